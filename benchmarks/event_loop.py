@@ -0,0 +1,85 @@
+"""
+Event Loop Benchmark
+
+Compares command throughput and event loop lag of the asyncio and uvloop
+loops by firing /quickroll interactions through the fake gateway.
+
+    python benchmarks/event_loop.py --interactions 5000 --concurrency 200
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+
+import discord
+from fake_discord import FakeGateway, percentile
+
+from utils.loop import LOOPS, loop_factory
+
+
+async def measure_lag(samples: list[float], interval: float = 0.005) -> None:
+    """Records how late the loop wakes a sleeping task, in seconds"""
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(time.perf_counter() - started - interval)
+
+
+async def run(interactions: int, concurrency: int) -> dict[str, float]:
+    from main import MyClient
+
+    client = MyClient(intents=discord.Intents.default())
+    gateway = FakeGateway(client)
+    await gateway.connect()
+    await gateway.load("cogs.roll")
+
+    lag: list[float] = []
+    monitor = asyncio.create_task(measure_lag(lag))
+
+    started = time.perf_counter()
+    for offset in range(0, interactions, concurrency):
+        batch = [
+            gateway.dispatch(gateway.slash("quickroll", amount=4, sides=6, modifier=2))
+            for _ in range(min(concurrency, interactions - offset))
+        ]
+        await asyncio.gather(*batch)
+    elapsed = time.perf_counter() - started
+
+    monitor.cancel()
+    await gateway.close()
+
+    latencies = gateway.latencies["quickroll"]
+    return {
+        "throughput": interactions / elapsed,
+        "p50": percentile(latencies, 0.5) * 1000,
+        "p99": percentile(latencies, 0.99) * 1000,
+        "lag_mean": statistics.fmean(lag) * 1000 if lag else 0.0,
+        "lag_max": max(lag, default=0.0) * 1000,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--interactions", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=100)
+    args = parser.parse_args()
+
+    print(
+        f"{'loop':<8} {'cmds/s':>10} {'p50 ms':>8} {'p99 ms':>8} "
+        f"{'lag ms':>8} {'max lag':>8}"
+    )
+    for requested in LOOPS:
+        name, factory = loop_factory(requested)
+        if name != requested:
+            continue
+        with asyncio.Runner(loop_factory=factory) as runner:
+            result = runner.run(run(args.interactions, args.concurrency))
+        print(
+            f"{name:<8} {result['throughput']:>10.0f} {result['p50']:>8.2f} "
+            f"{result['p99']:>8.2f} {result['lag_mean']:>8.2f} {result['lag_max']:>8.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,534 @@
+"""
+Fake Discord
+
+A stand-in for the Discord gateway and REST layer so MyClient and its cogs can
+be driven on a developer machine without a token or a network connection.
+"""
+
+import asyncio
+import itertools
+import json
+import os
+import sys
+import time
+from collections import Counter, defaultdict
+from contextvars import ContextVar
+from typing import Any
+
+import lavalink
+from discord import ClientUser
+from discord.webhook.async_ import AsyncWebhookAdapter, async_context
+
+# Make the bot's modules importable the same way running ./src/main.py does
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+APPLICATION_ID = 100000000000000001
+BOT_ID = 100000000000000002
+USER_ID = 100000000000000003
+CHANNEL_ID = 100000000000000004
+GUILD_ID = 100000000000000005
+VOICE_CHANNEL_ID = 100000000000000006
+
+OPTION_TYPES = {str: 3, int: 4, bool: 5, float: 10}
+ALL_PERMISSIONS = str((1 << 46) - 1)
+
+_snowflakes = itertools.count(200000000000000000)
+
+# The user interactions are sent as, set it per task to simulate many users
+acting_user: ContextVar[int] = ContextVar("acting_user", default=USER_ID)
+
+
+def snowflake() -> int:
+    return next(_snowflakes)
+
+
+def percentile(values: list[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+def user_payload(user_id: int = USER_ID, name: str = "tester") -> dict[str, Any]:
+    return {
+        "id": str(user_id),
+        "username": name,
+        "global_name": name,
+        "discriminator": "0",
+        "avatar": None,
+    }
+
+
+def member_payload(user_id: int = USER_ID, name: str = "tester") -> dict[str, Any]:
+    return {
+        "user": user_payload(user_id, name),
+        "roles": [],
+        "joined_at": "2024-01-01T00:00:00+00:00",
+        "deaf": False,
+        "mute": False,
+        "flags": 0,
+    }
+
+
+def member_ids(members: int) -> list[int]:
+    return [USER_ID] + [USER_ID + 1000 + i for i in range(members - 1)]
+
+
+def guild_payload(guild_id: int = GUILD_ID, members: int = 1) -> dict[str, Any]:
+    """Builds a GUILD_CREATE with a text and voice channel and *members* members"""
+    return {
+        "id": str(guild_id),
+        "name": f"guild-{guild_id}",
+        "owner_id": str(USER_ID),
+        "features": [],
+        "emojis": [],
+        "stickers": [],
+        "member_count": members,
+        "roles": [
+            {
+                "id": str(guild_id),
+                "name": "@everyone",
+                "permissions": ALL_PERMISSIONS,
+                "position": 0,
+                "color": 0,
+                "hoist": False,
+                "managed": False,
+                "mentionable": False,
+            }
+        ],
+        "channels": [
+            {"id": str(CHANNEL_ID), "type": 0, "name": "general", "position": 0},
+            {
+                "id": str(VOICE_CHANNEL_ID),
+                "type": 2,
+                "name": "voice",
+                "position": 1,
+                "bitrate": 64000,
+                "user_limit": 0,
+            },
+        ],
+        "members": [member_payload(user_id) for user_id in member_ids(members)],
+        "voice_states": [
+            {
+                "user_id": str(user_id),
+                "channel_id": str(VOICE_CHANNEL_ID),
+                "session_id": "session",
+                "deaf": False,
+                "mute": False,
+                "self_deaf": False,
+                "self_mute": False,
+                "self_video": False,
+                "suppress": False,
+            }
+            for user_id in member_ids(members)
+        ],
+    }
+
+
+def message_payload(data: dict[str, Any] | None = None) -> dict[str, Any]:
+    """Builds the message Discord would return for a sent or edited message"""
+    data = data or {}
+    return {
+        "id": str(snowflake()),
+        "channel_id": str(CHANNEL_ID),
+        "author": user_payload(BOT_ID, "spellbot"),
+        "content": data.get("content") or "",
+        "timestamp": "2024-01-01T00:00:00+00:00",
+        "edited_timestamp": None,
+        "tts": False,
+        "mention_everyone": False,
+        "mentions": [],
+        "mention_roles": [],
+        "attachments": [],
+        "embeds": data.get("embeds") or [],
+        "components": data.get("components") or [],
+        "pinned": False,
+        "type": 0,
+        "flags": data.get("flags", 0),
+    }
+
+
+def track(index: int) -> lavalink.AudioTrack:
+    return lavalink.AudioTrack(
+        {
+            "encoded": f"track-{index}",
+            "info": {
+                "identifier": str(index),
+                "isSeekable": True,
+                "author": "Fake Artist",
+                "length": 180000,
+                "isStream": False,
+                "title": f"Fake Song {index}",
+                "uri": f"https://example.com/watch?v={index}",
+                "sourceName": "youtube",
+                "position": 0,
+            },
+        },
+        0,
+    )
+
+
+class FakeNode:
+    def __init__(self, latency: float) -> None:
+        self.latency = latency
+        self.searches = 0
+
+    async def get_tracks(self, query: str) -> lavalink.LoadResult:
+        self.searches += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return lavalink.LoadResult(
+            lavalink.LoadType.SEARCH, [track(i) for i in range(5)]
+        )
+
+
+class FakePlayer:
+    """Just enough of lavalink.DefaultPlayer for the music cog"""
+
+    def __init__(self, guild_id: int, node: FakeNode) -> None:
+        self.guild_id = guild_id
+        self.node = node
+        self.queue: list[lavalink.AudioTrack] = []
+        self.current: lavalink.AudioTrack | None = None
+        self.channel_id: int | None = VOICE_CHANNEL_ID
+        self.is_connected = True
+        self.paused = False
+        self.shuffle = False
+        self.loop = 0
+        self.position = 0
+        self._store: dict[str, Any] = {}
+
+    @property
+    def is_playing(self) -> bool:
+        return self.current is not None and not self.paused
+
+    def store(self, key: str, value: Any) -> None:
+        self._store[key] = value
+
+    def add(self, track: lavalink.AudioTrack, requester: int = 0) -> None:
+        self.queue.append(track)
+
+    async def play(self) -> None:
+        self.current = self.queue.pop(0) if self.queue else None
+
+    async def skip(self) -> None:
+        await self.play()
+
+    async def stop(self) -> None:
+        self.current = None
+
+    async def set_pause(self, pause: bool) -> None:
+        self.paused = pause
+
+    def set_loop(self, loop: int) -> None:
+        self.loop = loop
+
+    def set_shuffle(self, shuffle: bool) -> None:
+        self.shuffle = shuffle
+
+
+class FakePlayerManager:
+    def __init__(self, node: FakeNode) -> None:
+        self.node = node
+        self.players: dict[int, FakePlayer] = {}
+
+    def get(self, guild_id: int) -> FakePlayer | None:
+        return self.players.get(guild_id)
+
+    def create(self, guild_id: int) -> FakePlayer:
+        return self.players.setdefault(guild_id, FakePlayer(guild_id, self.node))
+
+
+class FakeLavalink:
+    """Stands in for lavalink.Client, set as client.lavalink before loading cogs.music"""
+
+    def __init__(self, latency: float = 0.0) -> None:
+        self.node = FakeNode(latency)
+        self.player_manager = FakePlayerManager(self.node)
+        self.hooks: list[Any] = []
+
+    def add_event_hook(self, *hooks: Any) -> None:
+        self.hooks.extend(hooks)
+
+    def remove_event_hooks(self, *, hooks: list[Any]) -> None:
+        for hook in hooks:
+            self.hooks.remove(hook)
+
+
+class FakeVoiceClient:
+    def __init__(self, channel: Any) -> None:
+        self.channel = channel
+
+    async def disconnect(self, *, force: bool = False) -> None:
+        pass
+
+
+class FakeWebhookAdapter(AsyncWebhookAdapter):
+    """Answers interaction responses, followups and edits locally"""
+
+    def __init__(self, gateway: "FakeGateway"):
+        super().__init__()
+        self.gateway = gateway
+
+    async def request(self, route, session=None, *, payload=None, multipart=None, **_):
+        if multipart:
+            payload = next(
+                (part["value"] for part in multipart if part["name"] == "payload_json"),
+                None,
+            )
+            payload = payload and json.loads(payload)
+        return await self.gateway.handle(
+            route.method, route.path, str(route.webhook_token), payload
+        )
+
+
+class FakeGateway:
+    """
+    Fake Gateway
+
+    Feeds synthetic interactions into *client* and answers every request it
+    makes to Discord. It records how often each route was called and, per
+    command, how long each interaction took to get its first response.
+    """
+
+    def __init__(
+        self, client, *, rest_latency: float = 0.0, lavalink_latency: float = 0.0
+    ) -> None:
+        self.client = client
+        self.rest_latency = rest_latency
+        self.lavalink = FakeLavalink(lavalink_latency)
+        self.calls: Counter[str] = Counter()
+        self.latencies: defaultdict[str, list[float]] = defaultdict(list)
+        self.messages: dict[str, dict[str, Any]] = {}
+        self._interactions: dict[str, dict[str, Any]] = {}
+        self._pending: dict[str, tuple[str, float, asyncio.Future]] = {}
+        self._edits: dict[str, asyncio.Future] = {}
+
+    async def connect(self) -> None:
+        client = self.client
+        await client._async_setup_hook()
+        client._connection.user = ClientUser(
+            state=client._connection,
+            data={**user_payload(BOT_ID, "spellbot"), "bot": True},
+        )
+        client._connection.application_id = APPLICATION_ID
+        client.http.request = self._rest
+        client.lavalink = self.lavalink
+        async_context.set(FakeWebhookAdapter(self))
+
+    async def load(self, *extensions: str) -> None:
+        for extension in extensions:
+            await self.client.load_extension(extension)
+
+    def add_guild(self, guild_id: int = GUILD_ID, members: int = 1):
+        """Adds a guild in which the test user sits in a voice channel with the bot"""
+        state = self.client._connection
+        guild = state._add_guild_from_data(guild_payload(guild_id, members))
+        state._add_voice_client(
+            guild.id, FakeVoiceClient(guild.get_channel(VOICE_CHANNEL_ID))
+        )
+        return guild
+
+    async def close(self) -> None:
+        for _, _, future in self._pending.values():
+            future.cancel()
+        self.client._connection.clear()
+
+    async def _rest(self, route, **kwargs) -> Any:
+        return await self.handle(
+            route.method, route.path, None, kwargs.get("json"), kwargs.get("params")
+        )
+
+    async def handle(
+        self, method: str, path: str, token: str | None, payload=None, params=None
+    ) -> Any:
+        self.calls[f"{method} {path}"] += 1
+        if self.rest_latency:
+            await asyncio.sleep(self.rest_latency)
+
+        if path.endswith("/callback") and token is not None:
+            # 4 sends a message, 7 edits the message a component is on
+            if payload and payload.get("type") in (4, 7):
+                self._store_message(token, payload.get("data"))
+            if token in self._pending:
+                label, started, future = self._pending.pop(token)
+                self.latencies[label].append(time.perf_counter() - started)
+                if not future.done():
+                    future.set_result(payload)
+            return None
+
+        if path.endswith("/messages/@original") and token is not None:
+            if method == "PATCH":
+                self._store_message(token, payload)
+                if token in self._edits and not self._edits[token].done():
+                    self._edits.pop(token).set_result(payload)
+            return self.messages.get(token) or message_payload(payload)
+
+        if path.startswith("/applications") and method == "PUT":
+            return payload or []
+        if "/messages" in path or (path.startswith("/webhooks") and method == "POST"):
+            return message_payload(payload)
+        return None
+
+    def _store_message(self, token: str, data: dict[str, Any] | None) -> None:
+        message = self.messages.get(token) or message_payload()
+        for key in ("content", "embeds", "components"):
+            if data and key in data:
+                message[key] = data[key]
+        interaction = self._interactions.get(token)
+        if interaction is not None and "guild_id" in interaction:
+            message["guild_id"] = interaction["guild_id"]
+        if interaction is not None and "interaction_metadata" not in message:
+            message["interaction_metadata"] = {
+                "id": interaction["id"],
+                "type": interaction["type"],
+                "user": interaction.get("user") or interaction["member"]["user"],
+                "authorizing_integration_owners": {},
+            }
+        self.messages[token] = message
+
+    def interaction(
+        self, type: int, data: dict[str, Any], guild: bool = False, **extra: Any
+    ) -> dict[str, Any]:
+        interaction_id = snowflake()
+        payload = {
+            "id": str(interaction_id),
+            "application_id": str(APPLICATION_ID),
+            "type": type,
+            "token": f"token-{interaction_id}",
+            "version": 1,
+            "channel": {"id": str(CHANNEL_ID), "type": 1, "recipients": []},
+            "channel_id": str(CHANNEL_ID),
+            "user": user_payload(acting_user.get()),
+            "app_permissions": "0",
+            "locale": "en-US",
+            "entitlements": [],
+            "data": data,
+            **extra,
+        }
+        if guild:
+            del payload["user"]
+            payload["guild_id"] = str(GUILD_ID)
+            payload["channel"] = {"id": str(CHANNEL_ID), "type": 0, "name": "general"}
+            payload["member"] = {
+                **member_payload(acting_user.get()),
+                "permissions": ALL_PERMISSIONS,
+            }
+        return payload
+
+    def slash(self, name: str, guild: bool = False, **options: Any) -> dict[str, Any]:
+        return self.interaction(
+            2,
+            {
+                "id": str(snowflake()),
+                "name": name,
+                "type": 1,
+                "options": [
+                    {"name": key, "type": OPTION_TYPES[type(value)], "value": value}
+                    for key, value in options.items()
+                ],
+            },
+            guild,
+        )
+
+    def subcommand(
+        self, group: str, subcommand: str, guild: bool = False, **options: Any
+    ) -> dict[str, Any]:
+        """The slash command /*group* *subcommand*, options go to the subcommand"""
+        payload = self.slash(group, guild)
+        payload["data"]["options"] = [
+            {
+                "name": subcommand,
+                "type": 1,
+                "options": [
+                    {"name": key, "type": OPTION_TYPES[type(value)], "value": value}
+                    for key, value in options.items()
+                ],
+            }
+        ]
+        return payload
+
+    def autocomplete(
+        self, name: str, focused: str, current: str, guild: bool = False, **options: Any
+    ) -> dict[str, Any]:
+        payload = self.slash(name, guild, **options)
+        payload["type"] = 4
+        payload["data"]["options"].append(
+            {"name": focused, "type": 3, "value": current, "focused": True}
+        )
+        return payload
+
+    def click(
+        self, message: dict[str, Any], custom_id: str, values: list[str] | None = None
+    ) -> dict[str, Any]:
+        """A button click, or a select when *values* is given, on *message*"""
+        data: dict[str, Any] = {"custom_id": custom_id, "component_type": 2}
+        if values is not None:
+            data.update(component_type=3, values=values)
+        guild = "guild_id" in message
+        payload = self.interaction(3, data, guild, message=message)
+        self.messages[payload["token"]] = message
+        return payload
+
+    def submit(
+        self,
+        modal: dict[str, Any],
+        values: dict[str, str],
+        guild: bool = False,
+        message: dict[str, Any] | None = None,
+    ) -> dict[str, Any]:
+        """
+        Submits the *modal* a handler sent, filling text inputs by their label,
+        from the *message* whose component opened it when there is one
+        """
+        rows = [
+            {
+                "type": 1,
+                "components": [
+                    {
+                        "type": 4,
+                        "custom_id": field["custom_id"],
+                        "value": values.get(field["label"], field.get("value", "")),
+                    }
+                    for field in row["components"]
+                ],
+            }
+            for row in modal["data"]["components"]
+        ]
+        data = {"custom_id": modal["data"]["custom_id"], "components": rows}
+        if message is None:
+            return self.interaction(5, data, guild)
+        payload = self.interaction(5, data, guild, message=message)
+        self.messages[payload["token"]] = message
+        return payload
+
+    def dispatch(self, payload: dict[str, Any]) -> asyncio.Future:
+        """Delivers *payload* as an INTERACTION_CREATE, resolving on its first response"""
+        data = payload["data"]
+        label = data.get("name") or f"click:{data.get('custom_id')}"
+        if payload["type"] == 4:
+            label += ":autocomplete"
+        elif payload["type"] == 5:
+            label = "modal"
+
+        future = asyncio.get_running_loop().create_future()
+        self._interactions[payload["token"]] = payload
+        self._pending[payload["token"]] = (label, time.perf_counter(), future)
+        self.client._connection.parse_interaction_create(payload)
+        return future
+
+    def edited(self, payload: dict[str, Any]) -> asyncio.Future:
+        """Resolves the next time the original response of *payload* is edited"""
+        future = asyncio.get_running_loop().create_future()
+        self._edits[payload["token"]] = future
+        return future
+
+    def report(self) -> str:
+        lines = [f"{'interaction':<32} {'count':>7} {'p50 ms':>9} {'p99 ms':>9}"]
+        for label, latencies in sorted(self.latencies.items()):
+            p50 = percentile(latencies, 0.5) * 1000
+            p99 = percentile(latencies, 0.99) * 1000
+            lines.append(f"{label:<32} {len(latencies):>7} {p50:>9.2f} {p99:>9.2f}")
+        lines.append("")
+        lines.append(f"{'route':<60} {'calls':>7}")
+        for route, count in self.calls.most_common():
+            lines.append(f"{route:<60} {count:>7}")
+        return "\n".join(lines)
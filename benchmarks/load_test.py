@@ -0,0 +1,214 @@
+"""
+Load Test
+
+Replays synthetic traffic against every cog through the fake gateway and
+reports response latencies and Discord/Lavalink call counts.
+
+    python benchmarks/load_test.py --rate 50 --duration 10
+"""
+
+import argparse
+import asyncio
+import random
+import time
+from typing import Any
+
+import discord
+from fake_discord import FakeGateway, acting_user, member_ids, track
+
+SPELLS = [
+    {
+        "name": f"spell {i}",
+        "level": i % 10,
+        "school": "VAEIDNTC"[i % 8],
+        "ritual": i % 7 == 0,
+        "casttime": "1 action",
+        "range": "60 feet",
+        "components": {"verbal": True, "somatic": i % 2 == 0, "material": ""},
+        "duration": "Instantaneous",
+        "classes": "Wizard, Sorcerer" if i % 2 else "Cleric, Druid",
+        "subclasses": "",
+        "description": "A synthetic spell. " * 40,
+    }
+    for i in range(400)
+]
+
+
+async def quickroll(gateway: FakeGateway) -> None:
+    await gateway.dispatch(gateway.slash("quickroll", amount=4, sides=6, modifier=2))
+
+
+async def rollodds(gateway: FakeGateway) -> None:
+    expression = random.choice(("4d6kh3", "2d20kh1 + 5", "8d6", "4d6mi2ro1", "4d6rol1"))
+    await gateway.dispatch(gateway.slash("rollodds", expression=expression, goal=12))
+
+
+async def grouproll(gateway: FakeGateway) -> None:
+    await gateway.dispatch(
+        gateway.slash("grouproll", expression="1d20 + 4", count=30, dc=14)
+    )
+
+
+async def rollstats(gateway: FakeGateway) -> None:
+    await gateway.dispatch(gateway.slash("rollstats"))
+
+
+def component(message: dict[str, Any], action: str) -> str:
+    """The custom_id of the roll builder component for *action* on *message*"""
+    return next(
+        item["custom_id"]
+        for row in message["components"]
+        for item in row["components"]
+        if item["custom_id"].startswith(f"rb:{action}:")
+    )
+
+
+async def complexroll(gateway: FakeGateway) -> None:
+    """Builds a 4d6 through the roll builder's select, modals and buttons, then rolls it"""
+    command = gateway.slash("complexroll")
+    await gateway.dispatch(command)
+    message = gateway.messages[command["token"]]
+
+    select = gateway.click(message, component(message, "sel"), ["New"])
+    modal = await gateway.dispatch(select)
+    submit = gateway.submit(
+        modal, {"# of dice": "4", "# of sides": "6"}, message=message
+    )
+    await gateway.dispatch(submit)
+    message = gateway.messages[submit["token"]]
+
+    keep = gateway.click(message, component(message, "keep"))
+    modal = await gateway.dispatch(keep)
+    submit = gateway.submit(
+        modal,
+        {"Selector": "highest", "Number": "3", "Drop Or Keep": "keep"},
+        message=message,
+    )
+    await gateway.dispatch(submit)
+    message = gateway.messages[submit["token"]]
+
+    await gateway.dispatch(gateway.click(message, component(message, "roll")))
+
+
+async def macro(gateway: FakeGateway) -> None:
+    """Saves a macro, then runs it like a player would every turn"""
+    await gateway.dispatch(
+        gateway.subcommand("macro", "save", name="attack", expression="1d20 + 5")
+    )
+    for _ in range(3):
+        await gateway.dispatch(gateway.subcommand("macro", "run", name="attack"))
+
+
+async def spelldescription(gateway: FakeGateway) -> None:
+    name = random.choice(SPELLS)["name"]
+    for end in range(1, 6):
+        await gateway.dispatch(
+            gateway.autocomplete("spelldescription", "spell", name[:end])
+        )
+    await gateway.dispatch(gateway.slash("spelldescription", spell=name))
+
+
+async def spells(gateway: FakeGateway) -> None:
+    await gateway.dispatch(gateway.slash("spells", level=random.randrange(10)))
+
+
+async def play(gateway: FakeGateway) -> None:
+    query = "never gonna give"
+    for end in range(1, len(query), 3):
+        await gateway.dispatch(
+            gateway.autocomplete("play", "query", query[:end], guild=True)
+        )
+    await gateway.dispatch(gateway.slash("play", guild=True, query=query))
+
+
+async def queue(gateway: FakeGateway) -> None:
+    command = gateway.slash("queue", guild=True)
+    await gateway.dispatch(command)
+    message = gateway.messages[command["token"]]
+    for custom_id in ("right", "right", "left", "full_right", "full_left"):
+        await gateway.dispatch(gateway.click(message, custom_id))
+
+
+SCENARIOS = {
+    "roll": [quickroll, complexroll, rollodds, grouproll, rollstats],
+    "macro": [macro],
+    "spell": [spelldescription, spells],
+    "music": [play, queue],
+}
+
+
+async def run(
+    cogs: list[str], rate: float, duration: float, latency: float, users: int
+) -> None:
+    from main import MyClient
+
+    client = MyClient(intents=discord.Intents.default())
+    gateway = FakeGateway(client, rest_latency=latency, lavalink_latency=latency)
+    await gateway.connect()
+    await gateway.load(*(f"cogs.{cog}" for cog in cogs))
+    gateway.add_guild(members=users)
+    userIds = member_ids(users)
+
+    if "spell" in cogs:
+        # Skip the need for spells2.json by handing the cog a synthetic index
+        spell = client.get_cog("Spell")
+        spell.import_state(  # type: ignore
+            {
+                "spells": SPELLS,
+                "spellsByName": {s["name"]: s for s in SPELLS},
+                "spellNames": [s["name"].title() for s in SPELLS],
+            }
+        )
+    if "music" in cogs:
+        player = gateway.lavalink.player_manager.create(client.guilds[0].id)
+        player.queue.extend(track(i) for i in range(35))
+
+    async def session(scenario) -> None:
+        acting_user.set(random.choice(userIds))
+        await scenario(gateway)
+
+    scenarios = [scenario for cog in cogs for scenario in SCENARIOS[cog]]
+    sessions: list[asyncio.Task] = []
+    started = time.perf_counter()
+    while time.perf_counter() - started < duration:
+        sessions.append(asyncio.create_task(session(random.choice(scenarios))))
+        await asyncio.sleep(1 / rate)
+
+    done, pending = await asyncio.wait(sessions, timeout=30)
+    failed = [task for task in done if task.exception() is not None]
+    elapsed = time.perf_counter() - started
+
+    print(gateway.report())
+    print()
+    print(
+        f"{len(done) - len(failed)} sessions completed, {len(failed)} failed, "
+        f"{len(pending)} timed out in {elapsed:.1f}s "
+        f"({sum(map(len, gateway.latencies.values())) / elapsed:.0f} interactions/s)"
+    )
+    print(f"Lavalink searches: {gateway.lavalink.node.searches}")
+    for task in failed[:3]:
+        print(repr(task.exception()))
+
+    for task in pending:
+        task.cancel()
+    await gateway.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--cogs", nargs="+", default=list(SCENARIOS))
+    parser.add_argument("--rate", type=float, default=20, help="sessions per second")
+    parser.add_argument("--duration", type=float, default=5, help="seconds")
+    parser.add_argument(
+        "--latency", type=float, default=0.05, help="fake Discord/Lavalink latency"
+    )
+    parser.add_argument("--users", type=int, default=200, help="simulated users")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    asyncio.run(run(args.cogs, args.rate, args.duration, args.latency, args.users))
+
+
+if __name__ == "__main__":
+    main()
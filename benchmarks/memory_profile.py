@@ -0,0 +1,126 @@
+"""
+Memory Profile
+
+Compares the memory the client's caches take under the default and lean
+profiles after receiving a synthetic set of guilds and messages. The lean
+profile depends on the extensions loaded, only music asks for members in
+voice to be cached.
+
+    python benchmarks/memory_profile.py --guilds 200 --members 500
+    python benchmarks/memory_profile.py --extensions cogs.roll cogs.spell
+"""
+
+import argparse
+import asyncio
+import gc
+import tracemalloc
+
+from discord import ClientUser
+from fake_discord import (
+    BOT_ID,
+    CHANNEL_ID,
+    guild_payload,
+    member_payload,
+    message_payload,
+    user_payload,
+)
+
+from utils.profile import PROFILES, client_options
+
+
+async def measure(
+    profile: str,
+    extensions: list[str],
+    guilds: int,
+    members: int,
+    inVoice: int,
+    messages: int,
+) -> dict[str, float]:
+    from main import MyClient
+
+    client = MyClient(**client_options(profile, extensions))
+    await client._async_setup_hook()
+    state = client._connection
+    state.user = ClientUser(state=state, data={**user_payload(BOT_ID), "bot": True})
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+
+    for g in range(guilds):
+        guildId = 300000000000000000 + g
+        payload = guild_payload(guildId, 1)
+        userIds = [400000000000000000 + g * members + m for m in range(members)]
+        payload["members"] = [member_payload(userId) for userId in userIds]
+        payload["voice_states"] = [
+            {**payload["voice_states"][0], "user_id": str(userId)}
+            for userId in userIds[:inVoice]
+        ]
+        state._add_guild_from_data(payload)
+
+        for _ in range(messages):
+            message = message_payload({"content": "hello " * 20})
+            message["guild_id"] = str(guildId)
+            message["channel_id"] = str(CHANNEL_ID)
+            message["author"] = {**user_payload(userIds[0]), "bot": True}
+            state.parse_message_create(message)
+        await asyncio.sleep(0)
+
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    cachedMembers = sum(len(guild._members) for guild in client.guilds)
+    cachedMessages = len(state._messages) if state._messages is not None else 0
+    state.clear()
+    return {
+        "mb": used / 1024 / 1024,
+        "members": cachedMembers,
+        "messages": cachedMessages,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--guilds", type=int, default=100)
+    parser.add_argument("--members", type=int, default=200, help="members per guild")
+    parser.add_argument(
+        "--in-voice", type=int, default=2, help="members per guild in voice"
+    )
+    parser.add_argument(
+        "--messages", type=int, default=50, help="messages per guild received"
+    )
+    parser.add_argument(
+        "--extensions",
+        nargs="+",
+        help="extensions to build the profiles for, all by default",
+    )
+    args = parser.parse_args()
+    if args.extensions is None:
+        from main import EXTENSIONS
+
+        args.extensions = EXTENSIONS
+
+    print(
+        f"{args.guilds} guilds, {args.members} members and {args.messages} messages each"
+    )
+    print(f"extensions: {', '.join(sorted(args.extensions))}")
+    print(f"{'profile':<8} {'MB':>8} {'members':>9} {'messages':>9}")
+    for profile in PROFILES:
+        result = asyncio.run(
+            measure(
+                profile,
+                args.extensions,
+                args.guilds,
+                args.members,
+                args.in_voice,
+                args.messages,
+            )
+        )
+        print(
+            f"{profile:<8} {result['mb']:>8.1f} {result['members']:>9} {result['messages']:>9}"
+        )
+
+
+if __name__ == "__main__":
+    main()
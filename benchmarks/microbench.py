@@ -0,0 +1,261 @@
+"""
+Microbenchmarks
+
+Times the synchronous building blocks the commands are made of and compares
+them against the baselines stored in benchmarks/baselines.json. Baselines are
+only comparable on the machine that recorded them, save fresh ones before
+comparing on a new machine.
+
+    python benchmarks/microbench.py run --save
+    python benchmarks/microbench.py compare --threshold 0.25
+"""
+
+import argparse
+import asyncio
+import inspect
+import json
+import os
+import sys
+import tempfile
+import timeit
+from types import SimpleNamespace
+from typing import Any, Callable, Coroutine
+
+import discord
+from fake_discord import FakeLavalink, track
+
+import utils.rng as rng
+from utils.cost import estimate
+from utils.odds import distribution
+from utils.paginator import Paginator
+from utils.pools import roll_pool
+from utils.roll import (
+    Dice,
+    Die,
+    DropOrKeep,
+    KeepType,
+    MultiplyDivide,
+    MultiplyOrDivide,
+    Reroll,
+    RerollOn,
+    Selectors,
+    compile_expression,
+)
+from utils.settings import get_prefix
+from utils.simulate import simulate
+
+BASELINES = os.path.join(os.path.dirname(__file__), "baselines.json")
+
+DICE = [
+    Die(4, 6, keep=KeepType(Selectors.highest.value, 3, DropOrKeep.keep.value)),
+    Die(
+        2,
+        20,
+        type="fire",
+        modifier=3,
+        min=2,
+        reroll=Reroll(Selectors.exact.value, RerollOn.once.value, 1),
+    ),
+    Die(
+        8,
+        8,
+        negate=True,
+        multiplyDivide=MultiplyDivide(2, MultiplyOrDivide.divide.value),
+    ),
+]
+
+
+def die_str() -> Callable[[], Any]:
+    return lambda: [str(die) for die in DICE]
+
+
+def dice_roll() -> Callable[[], Any]:
+    return Dice(DICE).roll
+
+
+def dice_roll_seeded() -> Callable[[], Any]:
+    # The same dice every call, so the time doesn't depend on what was thrown
+    dice = Dice(DICE)
+    return lambda: dice.roll(seed=20)
+
+
+def rng_roll(backend: str, expression: str) -> Callable[[], Callable[[], Any]]:
+    def setup() -> Callable[[], Any]:
+        rng.backend = rng.BACKENDS[backend]
+        tree = compile_expression(expression)
+        return lambda: rng.roll(tree)
+
+    return setup
+
+
+def pool_roll(expression: str) -> Callable[[], Callable[[], Any]]:
+    return lambda: lambda: roll_pool(expression)
+
+
+def cost_estimate(expression: str) -> Callable[[], Callable[[], Any]]:
+    # The walk itself, without the cache of estimates in front of it
+    def setup() -> Callable[[], Any]:
+        tree = compile_expression(expression)
+        return lambda: estimate(tree)
+
+    return setup
+
+
+def odds_distribution(expression: str) -> Callable[[], Callable[[], Any]]:
+    # The engine itself, without the per expression cache in front of it
+    return lambda: lambda: distribution(expression)
+
+
+def simulate_million() -> Callable[[], Any]:
+    # Every sample, no early stop, ten dice going through a reroll and a keep
+    return lambda: simulate("10d6ro1kh5", samples=1_000_000, budget=60, precision=0)
+
+
+def paginator_update_button_status() -> Callable[[], Any]:
+    paginator = Paginator([discord.Embed(title=str(page)) for page in range(100)])
+    paginator.page = 50
+    return paginator.update_button_status
+
+
+def complete(coroutine: Coroutine[Any, Any, Any]) -> Any:
+    """Runs a coroutine that finishes without suspending, like a cache hit"""
+    try:
+        coroutine.send(None)
+    except StopIteration as stop:
+        return stop.value
+    coroutine.close()
+    raise RuntimeError("The coroutine suspended")
+
+
+async def settings_get_prefix() -> Callable[[], Any]:
+    directory = tempfile.mkdtemp()
+    with open(os.path.join(directory, "settings.json"), "w") as f:
+        json.dump({"prefixes": {str(guild): "!" for guild in range(1000)}}, f)
+    os.chdir(directory)
+    message = SimpleNamespace(guild=SimpleNamespace(id=500))
+    # Times the cached path every message takes, the file is read once
+    await get_prefix(None, message)  # type: ignore
+    return lambda: complete(get_prefix(None, message))  # type: ignore
+
+
+def music_queue_pages(tracks: int) -> Callable[[], Callable[[], Any]]:
+    def setup() -> Callable[[], Any]:
+        from cogs.music import Music
+
+        music = Music(SimpleNamespace(lavalink=FakeLavalink()))  # type: ignore
+        queue = [track(index) for index in range(tracks)]
+        return lambda: music.queue_pages(queue, "❌", "❌")
+
+    return setup
+
+
+CASES: dict[str, Callable[[], Any]] = {
+    "Die.__str__": die_str,
+    "Dice.roll": dice_roll,
+    "Dice.roll[seeded]": dice_roll_seeded,
+    "rng.roll[100d6 random]": rng_roll("random", "100d6"),
+    "rng.roll[100d6 numpy]": rng_roll("numpy", "100d6"),
+    "roll_pool[1000d6]": pool_roll("1000d6"),
+    "roll_pool[10000d20kh100]": pool_roll("10000d20kh100"),
+    "cost.estimate[4d6rr<3e6kh3]": cost_estimate("4d6rr<3e6kh3"),
+    "odds.distribution[4d6kh3]": odds_distribution("4d6kh3"),
+    "odds.distribution[8d6 + 5]": odds_distribution("8d6 + 5"),
+    "simulate[10d6ro1kh5 x 10^6]": simulate_million,
+    "Paginator.update_button_status": paginator_update_button_status,
+    "get_prefix": settings_get_prefix,
+    "Music.queue_pages[10]": music_queue_pages(10),
+    "Music.queue_pages[1000]": music_queue_pages(1_000),
+    "Music.queue_pages[10000]": music_queue_pages(10_000),
+}
+
+
+def measure(func: Callable[[], Any], repeat: int) -> float:
+    """Seconds per call, the best of *repeat* rounds of as many calls as fit in 0.2s"""
+    timer = timeit.Timer(func)
+    # The first round warms caches and lets the allocator settle, it doesn't count
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number
+
+
+async def run(names: list[str], repeat: int) -> dict[str, float]:
+    # Views need a running event loop to be built
+    cwd = os.getcwd()
+    results = {}
+    try:
+        for name in names:
+            func = CASES[name]()
+            if inspect.isawaitable(func):
+                func = await func
+            results[name] = measure(func, repeat)
+            print(f"{name:<32} {format_time(results[name]):>10}", file=sys.stderr)
+    finally:
+        os.chdir(cwd)
+    return results
+
+
+def format_time(seconds: float) -> str:
+    for unit, scale in (("s", 1), ("ms", 1e-3), ("µs", 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:.2f}{unit}"
+    return f"{seconds / 1e-9:.0f}ns"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("command", choices=("run", "compare"))
+    parser.add_argument(
+        "-k", dest="filter", default="", help="only cases containing this"
+    )
+    parser.add_argument("--repeat", type=int, default=7)
+    parser.add_argument(
+        "--save", action="store_true", help="store the results as the baselines"
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.25,
+        help="fail when a case is this much slower than its baseline",
+    )
+    args = parser.parse_args()
+
+    names = [name for name in CASES if args.filter in name]
+    results = asyncio.run(run(names, args.repeat))
+
+    if args.command == "run":
+        if args.save:
+            baselines = {}
+            if os.path.exists(BASELINES):
+                with open(BASELINES, encoding="utf-8") as f:
+                    baselines = json.load(f)
+            baselines.update(results)
+            with open(BASELINES, "w", encoding="utf-8") as f:
+                json.dump(baselines, f, indent=4, sort_keys=True)
+                f.write("\n")
+            print(f"Saved {len(results)} baselines to {BASELINES}")
+        return
+
+    with open(BASELINES, encoding="utf-8") as f:
+        baselines = json.load(f)
+
+    regressions = 0
+    print(f"{'case':<32} {'baseline':>10} {'now':>10} {'change':>8}")
+    for name, seconds in results.items():
+        baseline = baselines.get(name)
+        if baseline is None:
+            print(f"{name:<32} {'-':>10} {format_time(seconds):>10} {'new':>8}")
+            continue
+        change = seconds / baseline - 1
+        regressed = change > args.threshold
+        regressions += regressed
+        print(
+            f"{name:<32} {format_time(baseline):>10} {format_time(seconds):>10} "
+            f"{change:>+8.0%}{'  REGRESSED' if regressed else ''}"
+        )
+
+    if regressions:
+        print(f"{regressions} cases regressed by more than {args.threshold:.0%}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
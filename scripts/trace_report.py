@@ -0,0 +1,69 @@
+"""
+Trace Report
+
+Aggregates the traces the bot wrote into a per-stage latency breakdown for
+every command.
+
+    python scripts/trace_report.py traces.jsonl*
+"""
+
+import argparse
+import glob
+import json
+import statistics
+from collections import defaultdict
+
+
+def percentile(values: list[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("files", nargs="*", default=["traces.jsonl*"])
+    parser.add_argument("--trace", help="only report this command")
+    args = parser.parse_args()
+
+    totals: defaultdict[str, list[float]] = defaultdict(list)
+    stages: defaultdict[str, defaultdict[str, list[float]]] = defaultdict(
+        lambda: defaultdict(list)
+    )
+
+    for pattern in args.files:
+        for path in glob.glob(pattern):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    trace = json.loads(line)
+                    if args.trace and trace["trace"] != args.trace:
+                        continue
+                    totals[trace["trace"]].append(trace["duration_ms"])
+                    # Sum repeated stages so each trace counts once per stage
+                    perTrace: defaultdict[str, float] = defaultdict(float)
+                    for span in trace["spans"]:
+                        perTrace[span["name"]] += span["duration_ms"]
+                    for name, duration in perTrace.items():
+                        stages[trace["trace"]][name].append(duration)
+
+    for name, durations in sorted(totals.items(), key=lambda item: -len(item[1])):
+        mean = statistics.fmean(durations)
+        print(
+            f"{name}: {len(durations)} traces, mean {mean:.1f}ms, "
+            f"p50 {percentile(durations, 0.5):.1f}ms, p95 {percentile(durations, 0.95):.1f}ms"
+        )
+        print(
+            f"    {'stage':<50} {'seen':>6} {'mean ms':>9} {'p95 ms':>9} {'share':>6}"
+        )
+        for stage, values in sorted(
+            stages[name].items(), key=lambda item: -statistics.fmean(item[1])
+        ):
+            share = sum(values) / sum(durations) if sum(durations) else 0
+            print(
+                f"    {stage:<50} {len(values):>6} {statistics.fmean(values):>9.1f} "
+                f"{percentile(values, 0.95):>9.1f} {share:>6.0%}"
+            )
+        print()
+
+
+if __name__ == "__main__":
+    main()
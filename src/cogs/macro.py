@@ -0,0 +1,203 @@
+import asyncio
+
+import d20
+import discord
+from discord import app_commands
+from discord.ext import commands
+
+from utils.autocomplete import Autocomplete
+from utils.cost import check
+from utils.errors import BadRoll, PoolSaturated
+from utils.history import history
+from utils.macros import GUILD, MAX_NAME_LENGTH, USER, macros, validate
+from utils.pools import PoolRoll, is_large, pool_embed, record_pool, roll_pool
+from utils.rng import roll, seed_footer
+from utils.roll import roll_expression
+from utils.throttle import Limit, Throttle
+
+
+# Intents and member caching the lean profile turns on for this cog, none
+REQUIRED_INTENTS: list[str] = []
+MEMBER_CACHE: list[str] = []
+
+macroThrottle = Throttle(user=Limit(5, 10.0))
+
+
+def macro_key(_, interaction: discord.Interaction) -> tuple[int, int | None]:
+    return interaction.user.id, interaction.guild_id
+
+
+# Names are cached per user and guild, saving or deleting a macro forgets them
+macroNames = Autocomplete(limit=25, ttl=10.0, key=macro_key)
+
+
+def forget_names(scope: str, owner: int) -> None:
+    """Drops the cached names of everyone who sees the owner's macros"""
+    index = 0 if scope == USER else 1
+    macroNames.forget(lambda key: key[index] == owner)  # type: ignore
+
+
+class Macro(commands.Cog):
+    macro = app_commands.Group(name="macro", description="Save rolls to run by name")
+
+    def __init__(self, client: commands.Bot) -> None:
+        self.client = client
+
+    @macro.command(name="save", description="Save a roll under a name")
+    @app_commands.describe(
+        name="Name to run it by",
+        expression="Dice expression, like 4d6kh3 or 1d20 + 5",
+        shared="Let everyone in this server run it",
+    )
+    @macroThrottle.check()
+    async def save(
+        self,
+        interaction: discord.Interaction,
+        name: app_commands.Range[str, 1, MAX_NAME_LENGTH],
+        expression: app_commands.Range[str, 1, 200],
+        shared: bool = False,
+    ):
+        if shared and interaction.guild_id is None:
+            return await interaction.response.send_message(
+                "Shared macros can only be saved in a server.", ephemeral=True
+            )
+        scope, owner = (
+            (GUILD, interaction.guild_id) if shared else (USER, interaction.user.id)
+        )
+        try:
+            expression = await validate(expression, self.client.workers)  # type: ignore
+            await macros.save(scope, owner, name, expression, interaction.user.id)  # type: ignore
+            forget_names(scope, owner)  # type: ignore
+        except BadRoll as error:
+            return await interaction.response.send_message(
+                error.message, ephemeral=True
+            )
+        where = "for this server" if shared else "for you"
+        await interaction.response.send_message(
+            f"Saved `{expression}` as **{name}** {where}.", ephemeral=True
+        )
+
+    @macro.command(name="run", description="Roll a saved macro")
+    @app_commands.describe(name="Name of the macro, yours or this server's")
+    async def run(self, interaction: discord.Interaction, name: str):
+        macro = await macros.find(interaction.user.id, interaction.guild_id, name)
+        if macro is None:
+            return await interaction.response.send_message(
+                f"There is no macro called **{name}**.", ephemeral=True
+            )
+        try:
+            # Limits may have changed since it was saved
+            cost = check(macro.expression)
+            large = is_large(macro.expression)
+            if cost.inline:
+                # Parsed when it was saved or loaded, so it goes straight to rolling
+                rolled = roll_pool(macro.expression) if large else roll(macro.tree)
+            else:
+                rolled = await self.client.workers.submit(  # type: ignore
+                    roll_pool if large else roll_expression,
+                    macro.expression,
+                    kind="process",
+                    timeout=2.0,
+                )
+        except d20.RollError as error:
+            return await interaction.response.send_message(
+                f"**{macro.name}** can't be rolled: {error}", ephemeral=True
+            )
+        except BadRoll as error:
+            return await interaction.response.send_message(
+                error.message, ephemeral=True
+            )
+        except PoolSaturated:
+            return await interaction.response.send_message(
+                "Too many rolls at once, try again in a moment.", ephemeral=True
+            )
+        except asyncio.TimeoutError:
+            return await interaction.response.send_message(
+                f"**{macro.name}** is too big to finish in time.", ephemeral=True
+            )
+        if isinstance(rolled, PoolRoll):
+            record_pool(
+                interaction.user.id, interaction.channel_id, macro.expression, rolled
+            )
+            embed = pool_embed(macro.name, macro.expression, rolled)
+        else:
+            history.record(
+                interaction.user.id,
+                interaction.channel_id,
+                macro.expression,
+                rolled.result,
+            )
+            embed = discord.Embed(title=macro.name, description=str(rolled.result))
+        embed.set_author(
+            name=interaction.user.__str__(),
+            icon_url=interaction.user.avatar.url if interaction.user.avatar else None,
+        )
+        if rolled.seed is not None:
+            embed.set_footer(text=seed_footer(macro.expression, rolled.seed))
+        await interaction.response.send_message(embed=embed)
+
+    @macro.command(name="list", description="List your macros and this server's")
+    async def list_macros(self, interaction: discord.Interaction):
+        embed = discord.Embed(title="Macros", color=0xFEFEFE)
+        owners = [("Yours:", USER, interaction.user.id)]
+        if interaction.guild_id is not None:
+            owners.append(("This server's:", GUILD, interaction.guild_id))
+        for title, scope, owner in owners:
+            entries = await macros.entries(scope, owner)
+            value = "\n".join(
+                f"**{name}**: `{expression}`" for name, expression in entries
+            )
+            embed.add_field(name=title, value=value[:1024] or "None", inline=False)
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+
+    @macro.command(name="delete", description="Delete a saved macro")
+    @app_commands.describe(
+        name="Name of the macro",
+        shared="Delete this server's macro rather than yours",
+    )
+    async def delete(
+        self, interaction: discord.Interaction, name: str, shared: bool = False
+    ):
+        if shared and interaction.guild_id is None:
+            return await interaction.response.send_message(
+                "Shared macros only exist in a server.", ephemeral=True
+            )
+        scope, owner = (
+            (GUILD, interaction.guild_id) if shared else (USER, interaction.user.id)
+        )
+        macro = await macros.get(scope, owner, name)  # type: ignore
+        if macro is None:
+            return await interaction.response.send_message(
+                f"There is no macro called **{name}**.", ephemeral=True
+            )
+        permissions = interaction.permissions
+        if (
+            shared
+            and macro.author != interaction.user.id
+            and not permissions.manage_guild
+        ):
+            return await interaction.response.send_message(
+                "Only whoever saved a shared macro, or someone who can manage the server, "
+                "can delete it.",
+                ephemeral=True,
+            )
+        await macros.delete(scope, owner, name)  # type: ignore
+        forget_names(scope, owner)  # type: ignore
+        await interaction.response.send_message(
+            f"Deleted **{macro.name}**.", ephemeral=True
+        )
+
+    @run.autocomplete("name")
+    @delete.autocomplete("name")
+    @macroNames
+    async def name_autocomplete(
+        self, interaction: discord.Interaction, current: str
+    ) -> list[str]:
+        names = await macros.names(USER, interaction.user.id)
+        if interaction.guild_id is not None:
+            names += await macros.names(GUILD, interaction.guild_id)
+        return list(dict.fromkeys(names))
+
+
+async def setup(bot: commands.Bot) -> None:
+    await bot.add_cog(Macro(bot))
@@ -1,17 +1,38 @@
 import re
-from typing import List, Optional
+from typing import Optional
 
 import discord
 import lavalink
 from discord import app_commands
 from discord.ext import commands
-from fuzzywuzzy import fuzz, process
 from lavalink.client import asyncio
 
+from utils.autocomplete import Autocomplete
+from utils.defer import auto_defer
 from utils.paginator import Paginator
+from utils.singleflight import SingleFlight
+from utils.throttle import Limit, Throttle
+from utils.tracing import span
+
+# Members' voice states tell us which channel to join, and the members in voice
+# are cached to tell whether anyone is still listening
+REQUIRED_INTENTS = ["voice_states"]
+MEMBER_CACHE = ["voice"]
 
 url_rx = re.compile(r"https?://(?:www\.)?.+")
 
+# Every keystroke is a Lavalink search, keep one user from flooding the node
+playAutocompleteThrottle = Throttle(user=Limit(5, 2.0), guild=Limit(20, 2.0))
+
+# Searches are shared between guilds, players get their own copy of each track
+# since adding one sets its requester. Failed and empty searches aren't kept so
+# they can be retried
+trackSearches: SingleFlight[lavalink.LoadResult] = SingleFlight(
+    "lavalink.get_tracks",
+    ttl=600.0,
+    keep=lambda results: bool(results and results.tracks),
+)
+
 
 class MusicError(discord.DiscordException):
     """Custom Error for music commands"""
@@ -121,7 +142,19 @@ class Music(commands.Cog):
             clientLavalink.add_node(
                 "lavalink", 2333, "youshallnotpass", "us", "default-node"
             )
-            clientLavalink.add_event_hook(self.track_hook)  # type: ignore
+        # The lavalink client and its players outlive the cog, only the hook is per instance
+        getattr(client, "lavalink").add_event_hook(self.track_hook)
+
+    async def cog_load(self) -> None:
+        # Guilds whose player was idle on the last check
+        self.idlePlayers: set[int] = set()
+        self.client.scheduler.every(  # type: ignore
+            "music.reap_idle_players", 60, self.reap_idle_players, jitter=10
+        )
+
+    async def cog_unload(self) -> None:
+        # Remove the hook so a reloaded cog doesn't leave this instance's hook behind
+        getattr(self.client, "lavalink").remove_event_hooks(hooks=[self.track_hook])
 
     async def track_hook(self, event):
         if isinstance(event, lavalink.events.QueueEndEvent):
@@ -135,6 +168,23 @@ class Music(commands.Cog):
             if guild and guild.voice_client:
                 await guild.voice_client.disconnect(force=True)
 
+    async def reap_idle_players(self) -> None:
+        """Leaves voice where nothing has played or nobody has listened for two checks in a row"""
+        idle = set()
+        for guild in self.client.guilds:
+            voiceClient = guild.voice_client
+            if voiceClient is None:
+                continue
+            player = self.client.lavalink.player_manager.get(guild.id)  # type: ignore
+            listening = any(not member.bot for member in voiceClient.channel.members)  # type: ignore
+            if player is not None and player.is_playing and listening:
+                continue
+            if guild.id in self.idlePlayers:
+                await voiceClient.disconnect(force=True)
+            else:
+                idle.add(guild.id)
+        self.idlePlayers = idle
+
     async def ensure_voice(self, interaction: discord.Interaction):
         """This check ensures that the bot and command author are in the same voicechannel."""
         player = self.client.lavalink.player_manager.create(interaction.guild.id)  # type: ignore
@@ -178,9 +228,11 @@ class Music(commands.Cog):
 
     @app_commands.command(name="play", description="Play a song in voice chat")
     @app_commands.guild_only()
+    @auto_defer()
     async def play(self, interaction: discord.Interaction, query: str):
         """Searches and plays a song from a given query."""
-        await self.ensure_voice(interaction)
+        with span("ensure_voice"):
+            await self.ensure_voice(interaction)
 
         # Get the player for this guild from cache.
         player = self.client.lavalink.player_manager.get(interaction.guild.id)  # type: ignore
@@ -193,7 +245,10 @@ class Music(commands.Cog):
             query = f"ytsearch:{query}"
 
         # Get the results for the query from Lavalink.
-        results: lavalink.LoadResult = await player.node.get_tracks(query)
+        with span("lavalink get_tracks"):
+            results: lavalink.LoadResult = await trackSearches.do(
+                query, lambda: player.node.get_tracks(query)
+            )
 
         # Results could be None if Lavalink returns an invalid response (non-JSON/non-200 (OK)).
         # ALternatively, resullts.tracks could be an empty array if the query yielded no tracks.
@@ -216,7 +271,10 @@ class Music(commands.Cog):
 
             for track in tracks:
                 # Add all of the tracks from the playlist to the queue.
-                player.add(requester=interaction.user.id, track=track)
+                player.add(
+                    requester=interaction.user.id,
+                    track=lavalink.AudioTrack(track, requester=interaction.user.id),
+                )
 
             embed.title = "Playlist Enqueued!"
             embed.description = (
@@ -234,19 +292,25 @@ class Music(commands.Cog):
             embed.add_field(name="Length:", value=tracklength, inline=False)
             embed.add_field(name="Author:", value=track.author, inline=False)
 
-            player.add(requester=interaction.user.id, track=track)
+            player.add(
+                requester=interaction.user.id,
+                track=lavalink.AudioTrack(track, requester=interaction.user.id),
+            )
 
         await interaction.response.send_message(embed=embed)
 
         # We don't want to call .play() if the player is playing as that will effectively skip
         # the current track.
         if not player.is_playing:
-            await player.play()
+            with span("lavalink play"):
+                await player.play()
 
     @play.autocomplete(name="query")
+    @playAutocompleteThrottle.autocomplete
+    @Autocomplete(scorer=None, limit=5)
     async def play_autocomplete(
         self, interaction: discord.Interaction, current: str  # type: ignore
-    ) -> list[app_commands.Choice[str]]:
+    ) -> list[tuple[str, str]]:
         if len(current) == 0:
             return []
         if url_rx.match(current):
@@ -258,12 +322,14 @@ class Music(commands.Cog):
         if not player:
             return []
 
-        results: lavalink.LoadResult = await player.node.get_tracks(current)
+        with span("lavalink get_tracks"):
+            results: lavalink.LoadResult = await trackSearches.do(
+                current, lambda: player.node.get_tracks(current)
+            )
 
-        return [
-            app_commands.Choice(name=track.title, value=track.uri)
-            for track in results.tracks[:5]
-        ]
+        if not results:
+            return []
+        return [(track.title, track.uri) for track in results.tracks]
 
     @app_commands.command(
         name="disconnect",
@@ -302,6 +368,52 @@ class Music(commands.Cog):
         await interaction.guild.voice_client.disconnect(force=True)  # type: ignore
         await interaction.response.send_message("*⃣ | Disconnected.")
 
+    def queue_pages(
+        self, q: list[lavalink.AudioTrack], shuffle: str, repeat: str
+    ) -> list[discord.Embed]:
+        """Splits the queue into embeds of 10 tracks each for the paginator"""
+        embeds = []
+
+        # func that checks if 'a' is a multiple of b if not rounds up to the nearest
+        def round_up_nearest(a, b):
+            return a + b - (a % b) if a % b else a
+
+        # rounds the amount of songs up to a multiple of 10
+        times = round_up_nearest(len(q), 10)
+
+        times = times // 10  # divides it by 10 telling us how many pages we need
+
+        tracknum = 0  # tracks what track we are on
+        for x, _ in enumerate(range(times)):  # for the pages we need create pages
+            # create the page template
+            embed = discord.Embed(title="Queue", color=discord.Color.blurple())
+            embed.set_footer(
+                text=f"Shuffle: {shuffle} Loop: {repeat} Page {x + 1}/{times}"  # type: ignore
+            )
+
+            for y, track in enumerate(
+                q[10 * x :]  # flake8: ignore
+            ):  # create the page slicing out the songs already added
+                tracknum += 1
+
+                # Check if it is live
+                tracklength = (
+                    "LIVE" if track.stream else lavalink.format_time(track.duration)
+                )
+                embed.add_field(
+                    name=f"Track {tracknum}:",
+                    value=f"[{track.title}]({track.uri})\nLength: {tracklength}",
+                    inline=False,
+                )
+
+                # make sure each page has only 10 songs
+                if (y + 1) == 10:
+                    break
+
+            embeds.append(embed)  # add the page
+
+        return embeds
+
     @app_commands.command(name="queue", description="Display the bot's current queue")
     @app_commands.guild_only()
     async def queue(self, interaction: discord.Interaction):
@@ -329,45 +441,7 @@ class Music(commands.Cog):
             repeat = "❌"
         # check if pagination is required
         if len(q) > 10:
-            embeds = []
-
-            # func that checks if 'a' is a multiple of b if not rounds up to the nearest
-            def round_up_nearest(a, b):
-                return a + b - (a % b) if a % b else a
-
-            # rounds the amount of songs up to a multiple of 10
-            times = round_up_nearest(len(q), 10)
-
-            times = times // 10  # divides it by 10 telling us how many pages we need
-
-            tracknum = 0  # tracks what track we are on
-            for x, _ in enumerate(range(times)):  # for the pages we need create pages
-                # create the page template
-                embed = discord.Embed(title="Queue", color=discord.Color.blurple())
-                embed.set_footer(
-                    text=f"Shuffle: {shuffle} Loop: {repeat} Page {x + 1}/{times}"  # type: ignore
-                )
-
-                for y, track in enumerate(
-                    q[10 * x :]  # flake8: ignore
-                ):  # create the page slicing out the songs already added
-                    tracknum += 1
-
-                    # Check if it is live
-                    tracklength = (
-                        "LIVE" if track.stream else lavalink.format_time(track.duration)
-                    )
-                    embed.add_field(
-                        name=f"Track {tracknum}:",
-                        value=f"[{track.title}]({track.uri})\nLength: {tracklength}",
-                        inline=False,
-                    )
-
-                    # make sure each page has only 10 songs
-                    if (y + 1) == 10:
-                        break
-
-                embeds.append(embed)  # add the page
+            embeds = self.queue_pages(q, shuffle, repeat)  # type: ignore
 
             await interaction.response.send_message(
                 embed=embeds[0], view=Paginator(embeds)
@@ -542,15 +616,13 @@ class Music(commands.Cog):
         await interaction.response.send_message(embed=embed)
 
     @loop.autocomplete("type")
+    @Autocomplete(limit=3)
     async def loop_autocomplete(
         self, _: discord.Interaction, current: str
-    ) -> list[app_commands.Choice[str]]:
-        options = ["song", "queue", "off"]
-        for i in options:
-            if any([current.startswith(i[:y]) for y in range(1, len(i) + 1)]):
-                return [app_commands.Choice(name=i, value=i)]
-
-        return [app_commands.Choice(name=option, value=option) for option in options]
+    ) -> list[str]:
+        # Three fixed choices, only offer the ones that start with what was typed
+        current = current.strip().lower()
+        return [option for option in ("song", "queue", "off") if option.startswith(current)]
 
     @app_commands.command(name="clear", description="Clears the current queue")
     @app_commands.guild_only()
@@ -654,35 +726,21 @@ class Music(commands.Cog):
 
     @remove.autocomplete("song")  # type: ignore
     @app_commands.guild_only()
+    # The queue changes under the cache, so rank it fresh every time
+    @Autocomplete(limit=5, cacheSize=0)
     async def remove_autocomplete(
         self, interaction: discord.Interaction, current: str
-    ) -> List[app_commands.Choice[int]] | None:
+    ) -> list[tuple[str, int]]:
         player: lavalink.DefaultPlayer | None = self.client.lavalink.player_manager.get(  # type: ignore
             interaction.guild.id  # type: ignore
         )  # get the player as always
 
-        if player is None or player.queue == []:
+        if player is None:
             return []
 
-        titles = [track.title for track in player.queue]
-
-        if len(current) == 0:
-            return [
-                app_commands.Choice(name=trackName, value=trackPosition + 1)
-                for trackPosition, trackName in enumerate(titles[:5])
-            ]
-
-        matches = process.extract(
-            current, titles, scorer=fuzz.token_sort_ratio, limit=5
-        )
-
-        positions = {title: position for position, title in enumerate(titles)}
-
         return [
-            app_commands.Choice(name=trackTitle, value=trackPosition + 1)
-            for trackTitle, trackPosition in {
-                match[0]: positions[match[0]] for match in matches
-            }.items()
+            (track.title, trackPosition + 1)
+            for trackPosition, track in enumerate(player.queue)
         ]
 
     async def cog_app_command_error(self, interaction: discord.Interaction, error):
@@ -695,5 +753,7 @@ class Music(commands.Cog):
 
 
 async def setup(bot: commands.Bot) -> None:
-    await asyncio.sleep(5)
+    # Give Lavalink time to start on the first load, a reload can reuse the running client
+    if not hasattr(bot, "lavalink"):
+        await asyncio.sleep(5)
     await bot.add_cog(Music(bot))
@@ -1,23 +1,105 @@
 import asyncio
-from collections import OrderedDict
+import os
 
+import d20
 import discord
-from d20 import roll
+import numpy as np
 from discord import app_commands
 from discord.ext import commands
 
-from utils.roll import RollBuilder
+from utils.cost import check
+from utils.defer import auto_defer
+from utils.errors import BadRoll, OddsUnsupported, PoolSaturated
+from utils.history import (
+    current_run,
+    face_stats,
+    history,
+    load_snapshot,
+    longest_run,
+    save_snapshot,
+)
+from utils.odds import expression_odds, odds_embed
+from utils.pools import (
+    MAX_POOL_DICE,
+    is_large,
+    pool_embed,
+    record_pool,
+    roll_pool,
+)
+from utils.rng import SEED_BITS, seed_footer
+from utils.roll import roll_expression
+from utils.rollbuilder import BuilderButton, BuilderSelect, BuilderState, builder_view
+from utils.simulate import roll_batch, work_out_odds
+from utils.throttle import Limit, Throttle
+
+
+# Intents and member caching the lean profile turns on for this cog, none
+REQUIRED_INTENTS: list[str] = []
+MEMBER_CACHE: list[str] = []
+
+complexrollThrottle = Throttle(user=Limit(3, 10.0))
+rolloddsThrottle = Throttle(user=Limit(5, 10.0), guild=Limit(20, 10.0))
+
+HISTORY_FILE = os.getenv("ROLL_HISTORY_FILE", "rollhistory.npz")
+
+
+def group_table(totals: list[int], dc: int | None) -> str:
+    """Numbered totals laid out in columns, each marked when a DC is given"""
+    indexWidth = len(str(len(totals)))
+    totalWidth = max(len(str(total)) for total in totals)
+    cells = []
+    for index, total in enumerate(totals, start=1):
+        mark = "" if dc is None else (" ✓" if total >= dc else " ✗")
+        cells.append(f"{index:>{indexWidth}}: {total:>{totalWidth}}{mark}")
+    # Lines short enough that an embed doesn't wrap them
+    perLine = max(1, min(5, 48 // (len(cells[-1]) + 2)))
+    lines = [
+        "  ".join(cells[start : start + perLine])
+        for start in range(0, len(cells), perLine)
+    ]
+    return "```\n" + "\n".join(lines) + "\n```"
 
 
 class Roll(commands.Cog):
     def __init__(self, client: commands.Bot) -> None:
         self.client = client
 
+    async def cog_load(self) -> None:
+        # The history outlives a reload of the cog, only read the file on a fresh start
+        if not len(history):
+            snapshot = await asyncio.to_thread(load_snapshot, HISTORY_FILE)
+            if snapshot is not None:
+                history.restore(snapshot)
+        self.savedVersion = history.version
+        self.client.scheduler.every(  # type: ignore
+            "rolls.save_history",
+            float(os.getenv("ROLL_HISTORY_INTERVAL", "300")),
+            self.save_history,
+            jitter=10,
+        )
+        self.client.add_shutdown_hook(self.save_history)  # type: ignore
+        # One handler for the components of every roll builder, old ones included
+        self.client.add_dynamic_items(BuilderSelect, BuilderButton)
+
+    async def cog_unload(self) -> None:
+        self.client.remove_dynamic_items(BuilderSelect, BuilderButton)
+        self.client.remove_shutdown_hook(self.save_history)  # type: ignore
+        await self.save_history()
+
+    async def save_history(self) -> None:
+        """Writes the roll history to disk when it changed since the last time"""
+        version = history.version
+        if version == self.savedVersion:
+            return
+        await asyncio.to_thread(save_snapshot, HISTORY_FILE, history.snapshot())
+        self.savedVersion = version
+
     @app_commands.command(
         name="complexroll", description="Intricately orchestrate a new roll"
     )
+    @complexrollThrottle.check()
+    @auto_defer(ephemeral=True)
     async def roll(self, interaction: discord.Interaction):
-        view = RollBuilder(OrderedDict())
         embed = discord.Embed(
             title="Dice",
         )
@@ -25,7 +107,11 @@ class Roll(commands.Cog):
             name=interaction.user.__str__(),
             icon_url=interaction.user.avatar.url if interaction.user.avatar else None,
         )
-        await interaction.response.send_message(embed=embed, view=view, ephemeral=True)
+        await interaction.response.send_message(
+            embed=embed,
+            view=await builder_view(BuilderState([], None)),
+            ephemeral=True,
+        )
 
     @app_commands.command(name="quickroll", description="Quickly Roll Some Dice")
     @app_commands.describe(
@@ -37,13 +123,18 @@ class Roll(commands.Cog):
     async def qroll(
         self,
         interaction: discord.Interaction,
-        amount: app_commands.Range[int, 1, 10],
+        amount: app_commands.Range[int, 1, MAX_POOL_DICE],
         sides: app_commands.Range[int, 1, 100],
         modifier: app_commands.Range[int, -500, 500] = 0,
         goal: int = 0,
     ):
         # Create the roll
-        r = roll(f"{amount}d{sides} + {modifier}")
+        expression = f"{amount}d{sides} + {modifier}"
+        if is_large(expression):
+            return await self.large_qroll(interaction, expression, goal)
+        rolled = roll_expression(expression)
+        r = rolled.result
+        history.record(interaction.user.id, interaction.channel_id, expression, r)
 
         # Get raw dice rolls
         rolls = str(r)
@@ -74,6 +165,8 @@ class Roll(commands.Cog):
         # If DC
         if int(goal) != 0:
             em = discord.Embed()
+            if rolled.seed is not None:
+                em.set_footer(text=seed_footer(expression, rolled.seed))
 
             total = int(total)
 
@@ -85,6 +178,7 @@ class Roll(commands.Cog):
                 if modifier != 0:
                     em.add_field(name="Modifier:", value=str(modifier))
                 em.add_field(name="Total:", value=f"{str(total)} ≥ {str(goal)}")
+                em.add_field(name="Odds:", value=await self.goal_odds(expression, goal))
                 await asyncio.sleep(1)
                 await interaction.edit_original_response(embed=em)
 
@@ -96,6 +190,7 @@ class Roll(commands.Cog):
                 if modifier != 0:
                     em.add_field(name="Modifier:", value=str(modifier))
                 em.add_field(name="Total:", value=f"{str(total)} < {str(goal)}")
+                em.add_field(name="Odds:", value=await self.goal_odds(expression, goal))
                 await asyncio.sleep(1)
                 await interaction.edit_original_response(embed=em)
 
@@ -112,10 +207,276 @@ class Roll(commands.Cog):
 
         if int(amount) != 1 or modifier != 0:
             embed.add_field(name="Total:", value=total)
+        if rolled.seed is not None:
+            embed.set_footer(text=seed_footer(expression, rolled.seed))
 
         await asyncio.sleep(1)
         await interaction.edit_original_response(embed=embed)
 
+    async def large_qroll(
+        self, interaction: discord.Interaction, expression: str, goal: int
+    ) -> None:
+        """A quickroll of too many dice to list, shown as a histogram of its faces"""
+        rolled = roll_pool(expression)
+        record_pool(interaction.user.id, interaction.channel_id, expression, rolled)
+        embed = pool_embed("Rolled:", expression, rolled)
+        if goal != 0:
+            if rolled.total >= goal:
+                embed.title, embed.color = "Roll Sucess!", 0x00D138
+                embed.add_field(name="Goal:", value=f"{rolled.total} ≥ {goal}")
+            else:
+                embed.title, embed.color = "Roll Failure", 0xFF1100
+                embed.add_field(name="Goal:", value=f"{rolled.total} < {goal}")
+            embed.add_field(name="Odds:", value=await self.goal_odds(expression, goal))
+        if rolled.seed is not None:
+            embed.set_footer(text=seed_footer(expression, rolled.seed))
+        await interaction.response.send_message(
+            embed=discord.Embed(title="Rolling...", description=f"Rolling {expression}")
+        )
+        await asyncio.sleep(1)
+        await interaction.edit_original_response(embed=embed)
+
+    async def goal_odds(self, expression: str, goal: int) -> str:
+        try:
+            odds = await expression_odds(expression, self.client.workers)  # type: ignore
+        except OddsUnsupported:
+            return "Took too long to work out"
+        return f"{odds.at_least(goal):.1%} to reach {goal}"
+
+    @app_commands.command(
+        name="rollodds", description="Work out the odds of a dice expression"
+    )
+    @app_commands.describe(
+        expression="Dice expression, like 4d6kh3 or 2d20kh1 + 5",
+        goal="Number to try to beat",
+    )
+    @rolloddsThrottle.check()
+    @auto_defer()
+    async def rollodds(
+        self,
+        interaction: discord.Interaction,
+        expression: app_commands.Range[str, 1, 200],
+        goal: int | None = None,
+    ):
+        try:
+            check(expression)
+            odds, samples = await work_out_odds(
+                expression, self.client.workers, goal  # type: ignore
+            )
+        except d20.RollError as error:
+            return await interaction.response.send_message(
+                f"`{expression}` isn't a valid roll: {error}", ephemeral=True
+            )
+        except BadRoll as error:
+            return await interaction.response.send_message(
+                error.message, ephemeral=True
+            )
+        except OddsUnsupported as error:
+            return await interaction.response.send_message(
+                f"Can't work out the odds of `{expression}`: {error.reason}",
+                ephemeral=True,
+            )
+        await interaction.response.send_message(
+            embed=odds_embed(expression, odds, samples, goal)
+        )
+
+    @app_commands.command(
+        name="rollreplay",
+        description="Roll an expression again from the seed of a roll",
+    )
+    @app_commands.describe(
+        expression="The expression that was rolled, as the roll shows it",
+        seed="The seed in the footer of the roll",
+    )
+    async def rollreplay(
+        self,
+        interaction: discord.Interaction,
+        expression: app_commands.Range[str, 1, 300],
+        seed: app_commands.Range[int, 0, 2**SEED_BITS - 1],
+    ):
+        try:
+            cost = check(expression)
+            large = is_large(expression)
+            if cost.inline:
+                rolled = (roll_pool if large else roll_expression)(expression, seed)
+            else:
+                rolled = await self.client.workers.submit(  # type: ignore
+                    roll_pool if large else roll_expression,
+                    expression,
+                    seed,
+                    kind="process",
+                    timeout=2.0,
+                )
+        except d20.RollError as error:
+            return await interaction.response.send_message(
+                f"`{expression}` isn't a valid roll: {error}", ephemeral=True
+            )
+        except BadRoll as error:
+            return await interaction.response.send_message(
+                error.message, ephemeral=True
+            )
+        except PoolSaturated:
+            return await interaction.response.send_message(
+                "Too many rolls at once, try again in a moment.", ephemeral=True
+            )
+        except asyncio.TimeoutError:
+            return await interaction.response.send_message(
+                "That roll is too big to finish in time.", ephemeral=True
+            )
+        if large:
+            embed = pool_embed("Replayed roll", expression, rolled)
+        else:
+            embed = discord.Embed(
+                title="Replayed roll", description=str(rolled.result), color=0xFEFEFE
+            )
+        embed.set_footer(text=f"Seed {seed}")
+        await interaction.response.send_message(embed=embed)
+
+    @app_commands.command(
+        name="grouproll", description="Roll the same thing for a whole group at once"
+    )
+    @app_commands.describe(
+        expression="Dice expression, like 1d20 + 4",
+        count="How many to roll",
+        dc="Number each roll tries to reach",
+        seed="Seed of an earlier group roll to throw the same dice again",
+    )
+    async def grouproll(
+        self,
+        interaction: discord.Interaction,
+        expression: app_commands.Range[str, 1, 200],
+        count: app_commands.Range[int, 1, 100],
+        dc: int | None = None,
+        seed: app_commands.Range[int, 0, 2**SEED_BITS - 1] | None = None,
+    ):
+        try:
+            cost = check(expression, count)
+            # Every roll of the group in one vectorized batch
+            if cost.inline:
+                batch, seed = roll_batch(expression, count, seed)
+            else:
+                batch, seed = await self.client.workers.submit(  # type: ignore
+                    roll_batch, expression, count, seed, kind="process", timeout=2.0
+                )
+            totals = batch.tolist()
+        except d20.RollError as error:
+            return await interaction.response.send_message(
+                f"`{expression}` isn't a valid roll: {error}", ephemeral=True
+            )
+        except BadRoll as error:
+            return await interaction.response.send_message(
+                error.message, ephemeral=True
+            )
+        except PoolSaturated:
+            return await interaction.response.send_message(
+                "Too many rolls at once, try again in a moment.", ephemeral=True
+            )
+        except asyncio.TimeoutError:
+            return await interaction.response.send_message(
+                "That roll is too big to finish in time.", ephemeral=True
+            )
+        except OddsUnsupported as error:
+            return await interaction.response.send_message(
+                f"Can't roll `{expression}`: {error.reason}", ephemeral=True
+            )
+
+        embed = discord.Embed(
+            title=f"{count} × {expression}",
+            description=group_table(totals, dc),
+            color=0xFEFEFE,
+        )
+        embed.set_author(
+            name=interaction.user.__str__(),
+            icon_url=interaction.user.avatar.url if interaction.user.avatar else None,
+        )
+        if dc is not None:
+            successes = sum(total >= dc for total in totals)
+            embed.color = 0x00D138 if successes * 2 >= count else 0xFF1100
+            embed.add_field(name="Successes:", value=f"{successes}/{count} reach {dc}")
+        embed.add_field(name="Average:", value=f"{sum(totals) / count:.1f}")
+        embed.add_field(name="Range:", value=f"{min(totals)} to {max(totals)}")
+        if seed is not None:
+            embed.set_footer(
+                text=seed_footer(expression, seed, "grouproll", count=count)
+            )
+        await interaction.response.send_message(embed=embed)
+
+    @app_commands.command(
+        name="rollstats", description="See how your recent rolls in this channel went"
+    )
+    @app_commands.describe(user="Whose rolls to look at, yours by default")
+    @auto_defer()
+    async def rollstats(
+        self, interaction: discord.Interaction, user: discord.User | None = None
+    ):
+        user = user or interaction.user  # type: ignore
+        buffer = history.get(user.id, interaction.channel_id)  # type: ignore
+        if buffer is None or not buffer.rolls:
+            return await interaction.response.send_message(
+                f"{user} hasn't rolled in this channel lately.", ephemeral=True
+            )
+        expressionIds, totals, sides, faces = buffer.recent()
+
+        # What each roll would average, from the exact odds of its expression
+        expected = np.full(len(totals), np.nan)
+        for expressionId in np.unique(expressionIds).tolist():
+            expression = history.expression(expressionId)
+            if expression is None:
+                continue
+            try:
+                odds = await expression_odds(expression, self.client.workers)  # type: ignore
+            except (OddsUnsupported, d20.RollError):
+                continue
+            expected[expressionIds == expressionId] = odds.mean()
+
+        embed = discord.Embed(title=f"Recent rolls of {user}", color=0xFEFEFE)
+        embed.set_thumbnail(url=user.display_avatar.url)  # type: ignore
+        rolls = f"{len(totals)}"
+        if buffer.rolls > len(totals):
+            rolls = f"The last {len(totals)} of {buffer.rolls}"
+        embed.add_field(name="Rolls:", value=rolls)
+        embed.add_field(name="Average total:", value=f"{totals.mean():.2f}")
+
+        known = ~np.isnan(expected)
+        if known.any():
+            difference = totals[known] - expected[known]
+            above, below = difference > 0, difference < 0
+            embed.add_field(
+                name="Against the odds:",
+                value=f"{difference.mean():+.2f} a roll, "
+                f"{int(above.sum())} above and {int(below.sum())} below average",
+                inline=False,
+            )
+            streak = (
+                f"{current_run(above)} above average"
+                if current_run(above)
+                else f"{current_run(below)} below average"
+            )
+            embed.add_field(
+                name="Streaks:",
+                value=f"Longest {longest_run(above)} above and {longest_run(below)} "
+                f"below average, now {streak}",
+                inline=False,
+            )
+
+        if len(faces):
+            sizes, counts = np.unique(sides, return_counts=True)
+            lines = []
+            for size in sizes[np.argsort(-counts, kind="stable")][:3].tolist():
+                stats = face_stats(sides, faces, size)
+                line = (
+                    f"d{size}: {stats['thrown']} thrown, average {stats['mean']:.2f} "
+                    f"(fair is {stats['expected_mean']:.1f}), "
+                    f"{stats['highest']} × {size} and {stats['lowest']} × 1 "
+                    f"(fair is {stats['expected_each']:.1f} each)"
+                )
+                if stats["chi_square"] is not None:
+                    fair = stats["chi_square"] <= stats["chi_square_limit"]
+                    line += ", looks fair" if fair else ", unusually uneven"
+                lines.append(line)
+            embed.add_field(name="Dice:", value="\n".join(lines), inline=False)
+        await interaction.response.send_message(embed=embed)
+
 
 async def setup(bot: commands.Bot) -> None:
     await bot.add_cog(Roll(bot))
@@ -1,16 +1,90 @@
 import json
 from string import capwords
-from typing import List, Tuple
+from typing import Any, List, Tuple
 
 import discord
 from discord import app_commands
 from discord.ext import commands
-from fuzzywuzzy import fuzz, process
+
+from utils.autocomplete import Autocomplete
+from utils.defer import auto_defer
+from utils.singleflight import SingleFlight
+from utils.throttle import Limit, Throttle
+from utils.tracing import span
+
+
+# Intents and member caching the lean profile turns on for this cog, none
+REQUIRED_INTENTS: list[str] = []
+MEMBER_CACHE: list[str] = []
+
+sdAutocompleteThrottle = Throttle(user=Limit(10, 2.0))
+spellsThrottle = Throttle(user=Limit(3, 10.0), guild=Limit(15, 10.0))
+
+# Built embeds are only read after this, so everyone asking for a spell can share them
+spellDescriptions: SingleFlight[list[discord.Embed]] = SingleFlight(
+    "spelldescription", ttl=3600.0, maxEntries=512
+)
+
+CLASSES = [
+    "Artificer",
+    "Warlock",
+    "Wizard",
+    "Sorcerer",
+    "Rouge",
+    "Ranger",
+    "Paladin",
+    "Monk",
+    "Fighter",
+    "Druid",
+    "Bard",
+    "Barbarian",
+]
+
+SCHOOLS = [
+    "Evocation",
+    "Abjuration",
+    "Enchantment",
+    "Illusion",
+    "Divinitation",
+    "Necromancy",
+    "Transmutation",
+    "Conjuration",
+]
 
 
 class Spell(commands.Cog):
     def __init__(self, client: commands.Bot) -> None:
         self.client = client
+        self.spells: list[dict[str, Any]] = []
+        self.spellsByName: dict[str, dict[str, Any]] = {}
+        self.spellNames: list[str] = []
+
+    def get_spells(self) -> list[dict[str, Any]]:
+        """# Get Spells
+
+        Loads spells2.json the first time it is needed and keeps it, indexed by name, in memory
+
+        ## Returns:
+            - list: every spell
+        """
+        if not self.spells:
+            with span("load spells2.json"), open("spells2.json") as f:
+                self.spells = json.load(f)
+            self.spellsByName = {spell["name"].lower(): spell for spell in self.spells}
+            self.spellNames = [capwords(spell["name"]) for spell in self.spells]
+        return self.spells
+
+    def export_state(self) -> dict[str, Any]:
+        return {
+            "spells": self.spells,
+            "spellsByName": self.spellsByName,
+            "spellNames": self.spellNames,
+        }
+
+    def import_state(self, state: dict[str, Any]) -> None:
+        self.spells = state["spells"]
+        self.spellsByName = state["spellsByName"]
+        self.spellNames = state["spellNames"]
 
     def chunk_text(
         self, text, max_chunk_size=1024, chunk_on=("\n\n", "\n", ". ", " "), chunker_i=0
@@ -184,15 +258,8 @@ class Spell(commands.Cog):
     async def sd(self, interaction: discord.Interaction, spell: str):
         spell = spell.lower()
 
-        with open("spells2.json") as f:
-            f = json.load(f)
-
-        foundSpell = None
-
-        for i in f:
-            if i["name"].lower() == spell:
-                foundSpell = i
-                break
+        self.get_spells()
+        foundSpell = self.spellsByName.get(spell)
 
         if foundSpell is None:
             embed = discord.Embed(title="Spell Not Found", color=0xFF1100)
@@ -200,34 +267,19 @@ class Spell(commands.Cog):
             await interaction.response.send_message(embed=embed, ephemeral=True)
             return
 
-        embed, pieces = self.create_spell_embed(foundSpell)
-
         await interaction.response.send_message(
-            embeds=self.create_embed_queue(embed, pieces)
+            embeds=await spellDescriptions.do(
+                spell,
+                lambda: self.create_embed_queue(*self.create_spell_embed(foundSpell)),
+            )
         )
 
     @sd.autocomplete("spell")
-    async def sd_autocomplete(
-        self, _: discord.Interaction, current: str
-    ) -> list[app_commands.Choice[str]]:
-        with open("spells2.json") as f:
-            f = json.load(f)
-
-        listOfSpells = []
-
-        for i in f:
-            listOfSpells.append(capwords((i["name"])))
-
-        if len(current) == 0:
-            return [
-                app_commands.Choice(name=spell, value=spell)
-                for spell in listOfSpells[:12]
-            ]
-
-        matches = process.extract(
-            current, listOfSpells, scorer=fuzz.token_sort_ratio, limit=12
-        )
-        return [app_commands.Choice(name=match[0], value=match[0]) for match in matches]
+    @sdAutocompleteThrottle.autocomplete
+    @Autocomplete(limit=12)
+    async def sd_autocomplete(self, _: discord.Interaction, current: str) -> list[str]:
+        self.get_spells()
+        return self.spellNames
 
     @app_commands.command(
         name="spells", description="Get the list of spells matching a set of paramaters"
@@ -238,6 +290,8 @@ class Spell(commands.Cog):
         spellclass="Class which has the spells you are looking for",
         ritual="true/false if you are looking for only rituals",
     )
+    @spellsThrottle.check()
+    @auto_defer()
     async def spells(
         self,
         interaction: discord.Interaction,
@@ -246,12 +300,9 @@ class Spell(commands.Cog):
         spellclass: str = "none",
         ritual: bool = False,
     ):
-        with open("spells2.json") as f:
-            f = json.load(f)
-
         listOfSpells = []
 
-        for i in f:
+        for i in self.get_spells():
             if not i["ritual"] and ritual:
                 continue
             if level != -1 and i["level"] != level:
@@ -282,60 +333,18 @@ class Spell(commands.Cog):
         )
 
     @spells.autocomplete("spellclass")
+    @Autocomplete(limit=3, browse=len(CLASSES))
     async def spellclass_autocomplete(
         self, _: discord.Interaction, current: str
-    ) -> list[app_commands.Choice[str]]:
-        classes = [
-            "Artificer",
-            "Warlock",
-            "Wizard",
-            "Sorcerer",
-            "Rouge",
-            "Ranger",
-            "Paladin",
-            "Monk",
-            "Fighter",
-            "Druid",
-            "Bard",
-            "Barbarian",
-        ]
-
-        if len(current) == 0:
-            return [
-                app_commands.Choice(name=dndClass, value=dndClass)
-                for dndClass in classes
-            ]
-
-        matches = process.extract(
-            current, classes, scorer=fuzz.token_sort_ratio, limit=3
-        )
-        return [app_commands.Choice(name=match[0], value=match[0]) for match in matches]
+    ) -> list[str]:
+        return CLASSES
 
     @spells.autocomplete("type")
+    @Autocomplete(limit=3, browse=len(SCHOOLS))
     async def type_autocomplete(
         self, _: discord.Interaction, current: str
-    ) -> list[app_commands.Choice[str]]:
-        spellTypes = [
-            "Evocation",
-            "Abjuration",
-            "Enchantment",
-            "Illusion",
-            "Divinitation",
-            "Necromancy",
-            "Transmutation",
-            "Conjuration",
-        ]
-
-        if len(current) == 0:
-            return [
-                app_commands.Choice(name=spellType, value=spellType)
-                for spellType in spellTypes
-            ]
-
-        matches = process.extract(
-            current, spellTypes, scorer=fuzz.token_sort_ratio, limit=3
-        )
-        return [app_commands.Choice(name=match[0], value=match[0]) for match in matches]
+    ) -> list[str]:
+        return SCHOOLS
 
 
 async def setup(bot: commands.Bot) -> None:
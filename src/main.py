@@ -1,19 +1,77 @@
+import asyncio
+import json
+import logging
 import os
-import traceback
+import signal
+from typing import Awaitable, Callable
 
 import discord
+from discord import app_commands
 from discord.ext import commands
 from dotenv import load_dotenv
 
+from utils.caches import MemoryBudget, caches, memory_budget
+from utils.log import setup_logging
+from utils.loop import install_event_loop, running_loop_name
+from utils.macros import macros
+from utils.metrics import metrics
+from utils.profile import client_options
+from utils.scheduler import Scheduler
 from utils.settings import get_prefix
+from utils.tracing import setup_tracing
+from utils.tree import SpellbotState, SpellbotTree
+from utils.workers import WorkerPool
 
 MY_GUILD = discord.Object(id=792524491665702954)
 
+log = logging.getLogger("spellbot")
+metricsLog = logging.getLogger("metrics")
+
+EXTENSIONS = [
+    f"cogs.{extension[:-3]}"
+    for extension in os.listdir("./src/cogs")
+    if extension.endswith(".py")
+]
+
+
+async def log_metrics() -> None:
+    metricsLog.info("Metrics snapshot %s", json.dumps(metrics.snapshot()))
+
+
+async def close_macros() -> None:
+    # Waits for a query still running in a thread before the file is let go
+    await asyncio.to_thread(macros.close)
+
 
 class MyClient(commands.Bot):
-    def __init__(self, *, intents: discord.Intents):
-        super().__init__(command_prefix=get_prefix, intents=intents)
+    def __init__(self, *, intents: discord.Intents, **options):
+        super().__init__(
+            command_prefix=get_prefix,
+            intents=intents,
+            tree_cls=SpellbotTree,
+            **options,
+        )
         self.bot = MY_GUILD
+        self.tree: SpellbotTree
+        self.shutdownHooks: list[Callable[[], Awaitable[None]]] = []
+        self.shuttingDown = False
+        self.shutdownTask: asyncio.Task | None = None
+        self.workers = WorkerPool(
+            threads=int(os.getenv("WORKER_THREADS", "0")) or None,
+            processes=int(os.getenv("WORKER_PROCESSES", "0")) or None,
+        )
+        self.scheduler = Scheduler()
+        self.caches = caches
+
+    def _get_state(self, **options) -> SpellbotState:
+        # Lets component and modal interactions be turned away during shutdown
+        return SpellbotState(
+            dispatch=self.dispatch,
+            handlers=self._handlers,
+            hooks=self._hooks,
+            http=self.http,
+            **options,
+        )
 
     async def sync(self) -> None:
         self.tree.copy_global_to(guild=MY_GUILD)
@@ -21,102 +79,296 @@ class MyClient(commands.Bot):
         await self.tree.sync()
 
     async def setup_hook(self) -> None:
-        for extension in os.listdir("./src/cogs"):
-            if extension.endswith(".py"):
-                await client.load_extension(f"cogs.{extension[:-3]}")
+        for extension in EXTENSIONS:
+            await self.load_extension(extension)
         await self.sync()
+        self.workers.warm()
+        self.scheduler.every(
+            "metrics.snapshot",
+            float(os.getenv("METRICS_INTERVAL", "300")),
+            log_metrics,
+            jitter=5,
+        )
+        # The last metrics since the previous snapshot, and the macros file with
+        # the roll builder's states. Cogs add their own, like the roll history
+        self.add_shutdown_hook(log_metrics)
+        self.add_shutdown_hook(close_macros)
+        budget = memory_budget()
+        if budget is not None:
+            self.scheduler.every(
+                "caches.memory_budget", 30, MemoryBudget(budget).enforce
+            )
+
+        try:
+            self.loop.add_signal_handler(signal.SIGTERM, self.start_shutdown)
+        except NotImplementedError:
+            # Windows event loops don't support signal handlers
+            pass
+
+    def start_shutdown(self) -> None:
+        # The loop only keeps a weak reference to tasks, keep this one until it is done
+        if self.shutdownTask is None:
+            self.shutdownTask = asyncio.create_task(self.shutdown())
+
+    def add_shutdown_hook(self, hook: Callable[[], Awaitable[None]]) -> None:
+        """Registers a coroutine function to flush pending work when the bot shuts down"""
+        self.shutdownHooks.append(hook)
+
+    def remove_shutdown_hook(self, hook: Callable[[], Awaitable[None]]) -> None:
+        if hook in self.shutdownHooks:
+            self.shutdownHooks.remove(hook)
+
+    async def shutdown(self, timeout: float | None = None) -> None:
+        """
+        Shutdown
+
+        Stops the bot without dropping work: new commands are turned away, running
+        handlers get up to *timeout* seconds to finish, shutdown hooks flush what
+        they hold, voice clients disconnect and finally the gateway is closed.
+        """
+        if self.shuttingDown:
+            return
+        self.shuttingDown = True
+
+        if timeout is None:
+            timeout = float(os.getenv("SHUTDOWN_TIMEOUT", "8"))
+
+        log.info("Shutting down, no longer accepting commands")
+        self.tree.accepting = False
+
+        abandoned = await self.tree.drain(timeout)
+        if abandoned:
+            log.warning(
+                "%d interaction handlers did not finish in %ss", abandoned, timeout
+            )
+
+        for hook in self.shutdownHooks:
+            try:
+                await hook()
+            except Exception:
+                log.exception("Shutdown hook %s failed", hook.__qualname__)
+
+        for voiceClient in list(self.voice_clients):
+            try:
+                await voiceClient.disconnect(force=True)
+            except Exception:
+                log.exception("Failed to disconnect from %s", voiceClient.channel)
+
+        await self.close()
+
+    async def close(self) -> None:
+        self.scheduler.close()
+        await super().close()
+        self.workers.close()
 
+    async def _remove_module_references(self, name: str) -> None:
+        # Called on unload and on reload, the jobs of the old cogs must not keep running
+        self.scheduler.cancel_owner(name)
+        await super()._remove_module_references(name)
 
-intents: discord.Intents = discord.Intents.default()
-intents.voice_states = True
-intents.message_content = True
+    async def reload_extension(self, name: str, *, package: str | None = None) -> None:
+        """
+        Reload Extension
 
-client = MyClient(intents=intents)
+        Reloads an extension while letting its cogs carry state across the reload.
+        Before unloading, every cog of the extension with an `export_state` method
+        is asked for a snapshot, after loading the new cog with the same name gets
+        that snapshot passed to its `import_state` method.
+        """
+        name = self._resolve_name(name, package)
+        snapshot = {
+            cog.qualified_name: cog.export_state()  # type: ignore
+            for cog in self.cogs.values()
+            if cog.__module__ == name and hasattr(cog, "export_state")
+        }
+        try:
+            await super().reload_extension(name)
+        finally:
+            # On failure the old version of the extension is back and adopts it instead
+            for cog in self.cogs.values():
+                state = snapshot.get(cog.qualified_name)
+                if cog.__module__ == name and state is not None:
+                    if hasattr(cog, "import_state"):
+                        cog.import_state(state)  # type: ignore
 
 
-@client.tree.command()
+# Commands are only attached to a client in build_client, so that importing this
+# module, as every spawned worker process does, doesn't build a client
+
+
+@app_commands.command()
 async def ping(interaction: discord.Interaction):
     """Returns the bot's ping"""
-    await interaction.response.send_message(
-        embed=discord.Embed(
-            title="Pong!", description=f":hourglass: {round(client.latency * 1000)}ms"
-        )
+    embed = discord.Embed(
+        title="Pong!",
+        description=f":hourglass: {round(interaction.client.latency * 1000)}ms",
     )
+    embed.set_footer(text=f"Event loop: {running_loop_name()}")
+    await interaction.response.send_message(embed=embed)
 
 
 @commands.is_owner()
-@client.command()
+@commands.command()
 async def load(ctx: commands.Context, extension: str):
     try:
-        await client.load_extension(f"cogs.{extension}")
-        print(f"Loaded {extension}")
+        await ctx.bot.load_extension(f"cogs.{extension}")
+        log.info("Loaded %s", extension)
         embed = discord.Embed(
             title="Success",
             description=f"{extension} was properly reloaded",
             color=0x00D138,
         )
     except Exception as err:
-        print(f"{extension} failed to reload")
+        log.exception("%s failed to reload", extension)
         embed = discord.Embed(
             title="Error", description=f"{extension} failed to reload", color=0xFF0000
         )
         if ctx.guild and ctx.guild.id == MY_GUILD.id:
             embed.add_field(name="Error", value=f"```{err}```")
-        traceback.print_tb(err.__traceback__)
     await ctx.send(embed=embed)
-    await client.sync()
+    await ctx.bot.sync()  # type: ignore
 
 
 @commands.is_owner()
-@client.command()
+@commands.command()
 async def unload(ctx: commands.Context, extension: str):
     try:
-        await client.unload_extension(f"cogs.{extension}")
-        print(f"Unloaded {extension}")
+        await ctx.bot.unload_extension(f"cogs.{extension}")
+        log.info("Unloaded %s", extension)
         embed = discord.Embed(
             title="Success",
             description=f"{extension} was properly unloaded",
             color=0x00D138,
         )
     except Exception as err:
-        print(f"{extension} failed to unload")
+        log.exception("%s failed to unload", extension)
         embed = discord.Embed(
             title="Error", description=f"{extension} failed to unload", color=0xFF0000
         )
         if ctx.guild and ctx.guild.id == MY_GUILD.id:
             embed.add_field(name="Error", value=f"```{err}```")
-        traceback.print_tb(err.__traceback__)
     await ctx.send(embed=embed)
 
 
 @commands.is_owner()
-@client.command()
+@commands.command()
 async def reload(ctx: commands.Context, extension: str):
     try:
-        await client.unload_extension(f"cogs.{extension}")
-        await client.load_extension(f"cogs.{extension}")
-        print(f"Reloaded {extension}")
+        await ctx.bot.reload_extension(f"cogs.{extension}")
+        log.info("Reloaded %s", extension)
         embed = discord.Embed(
             title="Success",
             description=f"{extension} was properly reloaded",
             color=0x00D138,
         )
     except Exception as err:
-        print(f"{extension} failed to reload")
+        log.exception("%s failed to reload", extension)
         embed = discord.Embed(
             title="Error", description=f"{extension} failed to reload", color=0xFF0000
         )
         if ctx.guild and ctx.guild.id == MY_GUILD.id:
             embed.add_field(name="Error", value=f"```{err}```")
-        traceback.print_tb(err.__traceback__)
     await ctx.send(embed=embed)
-    await client.sync()
+    await ctx.bot.sync()  # type: ignore
+
+
+@commands.is_owner()
+@commands.command(name="metrics")
+async def show_metrics(ctx: commands.Context):
+    snapshot = metrics.snapshot()
+    embed = discord.Embed(title="Metrics", color=0xAC26EB)
+    counters = "\n".join(
+        f"{name}: {value}" for name, value in sorted(snapshot["counters"].items())
+    )
+    embed.add_field(name="Counters", value=f"```{counters or 'none'}```", inline=False)
+    timings = "\n".join(
+        f"{name}: {t['count']}x, mean {t['mean_ms']:.1f}ms, max {t['max_ms']:.1f}ms"
+        for name, t in sorted(snapshot["timings"].items())
+    )
+    embed.add_field(name="Timings", value=f"```{timings or 'none'}```", inline=False)
+    workers = "\n".join(
+        f"{kind}: {s['pending']} in flight on {s['size']} workers, {s['queued']} queued"
+        for kind, s in ctx.bot.workers.stats().items()  # type: ignore
+    )
+    embed.add_field(name="Workers", value=f"```{workers}```", inline=False)
+    await ctx.send(embed=embed)
+
+
+@commands.is_owner()
+@commands.command(name="caches")
+async def manage_caches(
+    ctx: commands.Context,
+    action: str = "list",
+    name: str | None = None,
+    size: int | None = None,
+):
+    """!caches [list | resize <name> <entries> | clear <name|all>]"""
+    if action == "list":
+        lines = [
+            f"{c['name']}: {c['entries']}/{c['max_entries']} entries, "
+            f"~{c['bytes'] / 1024:.0f}KB, "
+            f"hits {'-' if c['hit_ratio'] is None else format(c['hit_ratio'], '.0%')}, "
+            f"{c['policy']}"
+            for c in ctx.bot.caches.stats()  # type: ignore
+        ]
+        description = "\n".join(lines) or "No caches"
+        embed = discord.Embed(
+            title="Caches", description=f"```{description}```", color=0xAC26EB
+        )
+        return await ctx.send(embed=embed)
+
+    if action == "clear" and name == "all":
+        for cache in ctx.bot.caches.caches.values():  # type: ignore
+            cache.clear()
+        return await ctx.send("Cleared every cache")
+
+    cache = ctx.bot.caches.get(name) if name else None  # type: ignore
+    if cache is None:
+        return await ctx.send(f"There is no cache called {name}")
+
+    if action == "clear":
+        cache.clear()
+        log.info("Cleared the %s cache", name)
+        await ctx.send(f"Cleared {name}")
+    elif action == "resize" and size is not None and size >= 0:
+        cache.resize(size)
+        log.info("Resized the %s cache to %d entries", name, size)
+        await ctx.send(f"{name} now keeps up to {size} entries")
+    else:
+        await ctx.send(
+            "Usage: caches [list | resize <name> <entries> | clear <name|all>]"
+        )
+
+
+def build_client() -> MyClient:
+    """The bot as configured by the environment, with the commands main.py defines"""
+    client = MyClient(**client_options(os.getenv("PROFILE", "default"), EXTENSIONS))
+    client.tree.add_command(ping)
+    for command in (load, unload, reload, show_metrics, manage_caches):
+        client.add_command(command)
+    return client
 
 
 if __name__ == "__main__":
     load_dotenv()
+    logListener = setup_logging(
+        os.getenv("LOG_LEVEL", "INFO"),
+        os.getenv("LOG_SAMPLING", "interactions.autocomplete=0.05"),
+    )
     token = os.getenv("TOKEN")
     if token is None:
-        print("No Token Found In The .env")
+        log.error("No Token Found In The .env")
+        logListener.stop()
         exit()
-    client.run(token)
+    traceListener = setup_tracing(
+        os.getenv("TRACE_FILE", "traces.jsonl"),
+        float(os.getenv("TRACE_SAMPLE_RATE", "0.1")),
+    )
+    loop = install_event_loop(os.getenv("EVENT_LOOP", "asyncio"))
+    log.info("Using the %s event loop", loop)
+    client = build_client()
+    try:
+        client.run(token, log_handler=None)
+    finally:
+        traceListener.stop()
+        logListener.stop()
@@ -0,0 +1,228 @@
+import asyncio
+import functools
+import heapq
+import threading
+import time
+from typing import Any, Awaitable, Callable, Hashable, Sequence
+
+import discord
+from discord import app_commands
+from fuzzywuzzy import fuzz
+
+from utils.caches import TTLCache
+from utils.errors import PoolSaturated
+from utils.metrics import metrics
+
+# Discord shows at most 25 choices
+MAX_CHOICES = 25
+
+# Candidate lists longer than this are ranked in the worker thread pool
+INLINE_CANDIDATES = 500
+
+# How many candidates get scored between checks of the deadline
+CHUNK = 200
+
+Candidate = str | tuple[str, Any]
+Source = Callable[..., Awaitable[Sequence[Candidate]]]
+
+
+def rank(
+    current: str,
+    names: Sequence[str],
+    scorer: Callable[[str, str], int],
+    limit: int,
+    deadline: float,
+    stop: threading.Event,
+) -> tuple[list[int], bool]:
+    """
+    Rank
+
+    Scores *names* against *current* in chunks, keeping the best *limit* of
+    them. Stops early once *deadline* (a time.monotonic() value) passes or
+    *stop* is set, returning the best found up to then.
+
+
+    Returns:
+        tuple: Indices of the best names, best first, and whether all were scored
+    """
+    best: list[tuple[int, int]] = []
+    complete = True
+    for start in range(0, len(names), CHUNK):
+        if start and (stop.is_set() or time.monotonic() > deadline):
+            complete = False
+            break
+        for index in range(start, min(start + CHUNK, len(names))):
+            # Ties go to the earlier name, like process.extract
+            entry = (scorer(current, names[index]), -index)
+            if len(best) < limit:
+                heapq.heappush(best, entry)
+            else:
+                heapq.heappushpop(best, entry)
+    return [-index for _, index in sorted(best, reverse=True)], complete
+
+
+class Call:
+    __slots__ = ("stop", "task")
+
+    def __init__(self) -> None:
+        self.stop = threading.Event()
+        self.task: asyncio.Future | None = None
+
+    def supersede(self) -> None:
+        self.stop.set()
+        if self.task is not None:
+            self.task.cancel()
+
+
+class Autocomplete:
+    """
+    Autocomplete
+
+    Turns a coroutine that returns the candidates for an option into its
+    autocomplete callback. Candidates are option names, or (name, value)
+    pairs, and get ranked against what the user typed with *scorer*.
+    Results are cached per query, a user's newer keystroke cancels their
+    older one still being worked on, and a call that runs out of *budget*
+    answers with the best matches found so far.
+
+
+    Args:
+        scorer (Callable): Scores (query, name) from 0 to 100, None when the
+            source already returns its candidates ranked for the query
+        limit (int): How many matches to suggest
+        browse (int): How many candidates to list while the option is empty,
+            defaults to *limit*
+        budget (float): Seconds a keystroke may take before answering
+        cacheSize (int): How many queries to keep results for, 0 turns caching off
+        ttl (float): Seconds cached results stay fresh
+        key (Callable): Takes (cog, interaction), scopes the cache when the
+            candidates depend on the interaction
+    """
+
+    def __init__(
+        self,
+        *,
+        scorer: Callable[[str, str], int] | None = fuzz.token_sort_ratio,
+        limit: int = 12,
+        browse: int | None = None,
+        budget: float = 1.0,
+        cacheSize: int = 1024,
+        ttl: float = 300.0,
+        key: Callable[[Any, discord.Interaction], Hashable] | None = None,
+    ) -> None:
+        self.scorer = scorer
+        self.limit = min(limit, MAX_CHOICES)
+        self.browse = min(browse or limit, MAX_CHOICES)
+        self.budget = budget
+        self.cacheSize = cacheSize
+        self.ttl = ttl
+        self.key = key
+        self.cache: TTLCache[list[app_commands.Choice]] | None = None
+        self.inflight: dict[int, Call] = {}
+
+    def forget(self, scope: Callable[[Hashable], bool]) -> None:
+        """Forgets the cached results for every key *scope* accepts, whatever the query"""
+        if self.cache is None:
+            return
+        stale = [key for key in self.cache.entries if scope(key[0])]  # type: ignore
+        for cacheKey in stale:
+            self.cache.pop(cacheKey)
+
+    def __call__(self, func: Source) -> Source:
+        name = func.__name__
+        if self.cacheSize:
+            self.cache = TTLCache(f"autocomplete.{name}", self.cacheSize, self.ttl)
+
+        @functools.wraps(func)
+        async def wrapper(
+            cog: Any, interaction: discord.Interaction, current: str
+        ) -> list[app_commands.Choice]:
+            cacheKey = (
+                self.key(cog, interaction) if self.key else None,
+                current.strip().lower(),
+            )
+            found, choices = (
+                self.cache.get(cacheKey) if self.cache is not None else (False, None)
+            )
+            if found:
+                metrics.incr(f"autocomplete.{name}.hits")
+                return choices
+            metrics.incr(f"autocomplete.{name}.misses")
+
+            userId = interaction.user.id
+            call = Call()
+            previous = self.inflight.get(userId)
+            if previous is not None:
+                previous.supersede()
+            self.inflight[userId] = call
+
+            try:
+                choices, complete = await self.complete(
+                    func, cog, interaction, current, call, name
+                )
+            finally:
+                if self.inflight.get(userId) is call:
+                    del self.inflight[userId]
+
+            # Partial or superseded results shouldn't answer the next identical query
+            if complete and choices and self.cache is not None:
+                self.cache.put(cacheKey, choices)
+            return choices
+
+        return wrapper
+
+    async def complete(
+        self,
+        func: Source,
+        cog: Any,
+        interaction: discord.Interaction,
+        current: str,
+        call: Call,
+        name: str,
+    ) -> tuple[list[app_commands.Choice], bool]:
+        deadline = time.monotonic() + self.budget
+
+        call.task = asyncio.ensure_future(func(cog, interaction, current))
+        try:
+            candidates = await asyncio.wait_for(call.task, self.budget)
+        except asyncio.CancelledError:
+            if not call.stop.is_set():
+                raise
+            metrics.incr(f"autocomplete.{name}.superseded")
+            return [], False
+        except asyncio.TimeoutError:
+            metrics.incr(f"autocomplete.{name}.timeouts")
+            return [], False
+
+        pairs = [
+            (candidate, candidate) if isinstance(candidate, str) else candidate
+            for candidate in candidates
+        ]
+        if self.scorer is None:
+            return self.choices(pairs[: self.limit]), True
+        if not current:
+            return self.choices(pairs[: self.browse]), True
+
+        names = [pair[0] for pair in pairs]
+        args = (current, names, self.scorer, self.limit, deadline, call.stop)
+        workers = getattr(interaction.client, "workers", None)
+        if workers is None or len(names) <= INLINE_CANDIDATES:
+            indices, complete = rank(*args)
+        else:
+            try:
+                # A little slack past the deadline for the partial result to come back
+                indices, complete = await workers.submit(
+                    rank, *args, timeout=max(0.0, deadline - time.monotonic()) + 0.2
+                )
+            except (PoolSaturated, asyncio.TimeoutError):
+                metrics.incr(f"autocomplete.{name}.timeouts")
+                return [], False
+        if not complete:
+            metrics.incr(f"autocomplete.{name}.partial")
+        return self.choices([pairs[index] for index in indices]), complete
+
+    @staticmethod
+    def choices(pairs: Sequence[tuple[str, Any]]) -> list[app_commands.Choice]:
+        return [
+            app_commands.Choice(name=name[:100], value=value) for name, value in pairs
+        ]
@@ -0,0 +1,289 @@
+import logging
+import os
+import random
+import sys
+import time
+from collections import OrderedDict
+from typing import Any, Generic, Hashable, TypeVar
+
+from utils.metrics import metrics
+
+log = logging.getLogger("caches")
+
+V = TypeVar("V")
+
+# How many entries get measured to estimate the size of a cache
+SIZE_SAMPLES = 20
+
+# cgroup v2 and v1 files holding the container's memory limit
+CGROUP_LIMITS = (
+    "/sys/fs/cgroup/memory.max",
+    "/sys/fs/cgroup/memory/memory.limit_in_bytes",
+)
+# cgroup v2 and v1 memory.stat files, and the line in each counting anonymous
+# memory. The totals also count the page cache, which evicting can't free
+CGROUP_STATS = (
+    ("/sys/fs/cgroup/memory.stat", "anon"),
+    ("/sys/fs/cgroup/memory/memory.stat", "total_rss"),
+)
+
+# Caches over the budget are shrunk to this fraction of it, and aren't shrunk
+# again until memory drops below it or EVICTION_COOLDOWN seconds go by. Freed
+# memory isn't always given back to the system straight away
+LOW_WATER = 0.9
+EVICTION_COOLDOWN = 300.0
+
+
+def deep_size(obj: Any, depth: int = 4, seen: set[int] | None = None) -> int:
+    """Roughly how many bytes *obj* and what it holds take, up to *depth* levels down"""
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj, 64)
+    if depth == 0 or isinstance(obj, (str, bytes, int, float, bool)):
+        return size
+    if isinstance(obj, dict):
+        children = [*obj.keys(), *obj.values()]
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        children = list(obj)
+    elif hasattr(obj, "__dict__"):
+        children = [vars(obj)]
+    else:
+        children = [
+            getattr(obj, slot, None) for slot in getattr(type(obj), "__slots__", ())
+        ]
+    return size + sum(deep_size(child, depth - 1, seen) for child in children)
+
+
+class TTLCache(Generic[V]):
+    """
+    TTL Cache
+
+    A least recently used cache whose entries also expire *ttl* seconds after
+    they were stored. It registers itself under *name* so the owner can see,
+    resize and clear it, and so it can be shrunk when memory runs low.
+
+
+    Args:
+        name (str): Unique name, a newer cache with the same name replaces this one
+        maxEntries (int): How many entries to keep at most
+        ttl (float): Seconds an entry stays fresh
+    """
+
+    policy = "LRU + TTL"
+
+    def __init__(self, name: str, maxEntries: int, ttl: float) -> None:
+        self.name = name
+        self.maxEntries = maxEntries
+        self.ttl = ttl
+        self.entries: OrderedDict[Hashable, tuple[float, V]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        caches.register(self)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, key: Hashable) -> tuple[bool, V | None]:
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] < time.monotonic():
+            del self.entries[key]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return False, None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return True, entry[1]
+
+    def put(self, key: Hashable, value: V) -> None:
+        if not self.maxEntries:
+            return
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        self.evict(len(self.entries) - self.maxEntries)
+
+    def pop(self, key: Hashable) -> None:
+        self.entries.pop(key, None)
+
+    def evict(self, count: int) -> int:
+        """Drops the *count* least recently used entries"""
+        count = min(max(count, 0), len(self.entries))
+        for _ in range(count):
+            self.entries.popitem(last=False)
+        return count
+
+    def resize(self, maxEntries: int) -> None:
+        self.maxEntries = maxEntries
+        self.evict(len(self.entries) - maxEntries)
+
+    def clear(self) -> None:
+        self.entries.clear()
+
+    def hit_ratio(self) -> float | None:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else None
+
+    def approximate_bytes(self) -> int:
+        """Size of a sample of entries scaled up to all of them"""
+        if not self.entries:
+            return 0
+        keys = list(self.entries)
+        sample = random.sample(keys, min(SIZE_SAMPLES, len(keys)))
+        sampled = sum(deep_size((key, self.entries[key])) for key in sample)
+        return sys.getsizeof(self.entries) + sampled * len(keys) // len(sample)
+
+
+class CacheRegistry:
+    """Every TTLCache in the process by name"""
+
+    def __init__(self) -> None:
+        self.caches: dict[str, TTLCache] = {}
+
+    def register(self, cache: TTLCache) -> None:
+        # A reloaded extension creates its caches again, the new ones take over
+        self.caches[cache.name] = cache
+
+    def get(self, name: str) -> TTLCache | None:
+        return self.caches.get(name)
+
+    def stats(self) -> list[dict[str, Any]]:
+        return [
+            {
+                "name": cache.name,
+                "entries": len(cache),
+                "max_entries": cache.maxEntries,
+                "bytes": cache.approximate_bytes(),
+                "hit_ratio": cache.hit_ratio(),
+                "policy": cache.policy,
+            }
+            for cache in self.caches.values()
+        ]
+
+    def relieve(self, excess: int) -> int:
+        """
+        Relieve
+
+        Evicts least recently used entries, from the biggest caches first, until
+        the estimated memory freed covers *excess* bytes.
+
+
+        Args:
+            excess (int): Bytes over the memory budget
+
+        Returns:
+            int: The estimated number of bytes freed
+        """
+        freed = 0
+        sizes = [(cache.approximate_bytes(), cache) for cache in self.caches.values()]
+        for size, cache in sorted(sizes, key=lambda item: -item[0]):
+            if freed >= excess or not len(cache):
+                break
+            perEntry = size / len(cache)
+            count = min(len(cache), int((excess - freed) / perEntry) + 1)
+            cache.evict(count)
+            freed += int(count * perEntry)
+            metrics.incr(f"caches.{cache.name}.pressure_evictions", count)
+        return freed
+
+
+caches = CacheRegistry()
+
+
+def read_bytes(paths: tuple[str, ...]) -> int | None:
+    for path in paths:
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+        except OSError:
+            continue
+        # cgroup v2 says "max" and v1 a huge number when there is no limit
+        if value.isdigit() and int(value) < 2**60:
+            return int(value)
+        return None
+    return None
+
+
+def read_stat(path: str, name: str) -> int | None:
+    try:
+        with open(path) as f:
+            for line in f:
+                key, _, value = line.partition(" ")
+                if key == name:
+                    return int(value)
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def memory_usage() -> int | None:
+    """Anonymous bytes the container uses, or this process when that isn't known"""
+    for path, name in CGROUP_STATS:
+        usage = read_stat(path, name)
+        if usage is not None:
+            return usage
+    try:
+        # Resident pages less the ones backed by files
+        with open("/proc/self/statm") as f:
+            resident, shared = f.read().split()[1:3]
+        return (int(resident) - int(shared)) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def memory_budget() -> int | None:
+    """
+    Memory Budget
+
+    The bytes the caches may let the process grow to before they get shrunk.
+    MEMORY_BUDGET_MB sets it, otherwise it is 85% of the container's limit.
+
+
+    Returns:
+        int: The budget, or None when there is nothing to go by
+    """
+    budget = os.getenv("MEMORY_BUDGET_MB")
+    if budget:
+        return int(float(budget) * 1024 * 1024)
+    limit = read_bytes(CGROUP_LIMITS)
+    return None if limit is None else int(limit * 0.85)
+
+
+class MemoryBudget:
+    """
+    Memory Budget
+
+    Shrinks the caches when memory goes over *budget*, down to LOW_WATER of
+    it, then leaves them be until memory drops below that or the cooldown
+    is over.
+
+
+    Args:
+        budget (int): Bytes memory may grow to
+    """
+
+    def __init__(self, budget: int) -> None:
+        self.budget = budget
+        self.lowWater = int(budget * LOW_WATER)
+        self.evictedAt: float | None = None
+
+    async def enforce(self) -> None:
+        usage = memory_usage()
+        if usage is None:
+            return
+        if self.evictedAt is not None:
+            if usage <= self.lowWater:
+                self.evictedAt = None
+            elif time.monotonic() - self.evictedAt < EVICTION_COOLDOWN:
+                return
+        if usage <= self.budget:
+            return
+        freed = caches.relieve(usage - self.lowWater)
+        self.evictedAt = time.monotonic()
+        log.warning(
+            "Memory at %.0fMB is over the %.0fMB budget, evicted about %.0fMB from the caches",
+            usage / 1024 / 1024,
+            self.budget / 1024 / 1024,
+            freed / 1024 / 1024,
+        )
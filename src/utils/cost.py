@@ -0,0 +1,218 @@
+import math
+import os
+from typing import Any, NamedTuple
+
+import d20
+
+from utils.caches import TTLCache
+from utils.errors import BadRoll
+from utils.roll import compile_expression, expression_key
+
+# Most dice a roll can be expected to throw, rerolls and explosions included
+MAX_DRAWS = int(os.getenv("ROLL_MAX_DRAWS", "20000"))
+
+# Rolls that could throw more dice than this are made in the process pool, about
+# what d20 throws in a few milliseconds
+INLINE_DRAWS = int(os.getenv("ROLL_INLINE_DRAWS", "1000"))
+
+# Characters d20 writes for a die on top of its face: the comma after it, and the
+# strikes and bold around rerolled and critical ones
+DIE_OUTPUT = 4
+
+
+class Cost(NamedTuple):
+    # Dice a roll is expected to throw, and the most it can throw, inf when a
+    # reroll or explosion can keep going
+    draws: float
+    worst: float
+    # Characters d20 is expected to write for the result
+    output: float
+    # Why the roll can never finish, None when it can
+    endless: str | None
+
+    @property
+    def inline(self) -> bool:
+        """Whether the roll is cheap enough to make on the event loop"""
+        return self.worst <= INLINE_DRAWS
+
+
+# Estimates only depend on the expression, kept by its key rather than its tree
+# so they don't hold on to trees the expression cache has let go of
+costs: TTLCache[Cost] = TTLCache("cost.estimates", 4096, ttl=24 * 60 * 60)
+
+
+def within(faces: range, low: float, high: float) -> int:
+    """How many of *faces* are between *low* and *high*"""
+    if not faces:
+        return 0
+    if faces.step != 1:
+        return sum(low <= face <= high for face in faces)
+    return max(0, int(min(high, faces[-1]) - max(low, faces[0])) + 1)
+
+
+def matching(selectors: list[Any], size: int | str) -> float | None:
+    """
+    Matching
+
+    The fraction of a die's faces that any of *selectors* picks.
+
+
+    Args:
+        selectors (list): The selectors of a d20 set operator
+        size (int | str): Sides of the die, "%" for percentile dice
+
+    Returns:
+        float: The fraction, None when a selector picks the highest or lowest
+            dice rather than faces
+    """
+    faces = range(0, 100, 10) if size == "%" else range(1, int(size) + 1)
+    spans = []
+    for selector in selectors:
+        match selector.cat:
+            case None:
+                spans.append((selector.num, selector.num))
+            case "<":
+                spans.append((-math.inf, selector.num - 1))
+            case ">":
+                spans.append((selector.num + 1, math.inf))
+            case _:
+                return None
+    # Selectors can overlap, every face is only counted once
+    matched, reached = 0, -math.inf
+    for low, high in sorted(spans):
+        matched += within(faces, max(low, reached + 1), high)
+        reached = max(reached, high)
+    return matched / len(faces) if faces else 0.0
+
+
+def pool_cost(dice: d20.ast.Dice, operations: list[Any]) -> Cost:
+    """What rolling one set of dice costs, its operations applied in order"""
+    expected = worstDice = float(dice.num)
+    draws = worst = float(dice.num)
+    for operation in operations:
+        op = operation.op
+        if op not in ("rr", "ro", "ra", "e"):
+            continue
+        fraction = matching(operation.sels, dice.size)
+        if fraction is None:
+            if op in ("rr", "e"):
+                return Cost(
+                    draws, math.inf, 0, f"`{operation}` always has a die to pick"
+                )
+            if op == "ro":
+                draws += min(sum(selector.num for selector in operation.sels), expected)
+                worst += worstDice
+            else:
+                # ra only ever adds one die
+                draws, worst = draws + 1, worst + 1
+                expected, worstDice = expected + 1, worstDice + 1
+            continue
+        match op:
+            case "ro":
+                draws += expected * fraction
+                worst += worstDice if fraction else 0
+            case "ra":
+                extra = 1 - (1 - fraction) ** expected
+                draws += extra
+                expected += extra
+                worst += 1 if fraction else 0
+                worstDice += 1 if fraction else 0
+            case "rr" | "e":
+                if fraction >= 1:
+                    word = "rerolls" if op == "rr" else "explodes on"
+                    reason = f"`{operation}` {word} every face of a d{dice.size}"
+                    return Cost(draws, math.inf, 0, reason)
+                if fraction:
+                    # Every die keeps being thrown until it misses, 1 / (1 - p) times
+                    extra = expected * fraction / (1 - fraction)
+                    draws += extra
+                    worst = math.inf
+                    if op == "e":
+                        expected += extra
+                        worstDice = math.inf
+    sides = 2 if dice.size == "%" else len(str(dice.size))
+    return Cost(draws, worst, draws * (sides + DIE_OUTPUT), None)
+
+
+def estimate(tree: d20.ast.Expression) -> Cost:
+    """
+    Estimate
+
+    What rolling an expression costs, worked out from its syntax tree alone
+    without throwing a die: how many dice it is expected to throw, the most
+    it can throw, and how long the result d20 writes for it will be.
+
+
+    Args:
+        tree (d20.ast.Expression): The parsed expression
+
+    Returns:
+        Cost: The estimate
+    """
+    draws = worst = 0.0
+    output = float(len(str(tree)))
+    endless = None
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        match node:
+            case d20.ast.OperatedDice():
+                cost = pool_cost(node.value, node.operations)
+            case d20.ast.Dice():
+                cost = pool_cost(node, [])
+            case _:
+                stack.extend(node.children)
+                continue
+        draws += cost.draws
+        worst += cost.worst
+        output += cost.output
+        endless = endless or cost.endless
+    return Cost(draws, worst, output, endless)
+
+
+def expression_cost(expression: str) -> Cost:
+    """The estimate for an expression, worked out once and kept for a day"""
+    key = expression_key(expression)
+    found, cost = costs.get(key)
+    if not found:
+        cost = estimate(compile_expression(expression))
+        costs.put(key, cost)
+    return cost  # type: ignore
+
+
+def check(expression: str, times: int = 1) -> Cost:
+    """
+    Check
+
+    Estimates what rolling an expression costs before it is rolled, and
+    refuses rolls that can never finish or would throw too many dice.
+
+
+    Args:
+        expression (str): The dice expression
+        times (int): How many times it is going to be rolled
+
+    Returns:
+        Cost: The estimate of rolling it *times* times, its inline property
+            says whether to make the rolls on the event loop
+
+    Raises:
+        d20.RollError: When the expression doesn't parse
+        BadRoll: When the roll is refused, saying why
+    """
+    cost = expression_cost(expression)
+    if cost.endless is not None:
+        raise BadRoll(
+            f"`{expression}` never finishes: {cost.endless}",
+            {"expression": expression},
+        )
+    cost = cost._replace(
+        draws=cost.draws * times, worst=cost.worst * times, output=cost.output * times
+    )
+    if cost.draws > MAX_DRAWS:
+        raise BadRoll(
+            f"`{expression}` would throw about {cost.draws:,.0f} dice, "
+            f"a roll can throw at most {MAX_DRAWS:,}",
+            {"expression": expression},
+        )
+    return cost
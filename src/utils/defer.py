@@ -0,0 +1,100 @@
+import asyncio
+import functools
+from typing import Any, Awaitable, Callable, TypeVar
+
+import discord
+from discord.interactions import InteractionResponse
+
+from utils.metrics import metrics
+
+T = TypeVar("T")
+
+# Discord fails an interaction that isn't answered within 3 seconds
+RESPONSE_WINDOW = 3.0
+
+
+class DeferringResponse(InteractionResponse):
+    """
+    Deferring Response
+
+    An InteractionResponse that can defer itself once the handler runs out of
+    time. After that send_message goes to a followup, which takes the place of
+    the "thinking" message, so handlers don't need to know it happened. A
+    message that isn't as ephemeral as the "thinking" one replaces it as a
+    new followup instead.
+    """
+
+    def __init__(self, parent: discord.Interaction, ephemeral: bool) -> None:
+        super().__init__(parent)
+        self.ephemeral = ephemeral
+        self.autoDeferred = False
+        self.lock = asyncio.Lock()
+
+    async def defer_after(self, budget: float, command: str) -> None:
+        await asyncio.sleep(budget)
+        async with self.lock:
+            if self.is_done():
+                return
+            await super().defer(ephemeral=self.ephemeral, thinking=True)
+            self.autoDeferred = True
+            metrics.incr(f"autodefer.{command}.deferred")
+
+    async def defer(self, **kwargs: Any) -> None:
+        async with self.lock:
+            if not self.autoDeferred:
+                await super().defer(**kwargs)
+
+    async def send_message(self, content: Any = None, **kwargs: Any) -> None:
+        async with self.lock:
+            if not self.autoDeferred:
+                return await super().send_message(content, **kwargs)
+        kwargs.pop("delete_after", None)
+        if kwargs.get("ephemeral", False) != self.ephemeral:
+            # The first followup would take the place of the "thinking" message and
+            # keep its visibility, an ephemeral error would show up in the channel
+            await self._parent.delete_original_response()
+        await self._parent.followup.send(content, **kwargs)
+
+
+def auto_defer(
+    budget: float = 2.5, ephemeral: bool = False
+) -> Callable[[Callable[..., Awaitable[T]]], Callable[..., Awaitable[T]]]:
+    """
+    Auto Defer
+
+    Defers the command's interaction if it hasn't responded within *budget*
+    seconds, so slow Lavalink or disk calls don't fail the interaction.
+
+
+    Args:
+        budget (float): Seconds the command gets to respond on its own
+        ephemeral (bool): Whether the deferred "thinking" message is ephemeral
+    """
+    if budget >= RESPONSE_WINDOW:
+        raise ValueError(f"The budget has to be under {RESPONSE_WINDOW} seconds")
+
+    def decorator(func: Callable[..., Awaitable[T]]) -> Callable[..., Awaitable[T]]:
+        @functools.wraps(func)
+        async def wrapper(
+            cog: Any, interaction: discord.Interaction, *args: Any, **kwargs: Any
+        ) -> T:
+            command = (
+                interaction.command.qualified_name
+                if interaction.command
+                else func.__name__
+            )
+            response = DeferringResponse(interaction, ephemeral)
+            interaction._cs_response = response  # type: ignore
+            metrics.incr(f"autodefer.{command}.invoked")
+
+            timer = asyncio.create_task(response.defer_after(budget, command))
+            try:
+                return await func(cog, interaction, *args, **kwargs)
+            finally:
+                # Let a defer that's already being sent finish instead of cutting it off
+                if not response.lock.locked():
+                    timer.cancel()
+
+        return wrapper
+
+    return decorator
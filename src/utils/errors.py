@@ -3,3 +3,15 @@ class BadRoll(Exception):
         self.message = message
         self.offendingAtribute = offendingAtribute
         super().__init__(message)
+
+
+class PoolSaturated(Exception):
+    def __init__(self, kind: str):
+        self.kind = kind
+        super().__init__(f"The {kind} pool is saturated")
+
+
+class OddsUnsupported(Exception):
+    def __init__(self, reason: str):
+        self.reason = reason
+        super().__init__(reason)
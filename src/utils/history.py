@@ -0,0 +1,323 @@
+import logging
+import os
+from collections import OrderedDict
+from typing import Any, Hashable
+
+import d20
+import numpy as np
+
+from utils.caches import caches
+from utils.metrics import metrics
+from utils.roll import expression_key
+
+log = logging.getLogger("history")
+
+# Rolls and natural die faces kept per user and channel
+ROLLS = 128
+FACES = 512
+
+# Expressions given an id, later ones are recorded without one
+MAX_EXPRESSIONS = 10_000
+UNKNOWN = -1
+
+INT32 = np.iinfo(np.int32)
+
+
+def natural_faces(result: d20.RollResult) -> tuple[list[int], list[int]]:
+    """The sides and face of every die a roll threw, rerolled ones included, before min/max"""
+    sides: list[int] = []
+    faces: list[int] = []
+    stack = [result.expr]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, d20.Dice) and isinstance(node.size, int):
+            for die in node.values:
+                for literal in die.values:
+                    sides.append(node.size)
+                    faces.append(literal.values[0])
+        stack.extend(node.children)
+    return sides, faces
+
+
+def ordered(array: np.ndarray, written: int) -> np.ndarray:
+    """The contents of a ring buffer that had *written* items put in it, oldest first"""
+    if written <= len(array):
+        return array[:written]
+    start = written % len(array)
+    return np.concatenate([array[start:], array[:start]])
+
+
+class RollBuffer:
+    """
+    Roll Buffer
+
+    The latest rolls of one user in one channel, held in fixed size arrays
+    that are written round and round so memory never grows: the expression
+    id and total of the last ROLLS rolls, and the sides and natural face of
+    the last FACES dice.
+    """
+
+    __slots__ = ("expressionIds", "totals", "rolls", "sides", "faces", "thrown")
+
+    def __init__(self) -> None:
+        self.expressionIds = np.full(ROLLS, UNKNOWN, dtype=np.int32)
+        self.totals = np.zeros(ROLLS, dtype=np.int32)
+        self.rolls = 0
+        self.sides = np.zeros(FACES, dtype=np.int16)
+        self.faces = np.zeros(FACES, dtype=np.int16)
+        self.thrown = 0
+
+    def append(
+        self,
+        expressionId: int,
+        total: int,
+        sides: list[int] | np.ndarray,
+        faces: list[int] | np.ndarray,
+    ) -> None:
+        index = self.rolls % ROLLS
+        self.expressionIds[index] = expressionId
+        self.totals[index] = min(max(total, INT32.min), INT32.max)
+        self.rolls += 1
+
+        sideArray = np.asarray(sides[-FACES:], dtype=np.int64)
+        faceArray = np.asarray(faces[-FACES:], dtype=np.int64)
+        # Dice too big for 16 bits are left out, nothing rolls them in practice
+        fits = (sideArray <= np.iinfo(np.int16).max) & (faceArray >= 0)
+        sideArray, faceArray = sideArray[fits], faceArray[fits]
+        positions = (self.thrown + np.arange(len(sideArray))) % FACES
+        self.sides[positions] = sideArray
+        self.faces[positions] = faceArray
+        self.thrown += len(sideArray)
+
+    def recent(self) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Expression ids, totals, sides and faces, oldest first"""
+        return (
+            ordered(self.expressionIds, self.rolls),
+            ordered(self.totals, self.rolls),
+            ordered(self.sides, self.thrown),
+            ordered(self.faces, self.thrown),
+        )
+
+    @property
+    def nbytes(self) -> int:
+        return (
+            self.expressionIds.nbytes
+            + self.totals.nbytes
+            + self.sides.nbytes
+            + self.faces.nbytes
+        )
+
+
+class RollHistory:
+    """
+    Roll History
+
+    A RollBuffer per user and channel, the least recently used ones let go
+    once there are more than *maxEntries*. It registers with the caches so
+    the owner can see and resize it and it gets shrunk when memory runs low.
+
+
+    Args:
+        name (str): Name it is registered under
+        maxEntries (int): How many users and channels to keep rolls for
+    """
+
+    policy = "LRU"
+
+    def __init__(self, name: str, maxEntries: int) -> None:
+        self.name = name
+        self.maxEntries = maxEntries
+        self.entries: OrderedDict[tuple[int, int], RollBuffer] = OrderedDict()
+        self.expressionIds: dict[str, int] = {}
+        self.expressions: list[str] = []
+        # Bumped on every change so snapshots can be skipped when nothing happened
+        self.version = 0
+        caches.register(self)  # type: ignore
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def expression_id(self, expression: str) -> int:
+        key = expression_key(expression)
+        expressionId = self.expressionIds.get(key)
+        if expressionId is None:
+            if len(self.expressions) >= MAX_EXPRESSIONS:
+                return UNKNOWN
+            expressionId = len(self.expressions)
+            self.expressionIds[key] = expressionId
+            self.expressions.append(key)
+        return expressionId
+
+    def expression(self, expressionId: int) -> str | None:
+        if 0 <= expressionId < len(self.expressions):
+            return self.expressions[expressionId]
+        return None
+
+    def record(
+        self,
+        userId: int,
+        channelId: int | None,
+        expression: str,
+        result: d20.RollResult,
+    ) -> None:
+        """Adds a roll to the history of *userId* in *channelId*"""
+        self.record_faces(
+            userId, channelId, expression, result.total, *natural_faces(result)
+        )
+
+    def record_faces(
+        self,
+        userId: int,
+        channelId: int | None,
+        expression: str,
+        total: int,
+        sides: list[int] | np.ndarray,
+        faces: list[int] | np.ndarray,
+    ) -> None:
+        """Adds a roll that wasn't made by d20, from its total and the natural faces it threw"""
+        key = (userId, channelId or 0)
+        buffer = self.entries.get(key)
+        if buffer is None:
+            buffer = self.entries[key] = RollBuffer()
+            self.evict(len(self.entries) - self.maxEntries)
+        self.entries.move_to_end(key)
+        buffer.append(self.expression_id(expression), total, sides, faces)
+        self.version += 1
+        metrics.incr("history.recorded")
+
+    def get(self, userId: int, channelId: int | None) -> RollBuffer | None:
+        return self.entries.get((userId, channelId or 0))
+
+    def evict(self, count: int) -> int:
+        """Lets go of the *count* least recently used buffers"""
+        count = min(max(count, 0), len(self.entries))
+        for _ in range(count):
+            self.entries.popitem(last=False)
+        if count:
+            self.version += 1
+        return count
+
+    def resize(self, maxEntries: int) -> None:
+        self.maxEntries = maxEntries
+        self.evict(len(self.entries) - maxEntries)
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.version += 1
+
+    def hit_ratio(self) -> float | None:
+        return None
+
+    def approximate_bytes(self) -> int:
+        return sum(buffer.nbytes for buffer in self.entries.values())
+
+    def snapshot(self) -> dict[str, np.ndarray]:
+        """Every buffer stacked into arrays, least recently used first"""
+        buffers = list(self.entries.values())
+        return {
+            "keys": np.array(list(self.entries), dtype=np.int64).reshape(-1, 2),
+            "rolls": np.array([b.rolls for b in buffers], dtype=np.int64),
+            "thrown": np.array([b.thrown for b in buffers], dtype=np.int64),
+            "expressionIds": np.array(
+                [b.expressionIds for b in buffers], dtype=np.int32
+            ).reshape(-1, ROLLS),
+            "totals": np.array([b.totals for b in buffers], dtype=np.int32).reshape(
+                -1, ROLLS
+            ),
+            "sides": np.array([b.sides for b in buffers], dtype=np.int16).reshape(
+                -1, FACES
+            ),
+            "faces": np.array([b.faces for b in buffers], dtype=np.int16).reshape(
+                -1, FACES
+            ),
+            "expressions": np.array(self.expressions, dtype=str),
+        }
+
+    def restore(self, snapshot: Any) -> None:
+        """Takes the buffers back from a snapshot, keeping any rolled since"""
+        if snapshot["totals"].shape[1:] != (ROLLS,) or snapshot["faces"].shape[1:] != (
+            FACES,
+        ):
+            log.warning("The roll history snapshot has a different layout, skipped it")
+            return
+        ids = [self.expression_id(str(e)) for e in snapshot["expressions"]]
+        remap = np.array(ids + [UNKNOWN], dtype=np.int32)
+        restored: OrderedDict[tuple[int, int], RollBuffer] = OrderedDict()
+        for index, (userId, channelId) in enumerate(snapshot["keys"].tolist()):
+            buffer = RollBuffer()
+            # UNKNOWN (-1) picks the last element of the remap, which stays unknown
+            buffer.expressionIds[:] = remap[snapshot["expressionIds"][index]]
+            buffer.totals[:] = snapshot["totals"][index]
+            buffer.sides[:] = snapshot["sides"][index]
+            buffer.faces[:] = snapshot["faces"][index]
+            buffer.rolls = int(snapshot["rolls"][index])
+            buffer.thrown = int(snapshot["thrown"][index])
+            restored[(userId, channelId)] = buffer
+        restored.update(self.entries)
+        self.entries = restored
+        self.evict(len(self.entries) - self.maxEntries)
+
+
+def save_snapshot(path: str, snapshot: dict[str, np.ndarray]) -> None:
+    # Written next to the old one and swapped in so a crash never leaves half a file
+    temporary = f"{path}.tmp"
+    with open(temporary, "wb") as f:
+        np.savez_compressed(f, **snapshot)
+    os.replace(temporary, path)
+
+
+def load_snapshot(path: str) -> dict[str, np.ndarray] | None:
+    try:
+        with np.load(path) as snapshot:
+            return {key: snapshot[key] for key in snapshot.files}
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError):
+        log.exception("Couldn't read the roll history snapshot %s", path)
+        return None
+
+
+def longest_run(flags: np.ndarray) -> int:
+    """Length of the longest run of True in *flags*"""
+    if not flags.any():
+        return 0
+    edges = np.diff(np.concatenate(([0], flags.astype(np.int8), [0])))
+    starts, ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+    return int((ends - starts).max())
+
+
+def current_run(flags: np.ndarray) -> int:
+    """Length of the run of True *flags* ends with"""
+    misses = np.flatnonzero(~flags)
+    return len(flags) if not len(misses) else len(flags) - 1 - int(misses[-1])
+
+
+def chi_square_limit(degrees: int) -> float:
+    """The chi-square value a fair die stays under 95% of the time, by Wilson-Hilferty"""
+    term = 2 / (9 * degrees)
+    return degrees * (1 - term + 1.645 * term**0.5) ** 3
+
+
+def face_stats(sides: np.ndarray, faces: np.ndarray, size: int) -> dict[Hashable, Any]:
+    """How the natural faces of one size of die compare with a fair die"""
+    thrown = faces[sides == size]
+    counts = np.bincount(thrown - 1, minlength=size)[:size]
+    expected = len(thrown) / size
+    stats: dict[Hashable, Any] = {
+        "size": size,
+        "thrown": len(thrown),
+        "mean": float(thrown.mean()),
+        "expected_mean": (size + 1) / 2,
+        "highest": int(counts[-1]),
+        "lowest": int(counts[0]),
+        "expected_each": expected,
+        "chi_square": None,
+    }
+    # The test means little until every face is expected at least 5 times
+    if size > 1 and expected >= 5:
+        stats["chi_square"] = float(((counts - expected) ** 2 / expected).sum())
+        stats["chi_square_limit"] = chi_square_limit(size - 1)
+    return stats
+
+
+history = RollHistory("rolls.history", int(os.getenv("ROLL_HISTORY_USERS", "2000")))
@@ -0,0 +1,125 @@
+import copy
+import json
+import logging
+import random
+import sys
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+
+import discord
+
+# What the current task is handling, attached to every record it logs
+logContext: ContextVar[dict[str, int | str | None]] = ContextVar(
+    "logContext", default={}
+)
+
+
+def bind_interaction(interaction: discord.Interaction) -> None:
+    """Tags everything logged from now on in this task with *interaction*"""
+    command = interaction.command
+    logContext.set(
+        {
+            "guild": interaction.guild_id,
+            "command": command.qualified_name if command else None,
+            "interaction": interaction.id,
+        }
+    )
+
+
+class ContextQueueHandler(QueueHandler):
+    """
+    Context Queue Handler
+
+    Queues records for the writer thread, attaching the interaction context
+    first since the writer thread can't see the logging task's context.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        record.context = logContext.get()
+        return record
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Sampling Filter
+
+    Keeps only a fraction of the records below WARNING from the loggers in
+    *rates*, a logger also matches the rates of its parents.
+    """
+
+    def __init__(self, rates: dict[str, float]) -> None:
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or not self.rates:
+            return True
+        name = record.name
+        while name:
+            rate = self.rates.get(name)
+            if rate is not None:
+                return random.random() < rate
+            name = name.rpartition(".")[0]
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        line = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            **getattr(record, "context", {}),
+        }
+        if record.exc_info:
+            line["exception"] = self.formatException(record.exc_info)
+        return json.dumps(line, default=str)
+
+
+def parse_sampling(sampling: str) -> dict[str, float]:
+    """Parses "logger=rate,logger=rate" into a dict"""
+    rates: dict[str, float] = {}
+    for pair in filter(None, sampling.split(",")):
+        name, _, rate = pair.partition("=")
+        rates[name.strip()] = float(rate)
+    return rates
+
+
+def setup_logging(level: str = "INFO", sampling: str = "") -> QueueListener:
+    """
+    Setup Logging
+
+    Routes all logging through a queue to a background thread that writes JSON
+    lines to stdout, so a slow log pipe never blocks the event loop.
+
+
+    Args:
+        level (str): The lowest level to log
+        sampling (str): Sampling rates as "logger=rate,logger=rate"
+
+    Returns:
+        QueueListener: The running writer, stop it to flush the queue on exit
+    """
+    queue: SimpleQueue[logging.LogRecord] = SimpleQueue()
+
+    queueHandler = ContextQueueHandler(queue)
+    queueHandler.addFilter(SamplingFilter(parse_sampling(sampling)))
+
+    streamHandler = logging.StreamHandler(sys.stdout)
+    streamHandler.setFormatter(JsonFormatter())
+
+    root = logging.getLogger()
+    root.handlers.clear()
+    root.addHandler(queueHandler)
+    root.setLevel(level.upper())
+
+    listener = QueueListener(queue, streamHandler, respect_handler_level=True)
+    listener.start()
+    return listener
@@ -0,0 +1,62 @@
+import asyncio
+import logging
+from typing import Callable
+
+LOOPS = ("asyncio", "uvloop")
+
+log = logging.getLogger(__name__)
+
+
+def loop_factory(name: str) -> tuple[str, Callable[[], asyncio.AbstractEventLoop]]:
+    """
+    Loop Factory
+
+    Finds the event loop implementation for *name*, falling back to the
+    default asyncio loop when uvloop is requested but not installed.
+
+
+    Args:
+        name (str): Either "asyncio" or "uvloop"
+
+    Returns:
+        tuple: The name of the loop actually used and a function creating it
+    """
+    if name.lower() == "uvloop":
+        try:
+            import uvloop
+        except ImportError:
+            log.warning("uvloop is not installed, falling back to asyncio")
+        else:
+            return "uvloop", uvloop.new_event_loop
+
+    return "asyncio", asyncio.new_event_loop
+
+
+def install_event_loop(name: str) -> str:
+    """
+    Install Event Loop
+
+    Sets the event loop policy so the next asyncio.run (and so client.run)
+    uses the requested loop.
+
+
+    Args:
+        name (str): Either "asyncio" or "uvloop"
+
+    Returns:
+        str: The name of the loop that was installed
+    """
+    name, _ = loop_factory(name)
+    if name == "uvloop":
+        import uvloop
+
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    else:
+        asyncio.set_event_loop_policy(None)
+    return name
+
+
+def running_loop_name() -> str:
+    """Returns the name of the implementation of the running event loop"""
+    loop = asyncio.get_running_loop()
+    return type(loop).__module__.split(".")[0]
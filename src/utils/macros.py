@@ -0,0 +1,258 @@
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, NamedTuple
+
+import d20
+
+from utils.caches import TTLCache
+from utils.cost import check
+from utils.errors import BadRoll, PoolSaturated
+from utils.metrics import metrics
+from utils.pools import is_large, roll_pool
+from utils.roll import compile_expression, roll_expression
+
+# Macros are saved for a user, or for a whole guild
+USER = "user"
+GUILD = "guild"
+
+# Discord shows at most 25 autocomplete choices, so that is how many each owner gets
+MAX_MACROS = 25
+MAX_NAME_LENGTH = 32
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS macros (
+    scope TEXT NOT NULL,
+    owner INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    expression TEXT NOT NULL,
+    author INTEGER NOT NULL,
+    PRIMARY KEY (scope, owner, name)
+);
+CREATE TABLE IF NOT EXISTS builder_states (
+    key TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    saved REAL NOT NULL
+);
+"""
+
+# Roll builder states too long for a custom_id are kept this many seconds
+STATE_TTL = 7 * 24 * 60 * 60
+
+
+class Macro(NamedTuple):
+    name: str
+    expression: str
+    author: int
+    tree: d20.ast.Expression
+
+
+def normalise_name(name: str) -> str:
+    return " ".join(name.lower().split())
+
+
+async def validate(expression: str, workers: Any) -> str:
+    """
+    Validate
+
+    Checks that an expression parses, that its estimated cost is within the
+    limits, and that it can be rolled in time, by rolling it once, in the
+    process pool unless it is cheap and in bulk when it throws a large pool
+    of dice.
+
+
+    Args:
+        expression (str): The dice expression
+        workers (WorkerPool): The client's worker pools
+
+    Returns:
+        str: The expression as d20 writes it, which is what gets saved
+
+    Raises:
+        BadRoll: When the expression can't be rolled, saying why
+    """
+    try:
+        tree = compile_expression(expression)
+        rollable = roll_pool if is_large(str(tree)) else roll_expression
+        if check(str(tree)).inline:
+            rollable(str(tree))
+        else:
+            await workers.submit(rollable, str(tree), kind="process", timeout=2.0)
+    except d20.RollError as error:
+        raise BadRoll(
+            f"`{expression}` isn't a valid roll: {error}", {"expression": expression}
+        )
+    except (PoolSaturated, asyncio.TimeoutError):
+        raise BadRoll(
+            f"`{expression}` takes too long to roll", {"expression": expression}
+        )
+    return str(tree)
+
+
+class MacroStore:
+    """
+    Macro Store
+
+    Named dice expressions kept in an SQLite file, each belonging to a user or
+    to a guild. Only validated expressions are saved, as d20 writes them, and
+    the macros run most are kept in memory already parsed so running one goes
+    straight to rolling. Queries run in a thread, the connection is opened on
+    first use and again on the next query after close(). Roll builder states
+    too long for a custom_id are kept in the same file, so the store belongs
+    to the client and is only closed when it shuts down.
+
+
+    Args:
+        path (str): The SQLite file
+        maxCached (int): How many parsed macros to keep in memory
+    """
+
+    def __init__(self, path: str, maxCached: int) -> None:
+        self.path = path
+        self.connection: sqlite3.Connection | None = None
+        self.lock = threading.Lock()
+        # Misses are cached too, as None, so a typo doesn't hit the file every time
+        self.cache: TTLCache[Macro | None] = TTLCache(
+            "rolls.macros", maxCached, ttl=60 * 60
+        )
+
+    def execute(self, query: str, *parameters: Any) -> list[tuple]:
+        with self.lock:
+            if self.connection is None:
+                self.connection = sqlite3.connect(self.path, check_same_thread=False)
+                self.connection.executescript(SCHEMA)
+            with self.connection:
+                return self.connection.execute(query, parameters).fetchall()
+
+    def close(self) -> None:
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+    async def get(self, scope: str, owner: int, name: str) -> Macro | None:
+        key = (scope, owner, normalise_name(name))
+        found, macro = self.cache.get(key)
+        if found:
+            metrics.incr("macros.cached")
+            return macro
+        rows = await asyncio.to_thread(
+            self.execute,
+            "SELECT name, expression, author FROM macros "
+            "WHERE scope = ? AND owner = ? AND name = ?",
+            *key,
+        )
+        macro = None
+        if rows:
+            name, expression, author = rows[0]
+            macro = Macro(name, expression, author, compile_expression(expression))
+        self.cache.put(key, macro)
+        return macro
+
+    async def find(self, userId: int, guildId: int | None, name: str) -> Macro | None:
+        """The user's own macro called *name*, or else the guild's"""
+        macro = await self.get(USER, userId, name)
+        if macro is None and guildId is not None:
+            macro = await self.get(GUILD, guildId, name)
+        return macro
+
+    async def names(self, scope: str, owner: int) -> list[str]:
+        rows = await asyncio.to_thread(
+            self.execute,
+            "SELECT name FROM macros WHERE scope = ? AND owner = ? ORDER BY name",
+            scope,
+            owner,
+        )
+        return [row[0] for row in rows]
+
+    async def entries(self, scope: str, owner: int) -> list[tuple[str, str]]:
+        return await asyncio.to_thread(
+            self.execute,
+            "SELECT name, expression FROM macros "
+            "WHERE scope = ? AND owner = ? ORDER BY name",
+            scope,
+            owner,
+        )
+
+    async def save(
+        self, scope: str, owner: int, name: str, expression: str, author: int
+    ) -> None:
+        """
+        Save
+
+        Saves a validated expression under *name*, replacing the owner's macro
+        of that name if there is one.
+
+
+        Raises:
+            BadRoll: When the name is empty or too long, or the owner has too many macros
+        """
+        name = normalise_name(name)
+        if not name or len(name) > MAX_NAME_LENGTH:
+            raise BadRoll(
+                f"Macro names are 1 to {MAX_NAME_LENGTH} characters long",
+                {"name": name},
+            )
+        names = await self.names(scope, owner)
+        if name not in names and len(names) >= MAX_MACROS:
+            raise BadRoll(
+                f"There can be at most {MAX_MACROS} macros, delete one first",
+                {"name": name},
+            )
+        await asyncio.to_thread(
+            self.execute,
+            "INSERT OR REPLACE INTO macros VALUES (?, ?, ?, ?, ?)",
+            scope,
+            owner,
+            name,
+            expression,
+            author,
+        )
+        self.cache.put(
+            (scope, owner, name),
+            Macro(name, expression, author, compile_expression(expression)),
+        )
+
+    async def delete(self, scope: str, owner: int, name: str) -> None:
+        name = normalise_name(name)
+        await asyncio.to_thread(
+            self.execute,
+            "DELETE FROM macros WHERE scope = ? AND owner = ? AND name = ?",
+            scope,
+            owner,
+            name,
+        )
+        self.cache.pop((scope, owner, name))
+
+    async def save_state(self, key: str, state: str) -> None:
+        """Keeps a roll builder state under *key*, forgetting those older than STATE_TTL"""
+        now = time.time()
+        await asyncio.to_thread(
+            self.execute,
+            "DELETE FROM builder_states WHERE saved < ?",
+            now - STATE_TTL,
+        )
+        await asyncio.to_thread(
+            self.execute,
+            "INSERT OR REPLACE INTO builder_states VALUES (?, ?, ?)",
+            key,
+            state,
+            now,
+        )
+
+    async def load_state(self, key: str) -> str | None:
+        rows = await asyncio.to_thread(
+            self.execute,
+            "SELECT state FROM builder_states WHERE key = ? AND saved >= ?",
+            key,
+            time.time() - STATE_TTL,
+        )
+        return rows[0][0] if rows else None
+
+
+macros = MacroStore(
+    os.getenv("ROLL_MACRO_FILE", "macros.db"),
+    int(os.getenv("ROLL_MACRO_CACHE", "1024")),
+)
@@ -0,0 +1,49 @@
+from collections import Counter
+from typing import Any
+
+
+class Timing:
+    __slots__ = ("count", "total", "max")
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+
+class Metrics:
+    """In process counters and timings, cheap enough to update from any handler"""
+
+    def __init__(self) -> None:
+        self.counters: Counter[str] = Counter()
+        self.timings: dict[str, Timing] = {}
+
+    def incr(self, name: str, amount: int = 1) -> None:
+        self.counters[name] += amount
+
+    def observe(self, name: str, seconds: float) -> None:
+        timing = self.timings.get(name)
+        if timing is None:
+            timing = self.timings[name] = Timing()
+        timing.observe(seconds)
+
+    def snapshot(self) -> dict[str, Any]:
+        return {
+            "counters": dict(self.counters),
+            "timings": {
+                name: {
+                    "count": timing.count,
+                    "mean_ms": timing.total / timing.count * 1000,
+                    "max_ms": timing.max * 1000,
+                }
+                for name, timing in self.timings.items()
+            },
+        }
+
+
+metrics = Metrics()
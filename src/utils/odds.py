@@ -0,0 +1,430 @@
+import asyncio
+import math
+from typing import Any, Callable
+
+import d20
+import discord
+import numpy as np
+
+from utils.errors import OddsUnsupported, PoolSaturated
+from utils.roll import compile_expression, expression_key
+from utils.singleflight import SingleFlight
+
+# Distributions with more outcomes than this are too big to work out exactly
+MAX_OUTCOMES = 1_000_000
+
+# Keeping the highest or lowest of more dice than this gets too slow
+MAX_ORDERED_DICE = 50
+
+# Keeping the highest or lowest takes a step for every face, number of dice
+# handed out so far and number of dice showing it, about 10µs each. Past this
+# many steps the odds are simulated instead, 50d100kh25 would take seconds
+MAX_ORDERED_STEPS = 20_000
+
+# Outcomes less likely than this are dropped after every step
+EPSILON = 1e-15
+
+OPERATORS: dict[str, Callable[[np.ndarray, np.ndarray], np.ndarray]] = {
+    "+": np.add,
+    "-": np.subtract,
+    "*": np.multiply,
+    "/": np.true_divide,
+    "//": np.floor_divide,
+    "%": np.mod,
+    "<": np.less,
+    ">": np.greater,
+    "==": np.equal,
+    ">=": np.greater_equal,
+    "<=": np.less_equal,
+    "!=": np.not_equal,
+}
+
+
+class Distribution:
+    """
+    Distribution
+
+    Every outcome an expression can have and how likely it is. Outcomes are
+    floats because d20 only truncates the final total, so (1d4 / 2) * 2 can
+    still come out odd.
+
+
+    Args:
+        values (np.ndarray): The distinct outcomes, sorted
+        probs (np.ndarray): The probability of each outcome
+    """
+
+    __slots__ = ("values", "probs")
+
+    def __init__(self, values: np.ndarray, probs: np.ndarray) -> None:
+        self.values = values
+        self.probs = probs
+
+    @classmethod
+    def of(cls, values: np.ndarray, probs: np.ndarray) -> "Distribution":
+        """Builds a distribution from outcomes that may repeat and be unsorted"""
+        values, inverse = np.unique(values, return_inverse=True)
+        probs = np.bincount(inverse.ravel(), weights=probs.ravel())
+        keep = probs > EPSILON
+        return cls(values[keep], probs[keep])
+
+    @classmethod
+    def constant(cls, value: float) -> "Distribution":
+        return cls(np.array([float(value)]), np.array([1.0]))
+
+    def is_integral(self) -> bool:
+        return bool(np.all(self.values == np.round(self.values)))
+
+    def combine(self, other: "Distribution", op: str) -> "Distribution":
+        """The distribution of *op* applied to independent draws from both"""
+        if op in ("+", "-") and self.is_integral() and other.is_integral():
+            right = other if op == "+" else other.map(np.negative)
+            return self.add(right)
+        if len(self.values) * len(other.values) > MAX_OUTCOMES:
+            raise OddsUnsupported("The expression has too many possible outcomes")
+        if op in ("/", "//", "%") and np.any(other.values == 0):
+            raise OddsUnsupported("The expression can divide by zero")
+        values = OPERATORS[op](self.values[:, None], other.values[None, :])
+        probs = self.probs[:, None] * other.probs[None, :]
+        return Distribution.of(values.astype(float), probs)
+
+    def add(self, other: "Distribution") -> "Distribution":
+        """Sum of two integral distributions, by convolving them on a lattice"""
+        left, right = self.dense(), other.dense()
+        if left[1].size + right[1].size > MAX_OUTCOMES:
+            raise OddsUnsupported("The expression has too many possible outcomes")
+        return Distribution.from_dense(
+            left[0] + right[0], np.convolve(left[1], right[1])
+        )
+
+    def dense(self) -> tuple[int, np.ndarray]:
+        """The lowest outcome and the probabilities of every integer from it up"""
+        low = int(self.values[0])
+        pmf = np.zeros(int(self.values[-1]) - low + 1)
+        pmf[self.values.astype(np.int64) - low] = self.probs
+        return low, pmf
+
+    @classmethod
+    def from_dense(cls, low: int, pmf: np.ndarray) -> "Distribution":
+        (indices,) = np.nonzero(pmf > EPSILON)
+        return cls((indices + low).astype(float), pmf[indices])
+
+    def map(self, func: Callable[[np.ndarray], np.ndarray]) -> "Distribution":
+        return Distribution.of(func(self.values).astype(float), self.probs)
+
+    def times(self, count: int) -> "Distribution":
+        """Sum of *count* independent draws, by repeated squaring"""
+        result = Distribution.constant(0)
+        power: Distribution = self
+        while count:
+            if count & 1:
+                result = result.add(power)
+            count >>= 1
+            if count:
+                power = power.add(power)
+        return result
+
+    def truncate(self) -> "Distribution":
+        """What d20 reports as the total, the value cut down to an integer"""
+        return self.map(np.trunc)
+
+    def at_least(self, goal: float) -> float:
+        return float(self.probs[self.values >= goal].sum())
+
+    def mean(self) -> float:
+        return float(np.dot(self.values, self.probs))
+
+    def stdev(self) -> float:
+        return math.sqrt(
+            max(0.0, float(np.dot(self.values**2, self.probs)) - self.mean() ** 2)
+        )
+
+    def percentile(self, fraction: float) -> float:
+        cumulative = np.cumsum(self.probs)
+        index = int(np.searchsorted(cumulative, fraction * cumulative[-1]))
+        return float(self.values[min(index, len(self.values) - 1)])
+
+
+class DiePool:
+    """
+    Die Pool
+
+    A set of identical dice worked through d20's operators in order. As long
+    as every operator acts on each die on its own the dice stay independent,
+    so the distribution of one die describes them all. It is kept over the
+    faces and any value a clamp can force, plus a last slot for the chance
+    the die was dropped.
+
+    Reroll and add (ra) is the exception, it adds one extra die when any die
+    matches. From then on the pool also tracks the *unmatched* part of a
+    die's distribution and the *extra* die itself.
+    """
+
+    def __init__(self, count: int, size: int | str, operations: list[Any]) -> None:
+        if size == "%":
+            faces = np.arange(0, 100, 10, dtype=float)
+        elif int(size) < 1:
+            raise OddsUnsupported("Cannot roll a 0-sided die")
+        else:
+            faces = np.arange(1, int(size) + 1, dtype=float)
+        clamps = [op.sels[-1].num for op in operations if op.op in ("mi", "ma")]
+        self.count = count
+        self.values = np.union1d(faces, clamps)
+        self.fresh = np.append(np.isin(self.values, faces) / len(faces), 0.0)
+        self.probs = self.fresh.copy()
+        self.unmatched: np.ndarray | None = None
+        self.extra: np.ndarray | None = None
+        self.ordered: tuple[str, str, int] | None = None
+        for operation in operations:
+            self.apply(operation)
+
+    def apply(self, operation: Any) -> None:
+        if self.ordered is not None:
+            raise OddsUnsupported(
+                "Nothing can follow keeping or dropping the highest or lowest dice"
+            )
+        op = operation.op
+        if {selector.cat for selector in operation.sels} & {"h", "l"}:
+            if op not in ("k", "p") or len(operation.sels) != 1:
+                raise OddsUnsupported(f"{op} can't pick the highest or lowest dice")
+            if self.probs[-1] or self.extra is not None:
+                raise OddsUnsupported(
+                    "The highest or lowest can't be kept from a varying number of dice"
+                )
+            self.ordered = (op, operation.sels[0].cat, operation.sels[0].num)
+            return
+
+        matches = np.append(self.matches(operation), False)
+        match op:
+            case "mi" | "ma":
+                clamp = np.maximum if op == "mi" else np.minimum
+                targets = np.searchsorted(
+                    self.values, clamp(self.values, operation.sels[-1].num)
+                )
+                self.transform(lambda probs: self.move(probs, targets))
+            case "ro":
+                self.transform(lambda probs: self.reroll(probs, matches, self.fresh))
+            case "rr":
+                fresh = np.where(matches, 0.0, self.fresh)
+                if not fresh.any():
+                    raise OddsUnsupported(
+                        "Every face gets rerolled, the roll never ends"
+                    )
+                fresh = fresh / fresh.sum()
+                self.transform(lambda probs: self.reroll(probs, matches, fresh))
+            case "k" | "p":
+                drops = np.append(~matches[:-1] if op == "k" else matches[:-1], False)
+                self.transform(lambda probs: self.reroll(probs, drops, self.dropped))
+            case "ra":
+                if self.extra is not None:
+                    raise OddsUnsupported("Only one reroll and add (ra) is supported")
+                self.unmatched = np.where(matches, 0.0, self.probs)
+                self.extra = self.fresh.copy()
+            case _:
+                raise OddsUnsupported(f"The {op} operator isn't supported")
+
+    @property
+    def dropped(self) -> np.ndarray:
+        dropped = np.zeros(len(self.values) + 1)
+        dropped[-1] = 1.0
+        return dropped
+
+    def transform(self, func: Callable[[np.ndarray], np.ndarray]) -> None:
+        """Runs an operator over every distribution the pool tracks"""
+        self.probs = func(self.probs)
+        if self.unmatched is not None:
+            self.unmatched = func(self.unmatched)
+        if self.extra is not None:
+            self.extra = func(self.extra)
+
+    def move(self, probs: np.ndarray, targets: np.ndarray) -> np.ndarray:
+        moved = np.zeros_like(probs)
+        np.add.at(moved, targets, probs[:-1])
+        moved[-1] = probs[-1]
+        return moved
+
+    @staticmethod
+    def reroll(probs: np.ndarray, matches: np.ndarray, into: np.ndarray) -> np.ndarray:
+        """Replaces the matching part of *probs* with the distribution *into*"""
+        return np.where(matches, 0.0, probs) + probs[matches].sum() * into
+
+    def matches(self, operation: Any) -> np.ndarray:
+        matches = np.zeros(len(self.values), dtype=bool)
+        for selector in operation.sels:
+            match selector.cat:
+                case None:
+                    matches |= self.values == selector.num
+                case "<":
+                    matches |= self.values < selector.num
+                case ">":
+                    matches |= self.values > selector.num
+        return matches
+
+    def die(self, probs: np.ndarray) -> Distribution:
+        # A dropped die counts as 0
+        return Distribution.of(np.append(self.values, 0.0), probs)
+
+    def distribution(self) -> Distribution:
+        if self.ordered is not None:
+            return self.order_statistics(self.die(self.probs))
+        total = self.die(self.probs).times(self.count)
+        if self.extra is None or self.unmatched is None:
+            return total
+        # Either no die matched, or one did and the extra die joins the sum
+        unmatched = self.die(self.unmatched).times(self.count)
+        matched = Distribution.of(
+            np.concatenate([total.values, unmatched.values]),
+            np.concatenate([total.probs, -unmatched.probs]),
+        ).add(self.die(self.extra))
+        return Distribution.of(
+            np.concatenate([matched.values, unmatched.values]),
+            np.concatenate([matched.probs, unmatched.probs]),
+        )
+
+    def order_statistics(self, die: Distribution) -> Distribution:
+        """
+        Order Statistics
+
+        The sum of the highest or lowest dice. Faces are handed out from the
+        best down, choosing how many of the remaining dice show each one, and
+        only the first *keep* dice handed out count towards the sum.
+        """
+        op, cat, number = self.ordered  # type: ignore
+        count = self.count
+        if count > MAX_ORDERED_DICE:
+            raise OddsUnsupported(
+                f"The highest or lowest can only be kept from up to {MAX_ORDERED_DICE} dice"
+            )
+        if len(die.values) * (count + 1) * (count + 2) // 2 > MAX_ORDERED_STEPS:
+            raise OddsUnsupported(
+                "Too many dice and faces to work out the highest or lowest exactly"
+            )
+        number = max(0, min(number, count))
+        # Dropping the lowest n is keeping the highest count - n
+        highest = (cat == "h") == (op == "k")
+        keep = number if op == "k" else count - number
+
+        order = slice(None, None, -1) if highest else slice(None)
+        values = die.values[order].astype(np.int64)
+        probs = die.probs[order]
+        low = min(0, int(values.min())) * keep
+        high = max(0, int(values.max())) * keep
+        # dp[dice handed out, kept sum - low]
+        dp = np.zeros((count + 1, high - low + 1))
+        dp[0, -low] = 1.0
+        for value, prob in zip(values, probs):
+            handedOut = np.zeros_like(dp)
+            for handed in range(count + 1):
+                row = dp[handed]
+                if not row.any():
+                    continue
+                for showing in range(count - handed + 1):
+                    kept = max(0, min(showing, keep - handed))
+                    weight = math.comb(count - handed, showing) * prob**showing
+                    handedOut[handed + showing] += (
+                        np.roll(row, kept * int(value)) * weight
+                    )
+            dp = handedOut
+        return Distribution.from_dense(low, dp[count])
+
+
+def evaluate(node: Any) -> Distribution:
+    """The distribution of a d20 syntax tree node"""
+    match node:
+        case d20.ast.Expression():
+            return evaluate(node.roll)
+        case d20.ast.Parenthetical() | d20.ast.AnnotatedNumber():
+            return evaluate(node.value)
+        case d20.ast.Literal():
+            return Distribution.constant(node.value)
+        case d20.ast.UnOp():
+            value = evaluate(node.value)
+            return value.map(np.negative) if node.op == "-" else value
+        case d20.ast.BinOp():
+            return evaluate(node.left).combine(evaluate(node.right), node.op)
+        case d20.ast.OperatedSet() if not node.operations:
+            return evaluate(node.value)
+        case d20.ast.NumberSet():
+            total = Distribution.constant(0)
+            for value in node.values:
+                total = total.combine(evaluate(value), "+")
+            return total
+        case d20.ast.OperatedDice():
+            dice = node.value
+            return DiePool(dice.num, dice.size, node.operations).distribution()
+        case d20.ast.Dice():
+            return DiePool(node.num, node.size, []).distribution()
+    raise OddsUnsupported(f"{type(node).__name__} expressions aren't supported")
+
+
+def distribution(expression: str) -> Distribution:
+    """
+    Distribution
+
+    Works out exactly how likely every total of a dice expression is.
+
+
+    Args:
+        expression (str): The dice expression
+
+    Returns:
+        Distribution: The totals d20 can report and their probabilities
+    """
+    return evaluate(compile_expression(expression)).truncate()
+
+
+def odds_embed(
+    expression: str, odds: Distribution, samples: int | None, goal: int | None
+) -> discord.Embed:
+    embed = discord.Embed(title=f"Odds of {expression}", color=0xFEFEFE)
+    embed.add_field(name="Average:", value=f"{odds.mean():.2f}")
+    embed.add_field(name="Spread:", value=f"± {odds.stdev():.2f}")
+    embed.add_field(
+        name="Range:", value=f"{odds.values[0]:.0f} to {odds.values[-1]:.0f}"
+    )
+    embed.add_field(
+        name="Middle 80%:",
+        value=f"{odds.percentile(0.1):.0f} to {odds.percentile(0.9):.0f}",
+    )
+    embed.add_field(name="Median:", value=f"{odds.percentile(0.5):.0f}")
+    if goal is not None:
+        embed.add_field(
+            name="Goal:",
+            value=f"{odds.at_least(goal):.2%} to reach {goal}",
+            inline=False,
+        )
+    if samples is not None:
+        embed.set_footer(text=f"Estimated from {samples:,} simulated rolls")
+    return embed
+
+
+# Odds only depend on the expression so they are kept for a day
+distributions: SingleFlight[Distribution] = SingleFlight(
+    "odds.distributions", ttl=24 * 60 * 60
+)
+
+
+async def expression_odds(expression: str, workers: Any = None) -> Distribution:
+    """
+    Expression Odds
+
+    The distribution of an expression, worked out once and shared by everyone
+    asking for it. Big expressions are worked out in the thread pool.
+
+
+    Args:
+        expression (str): The dice expression
+        workers (WorkerPool): The client's worker pools, None to work it out inline
+
+    Returns:
+        Distribution: The totals and their probabilities
+    """
+    key = expression_key(expression)
+    if workers is None:
+        return await distributions.do(key, lambda: distribution(expression))
+    try:
+        return await distributions.do(
+            key, lambda: workers.submit(distribution, expression, timeout=2.0)
+        )
+    except (PoolSaturated, asyncio.TimeoutError):
+        raise OddsUnsupported("The odds took too long to work out")
@@ -0,0 +1,128 @@
+import os
+from typing import NamedTuple
+
+import d20
+import discord
+import numpy as np
+
+from utils.cost import expression_cost
+from utils.errors import OddsUnsupported
+from utils.history import face_stats, history
+from utils.rng import dice_count, generator
+from utils.roll import compile_expression
+from utils.simulate import sample
+
+# Rolls throwing more dice than this are rolled in bulk and shown as a histogram,
+# d20 can't roll more than 1000 dice so it has to be below that
+LARGE_POOL = min(int(os.getenv("ROLL_LARGE_POOL", "100")), 1000)
+
+# Most dice a large pool can start with
+MAX_POOL_DICE = 10_000
+
+# Results longer than this don't fit in the description of an embed
+MAX_OUTPUT = 4000
+
+# Faces of bigger dice are grouped so a histogram has at most this many rows
+HISTOGRAM_ROWS = 10
+BAR_WIDTH = 20
+
+# Histograms shown for the sizes of die thrown most, the rest are only totalled
+MAX_HISTOGRAMS = 3
+
+
+class PoolRoll(NamedTuple):
+    total: int
+    # The sides and natural face of every numbered die thrown, rerolled ones included
+    sides: np.ndarray
+    faces: np.ndarray
+    seed: int | None
+
+
+def is_large(expression: str) -> bool:
+    """Whether a roll is expected to throw too many dice, or write too long a result, to show every die"""
+    cost = expression_cost(expression)
+    return cost.draws > LARGE_POOL or cost.output > MAX_OUTPUT
+
+
+def roll_pool(expression: str, seed: int | None = None) -> PoolRoll:
+    """
+    Roll Pool
+
+    Rolls an expression with too many dice to show one by one. Its dice are
+    drawn in bulk by the same vectorized simulation that estimates odds, a
+    single row of it, rather than one at a time by d20.
+
+
+    Args:
+        expression (str): The dice expression
+        seed (int): Seed of an earlier roll of the same expression to replay
+
+    Returns:
+        PoolRoll: The total, the faces thrown, and the seed when it can be replayed
+
+    Raises:
+        d20.RollError: When the expression can't be rolled
+    """
+    tree = compile_expression(expression)
+    if dice_count(tree) > MAX_POOL_DICE:
+        raise d20.TooManyRolls(f"A roll can throw at most {MAX_POOL_DICE:,} dice")
+    rng, seed = generator(seed)
+    thrown: list[tuple[int | str, np.ndarray]] = []
+    try:
+        total = int(np.trunc(sample(tree, 1, rng, thrown)[0]))
+    except OddsUnsupported as error:
+        raise d20.RollValueError(error.reason)
+    # Percentile dice have no face 1 to count from, history leaves them out too
+    numbered = [(size, faces) for size, faces in thrown if isinstance(size, int)]
+    sides = np.concatenate(
+        [np.full(faces.size, size, dtype=np.int64) for size, faces in numbered]
+        or [np.zeros(0, dtype=np.int64)]
+    )
+    faces = np.concatenate(
+        [faces.ravel().astype(np.int64) for _, faces in numbered]
+        or [np.zeros(0, dtype=np.int64)]
+    )
+    return PoolRoll(total, sides, faces, seed)
+
+
+def record_pool(
+    userId: int, channelId: int | None, expression: str, rolled: PoolRoll
+) -> None:
+    history.record_faces(
+        userId, channelId, expression, rolled.total, rolled.sides, rolled.faces
+    )
+
+
+def histogram(faces: np.ndarray, size: int) -> str:
+    """Bars of how often each face of a die came up, as a code block"""
+    counts = np.bincount(faces - 1, minlength=size)[:size]
+    edges = np.linspace(0, size, min(size, HISTOGRAM_ROWS) + 1).round().astype(int)
+    counts = np.add.reduceat(counts, edges[:-1])
+    labels = [
+        str(high) if high - low == 1 else f"{low + 1}-{high}"
+        for low, high in zip(edges[:-1].tolist(), edges[1:].tolist())
+    ]
+    labelWidth = max(len(label) for label in labels)
+    peak = max(int(counts.max()), 1)
+    lines = [
+        f"{label:>{labelWidth}} {'█' * round(BAR_WIDTH * count / peak):<{BAR_WIDTH}} {count}"
+        for label, count in zip(labels, counts.tolist())
+    ]
+    return "```\n" + "\n".join(lines) + "\n```"
+
+
+def pool_embed(title: str, expression: str, rolled: PoolRoll) -> discord.Embed:
+    """A large roll's total, and a histogram and summary of the faces of each size of die"""
+    lines = [f"`{expression}` = **{rolled.total:,}**"]
+    sizes, counts = np.unique(rolled.sides, return_counts=True)
+    for size in sizes[np.argsort(-counts, kind="stable")][:MAX_HISTOGRAMS].tolist():
+        stats = face_stats(rolled.sides, rolled.faces, size)
+        lines.append(
+            f"d{size}: {stats['thrown']:,} thrown, average {stats['mean']:.2f} "
+            f"(fair is {stats['expected_mean']:.1f})"
+        )
+        lines.append(histogram(rolled.faces[rolled.sides == size], size))
+    embed = discord.Embed(title=title, description="\n".join(lines), color=0xFEFEFE)
+    embed.add_field(name="Total:", value=f"{rolled.total:,}")
+    embed.add_field(name="Dice thrown:", value=f"{len(rolled.faces):,}")
+    return embed
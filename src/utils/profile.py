@@ -0,0 +1,103 @@
+import ast
+import importlib.util
+from typing import Any
+
+import discord
+
+PROFILES = ("default", "lean")
+
+# What main.py itself needs, the owner only prefix commands read messages
+CORE_INTENTS = ["guilds", "guild_messages", "dm_messages", "message_content"]
+
+
+def declared(extension: str, name: str) -> list[str]:
+    """
+    Declared
+
+    Reads a list an extension declares at the top of its module, like
+    REQUIRED_INTENTS = ["voice_states"], from its source. The module isn't
+    imported, load_extension runs an extension as a module of its own so
+    importing it here would run it twice.
+
+
+    Args:
+        extension (str): The extension, like "cogs.music"
+        name (str): The name the list is assigned to
+
+    Returns:
+        list: The declared names, empty when the extension declares none
+    """
+    spec = importlib.util.find_spec(extension)
+    if spec is None or spec.origin is None:
+        return []
+    with open(spec.origin, encoding="utf-8") as f:
+        tree = ast.parse(f.read(), spec.origin)
+    for node in tree.body:
+        if isinstance(node, ast.Assign):
+            targets, value = node.targets, node.value
+        elif isinstance(node, ast.AnnAssign) and node.value is not None:
+            targets, value = [node.target], node.value
+        else:
+            continue
+        if any(
+            isinstance(target, ast.Name) and target.id == name for target in targets
+        ):
+            return list(ast.literal_eval(value))
+    return []
+
+
+def required(extensions: list[str], name: str, core: list[str]) -> list[str]:
+    """Everything in *core* and what the extensions declare under *name*, once each"""
+    names = list(core)
+    for extension in extensions:
+        for declaredName in declared(extension, name):
+            if declaredName not in names:
+                names.append(declaredName)
+    return names
+
+
+def required_intents(extensions: list[str]) -> list[str]:
+    """The intents main.py needs and those the extensions declare in REQUIRED_INTENTS"""
+    return required(extensions, "REQUIRED_INTENTS", CORE_INTENTS)
+
+
+def member_cache(extensions: list[str]) -> list[str]:
+    """The member cache flags the extensions declare in MEMBER_CACHE"""
+    return required(extensions, "MEMBER_CACHE", [])
+
+
+def client_options(profile: str, extensions: list[str]) -> dict[str, Any]:
+    """
+    Client Options
+
+    Builds the intents and cache settings for the client.
+    The default profile keeps discord.py's defaults, the lean profile turns on
+    only the intents the extensions declare and caches just what they declare
+    they need: members only for the MEMBER_CACHE flags an extension lists,
+    none at all when no extension lists any, and no messages.
+
+
+    Args:
+        profile (str): Either "default" or "lean"
+        extensions (list): The extensions that are going to be loaded
+
+    Returns:
+        dict: Keyword arguments for MyClient
+    """
+    if profile == "lean":
+        intents = discord.Intents.none()
+        for intent in required_intents(extensions):
+            setattr(intents, intent, True)
+        memberCacheFlags = discord.MemberCacheFlags.none()
+        for flag in member_cache(extensions):
+            setattr(memberCacheFlags, flag, True)
+        return {
+            "intents": intents,
+            "member_cache_flags": memberCacheFlags,
+            "max_messages": None,
+        }
+
+    intents = discord.Intents.default()
+    intents.voice_states = True
+    intents.message_content = True
+    return {"intents": intents}
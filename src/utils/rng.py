@@ -0,0 +1,157 @@
+import os
+import random
+import secrets
+from typing import Any, NamedTuple
+
+import d20
+import d20.expression
+import numpy as np
+
+# Uniforms drawn at a time once a roll has used up those drawn for its dice,
+# rerolls and explosions need more than the expression shows
+REFILL = 64
+
+# Seeds fit in a Discord integer option so any roll can be replayed with /rollreplay
+SEED_BITS = 53
+
+
+class Rolled(NamedTuple):
+    result: d20.RollResult
+    # Rolling the same expression from it throws the same dice, None when not seeded
+    seed: int | None
+
+
+def dice_count(node: Any) -> int:
+    """How many dice an expression throws before any rerolls or explosions"""
+    count = 0
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, d20.ast.Dice):
+            count += node.num
+        stack.extend(node.children)
+    return count
+
+
+class PythonBackend:
+    """d20's own way of rolling, a call to Python's random for every die"""
+
+    name = "random"
+
+    def source(self, tree: Any, seed: int | None) -> tuple[Any, int | None]:
+        return random, None
+
+
+class Draws:
+    """
+    Draws
+
+    Stands in for the random module inside d20 during one roll. The uniforms
+    for every die the roll is going to throw are drawn in one call to a NumPy
+    Generator, more in blocks if rerolls need them, and each becomes a face
+    when d20 asks for one.
+    """
+
+    __slots__ = ("generator", "next")
+
+    def __init__(self, generator: np.random.Generator, count: int) -> None:
+        self.generator = generator
+        self.next = iter(generator.random(max(count, 1)).tolist()).__next__
+
+    def randrange(self, start: int, stop: int | None = None, step: int = 1) -> int:
+        try:
+            uniform = self.next()
+        except StopIteration:
+            self.next = iter(self.generator.random(REFILL).tolist()).__next__
+            uniform = self.next()
+        if stop is None:
+            return int(uniform * start)
+        return start + step * int(uniform * ((stop - start + step - 1) // step))
+
+
+class NumpyBackend:
+    """
+    NumPy Backend
+
+    Rolls with Draws from a NumPy Generator. When *seeded*, every roll gets a
+    Generator of its own from a fresh seed, and rolling the same expression
+    from that seed again throws exactly the same dice.
+
+
+    Args:
+        seeded (bool): Whether to seed every roll so it can be replayed
+    """
+
+    def __init__(self, seeded: bool) -> None:
+        self.seeded = seeded
+        self.name = "seeded" if seeded else "numpy"
+        self.generator = np.random.default_rng()
+
+    def source(self, tree: Any, seed: int | None) -> tuple[Any, int | None]:
+        if seed is None and self.seeded:
+            seed = secrets.randbits(SEED_BITS)
+        generator = self.generator if seed is None else np.random.default_rng(seed)
+        return Draws(generator, dice_count(tree)), seed
+
+
+BACKENDS: dict[str, PythonBackend | NumpyBackend] = {
+    "random": PythonBackend(),
+    "numpy": NumpyBackend(seeded=False),
+    "seeded": NumpyBackend(seeded=True),
+}
+
+# d20's own random stays the default, feeding it NumPy draws one die at a time
+# isn't faster than calling random for every die
+backend = BACKENDS[os.getenv("ROLL_RNG", "random")]
+
+
+def roll(tree: d20.ast.Expression, seed: int | None = None) -> Rolled:
+    """
+    Roll
+
+    Rolls a parsed expression with the backend picked by ROLL_RNG, or replays
+    the roll that was made from *seed*. d20 only ever calls random.randrange,
+    so its random is swapped for the roll's source. Rolls are made on the
+    event loop or in the process pool, never two at once in a process.
+
+
+    Args:
+        tree (d20.ast.Expression): The parsed expression
+        seed (int): Seed of an earlier roll of the same expression to replay
+
+    Returns:
+        Rolled: The result, and its seed when it can be replayed
+    """
+    source, seed = (backend if seed is None else BACKENDS["seeded"]).source(tree, seed)
+    d20.expression.random = source  # type: ignore
+    return Rolled(d20.roll(tree), seed)
+
+
+def generator(seed: int | None = None) -> tuple[np.random.Generator, int | None]:
+    """
+    Generator
+
+    A NumPy Generator for rolls drawn in bulk rather than through d20, seeded
+    the way the backend seeds its rolls, or from *seed* to replay one. Bulk
+    rolls always come from NumPy, whichever backend ROLL_RNG picks.
+
+
+    Args:
+        seed (int): Seed of an earlier roll to replay
+
+    Returns:
+        tuple: The Generator, and its seed when the roll can be replayed
+    """
+    if seed is None and backend.name == "seeded":
+        seed = secrets.randbits(SEED_BITS)
+    if seed is None:
+        return BACKENDS["numpy"].generator, None  # type: ignore
+    return np.random.default_rng(seed), seed
+
+
+def seed_footer(
+    expression: str, seed: int, command: str = "rollreplay", **options: Any
+) -> str:
+    """How to roll the same dice again, options go between the expression and seed"""
+    extra = "".join(f" {name}:{value}" for name, value in options.items())
+    return f"Replay with /{command} expression:{expression}{extra} seed:{seed}"
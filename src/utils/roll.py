@@ -1,12 +1,12 @@
-from collections import OrderedDict
+import re
 from enum import Enum
 from typing import NamedTuple
 
 import d20
-import discord
-from discord import ui
 
+from utils.caches import TTLCache
 from utils.errors import BadRoll
+from utils.rng import Rolled, roll
 
 
 class Selectors(Enum):
@@ -50,15 +50,38 @@ class Reroll(NamedTuple):
     number: int
 
 
-PARAMATERS = [
-    "type",
-    "keep",
-    "modifier",
-    "negate",
-    "multiplyDivide",
-    "minMax",
-    "reroll",
-]
+# Parsed dice expressions, rolling a tree doesn't change it so they can be shared
+expressions: TTLCache[d20.ast.Expression] = TTLCache(
+    "d20.expressions", 4096, ttl=24 * 60 * 60
+)
+
+# Selectors in the short form d20 writes them in, exact has none
+SELECTOR_CODES = {
+    Selectors.lowest: "l",
+    Selectors.highest: "h",
+    Selectors.exact: "",
+    Selectors.greater: ">",
+    Selectors.less: "<",
+}
+SELECTORS = {code: selector for selector, code in SELECTOR_CODES.items()}
+
+# Annotations like [fire damage], where whitespace is part of the text
+ANNOTATION = re.compile(r"(\[[^\]]*\])")
+
+# A die in a few characters, mostly as d20 would write it: 4d6i2a5rrl1kh3m2x2nt
+# is four six sided dice with a min of 2 and max of 5, rerolling 1s, keeping
+# the highest 3, plus 2, times 2, negated, of a type
+DIE_CODE = re.compile(
+    r"(?P<amount>\d+)d(?P<sides>\d+)"
+    r"(?:i(?P<min>-?\d+))?"
+    r"(?:a(?P<max>-?\d+))?"
+    r"(?:r(?P<when>[ora])(?P<rerollOn>[lh<>]?)(?P<reroll>-?\d+))?"
+    r"(?:(?P<dropOrKeep>[kp])(?P<keepOn>[lh<>]?)(?P<keep>-?\d+))?"
+    r"(?:m(?P<modifier>-?\d+))?"
+    r"(?:(?P<multiplyOrDivide>[x/])(?P<multiplyDivide>-?\d+))?"
+    r"(?P<negate>n)?"
+    r"(?:t(?P<type>\w+))?"
+)
 
 
 class Die:
@@ -86,7 +109,18 @@ class Die:
         self.max = max
         self.reroll = reroll
 
+    def __setattr__(self, name: str, value) -> None:
+        # Any change to the die makes the rendered form stale
+        super().__setattr__(name, value)
+        if name != "rendered":
+            super().__setattr__("rendered", None)
+
     def __str__(self):
+        if self.rendered is None:
+            self.rendered = self.render()
+        return self.rendered
+
+    def render(self) -> str:
         reroll: str = ""
         if self.reroll is not None:
             match RerollOn(self.reroll.when):
@@ -158,555 +192,146 @@ class Die:
 
         return f"{negate}({self.amount}d{self.sides}{min}{max}{reroll}{keep}{modifier}){multiplyDivide}{type}"
 
-
-class Dice:
-    def __init__(self, dice: list[Die], DC: int | None = None):
-        self.dice = dice
-        self.DC = DC
-
-    def roll(self):
-        return d20.roll("(" + ", ".join(str(die) for die in self.dice) + ")")
-
-
-class MinMaxButton(ui.Button["RollBuilder"]):
-    def __init__(self):
-        super().__init__(custom_id="minMax", label="Set min/max", disabled=True)
-        self.view: RollBuilder
-
-    async def callback(self, interaction: discord.Interaction) -> None:
-        modal = MinMaxModal(self.view)
-        await interaction.response.send_modal(modal)
-        await modal.wait()
-        await interaction.edit_original_response(view=self.view)
-
-
-class ModifierButton(ui.Button["RollBuilder"]):
-    def __init__(self):
-        super().__init__(custom_id="modifier", label="Set modifier", disabled=True)
-        self.view: RollBuilder
-
-    async def callback(self, interaction: discord.Interaction) -> None:
-        modal = ModifierModal(self.view)
-        await interaction.response.send_modal(modal)
-        await modal.wait()
-        await interaction.edit_original_response(view=self.view)
-
-
-class KeepButton(ui.Button["RollBuilder"]):
-    def __init__(self):
-        super().__init__(custom_id="keep", label="Set Keeps", disabled=True)
-        self.view: RollBuilder
-
-    async def callback(self, interaction: discord.Interaction) -> None:
-        modal = KeepModal(self.view)
-        await interaction.response.send_modal(modal)
-        await modal.wait()
-        await interaction.edit_original_response(view=self.view)
-
-
-class RerollButton(ui.Button["RollBuilder"]):
-    def __init__(self):
-        super().__init__(custom_id="reroll", label="Set Reroll", disabled=True)
-        self.view: RollBuilder
-
-    async def callback(self, interaction: discord.Interaction) -> None:
-        modal = RerollModal(self.view)
-        await interaction.response.send_modal(modal)
-        await modal.wait()
-        await interaction.edit_original_response(view=self.view)
-
-
-class MultiplyDivideButton(ui.Button["RollBuilder"]):
-    def __init__(self):
-        super().__init__(
-            custom_id="multiplyDivide", label="Multiply/Divide", disabled=True
-        )
-        self.view: RollBuilder
-
-    async def callback(self, interaction: discord.Interaction) -> None:
-        modal = MultiplyDivideModal(self.view)
-        await interaction.response.send_modal(modal)
-        await modal.wait()
-        await interaction.edit_original_response(view=self.view)
-
-
-class RollButton(ui.Button["RollBuilder"]):
-    def __init__(self):
-        super().__init__(
-            label="Roll",
-            style=discord.ButtonStyle.green,
-            custom_id="roll",
-        )
-
-    async def callback(self, interaction: discord.Interaction) -> None:
-        # Make linter behave
-        self.view: RollBuilder
-
-        if len(self.view.dice) <= 0:
-            return await interaction.response.send_message(
-                content="No dice to roll!", ephemeral=True
+    def code(self) -> str:
+        """The die written as a DIE_CODE"""
+        code = f"{self.amount}d{self.sides}"
+        if self.min is not None:
+            code += f"i{self.min}"
+        if self.max is not None:
+            code += f"a{self.max}"
+        if self.reroll is not None:
+            when = RerollOn(self.reroll.when).value[1]
+            code += f"r{when}{SELECTOR_CODES[Selectors(self.reroll.type)]}{self.reroll.number}"
+        if self.keep is not None:
+            dropOrKeep = DropOrKeep(self.keep.dropOrKeep) == DropOrKeep.keep
+            code += f"{'k' if dropOrKeep else 'p'}{SELECTOR_CODES[Selectors(self.keep.type)]}{self.keep.number}"
+        if self.modifier:
+            code += f"m{self.modifier}"
+        if self.multiplyDivide is not None:
+            multiply = (
+                MultiplyOrDivide(self.multiplyDivide.multiplyOrDivide)
+                == MultiplyOrDivide.multiply
             )
-        roll = Dice(list(self.view.dice.values())).roll()
-        embed = discord.Embed(title="Roll", description=str(roll))
-        embed.set_author(
-            name=interaction.user.__str__(),
-            icon_url=interaction.user.avatar.url if interaction.user.avatar else None,
-        )
-        self.view.stop()
-        await interaction.response.send_message(embed=embed)
-
-
-class DiceSelector(ui.Select["RollBuilder"]):
-    def __init__(self):
-        options: list[discord.SelectOption] = []
-        options.append(
-            discord.SelectOption(label="New", description="Add a new die", emoji="🆕")
-        )
-
-        super().__init__(
-            options=options,
-            min_values=1,
-            max_values=1,
-            placeholder="Pick a die to edit",
-            custom_id="selector",
-            row=0,
-        )
-
-    def disable_enable_buttons(self, status: bool) -> None:
-        buttons = list(
-            filter(lambda child: isinstance(child, ui.Button), self.view.children)
-        )
-        if len(buttons) == 0:
-            return
-        for button in buttons:
-            if not isinstance(button, ui.Button) or button.custom_id not in PARAMATERS:
-                continue
-            button.disabled = status
-
-    async def callback(self, interaction: discord.Interaction):
-        # Make the linter behave
-        self.view: RollBuilder
-
-        # Check if the user is making a new die
-        if self.values[0] == "New":
-            self.disable_enable_buttons(True)
-
-            # Prompt the user to pick sides and amount and if they don't defer
-            oldLength = len(self.view.dice)
-            modal = NewDieModal(self.view)
-            await interaction.response.send_modal(modal)
-            await modal.wait()
-            if len(self.view.dice) <= oldLength:
-                return await interaction.response.defer()
-
-            # Unselect their currently selected "New" option
-            self.values.pop()
-
-            # Add the new die to the list of dice and select it
-            newDie = next(reversed(self.view.dice))
-            self.add_option(label=newDie, emoji="🎲")
-            self.values.append(newDie)
-
-            # Update the message
-
-            embed: discord.Embed = (await interaction.original_response()).embeds[0]
-            embed.clear_fields().description = ", ".join(self.view.dice.keys())
-            return await interaction.edit_original_response(embed=embed, view=self.view)
-
-        if interaction.message is None:
-            raise Exception("Should not be possible")
-        embed: discord.Embed = interaction.message.embeds[0]
-        if len(embed.fields) >= 1:
-            await interaction.response.defer()
-            return
-        embed.add_field(name="Currently Editing", value=self.values[0])
-        self.disable_enable_buttons(False)
-        await interaction.response.edit_message(embed=embed, view=self.view)
-
-
-class RollBuilder(ui.View):
-    def __init__(self, dice: OrderedDict[str, Die]):
-        super().__init__()
-        self.dice = dice
-
-        self.add_item(DiceSelector())
-        self.add_item(MinMaxButton())
-        self.add_item(ModifierButton())
-        self.add_item(KeepButton())
-        self.add_item(RerollButton())
-        self.add_item(MultiplyDivideButton())
-        self.add_item(RollButton())
-
-    def getCurrentDie(self) -> Die | None:
-        # Filter out the die selector without the linter getting angry
-        children = list(
-            filter(lambda child: isinstance(child, DiceSelector), self.children)
-        )
-        selector = children[0] if len(children) == 1 else None
-        if selector is None or not isinstance(selector, DiceSelector):
-            raise Exception("This should never happen")
-
-        return self.dice.get(selector.values[0])
-
-
-class NewDieModal(ui.Modal, title="New Die"):
-    def __init__(self, view: RollBuilder):
-        super().__init__()
-        self.view = view
-
-    amount = discord.ui.TextInput(
-        label="# of dice",
-        default="1",
-        min_length=1,
-        max_length=3,
-        required=True,
-        style=discord.TextStyle.short,
-    )
-    sides = discord.ui.TextInput(
-        label="# of sides",
-        default="1",
-        required=True,
-        style=discord.TextStyle.short,
-        max_length=3,
-        min_length=1,
-    )
-
-    async def on_submit(self, interaction: discord.Interaction) -> None:
-        # Verify ints were submitted
-        sides = int(self.sides.value)
-        amount = int(self.amount.value)
-
-        dieLabel = f"{amount}d{sides}"
-        # Prevent conflicts
-        if self.view.dice.get(dieLabel) is not None:
-            return await interaction.response.send_message(f"{dieLabel} already exists")
-
-        self.view.dice[dieLabel] = Die(amount, sides)
-        await interaction.response.defer()
-
-    async def on_error(
-        self, interaction: discord.Interaction, error: Exception
-    ) -> None:
-        if isinstance(error, ValueError):
-            await interaction.response.send_message(
-                "Both values must be intergers.", ephemeral=True
+            code += f"{'x' if multiply else '/'}{self.multiplyDivide.value}"
+        if self.negate:
+            code += "n"
+        type = "".join(c for c in self.type or "" if c.isalnum() or c == "_")
+        if type:
+            code += f"t{type}"
+        return code
+
+    @classmethod
+    def from_code(cls, code: str) -> "Die":
+        """
+        From Code
+
+        Reads a die back from what Die.code wrote.
+
+
+        Args:
+            code (str): The DIE_CODE of the die
+
+        Returns:
+            Die: The die
+
+        Raises:
+            ValueError: When *code* isn't a DIE_CODE
+        """
+        match = DIE_CODE.fullmatch(code)
+        if match is None:
+            raise ValueError(f"{code!r} isn't a die")
+        parts = match.groupdict()
+        die = cls(int(parts["amount"]), int(parts["sides"]), type=parts["type"])
+        if parts["min"] is not None:
+            die.min = int(parts["min"])
+        if parts["max"] is not None:
+            die.max = int(parts["max"])
+        if parts["reroll"] is not None:
+            die.reroll = Reroll(
+                type=SELECTORS[parts["rerollOn"]].value,
+                when=RerollOn(f"r{parts['when']}").value,
+                number=int(parts["reroll"]),
             )
-
-
-class MinMaxModal(ui.Modal, title="Set the Min/Max"):
-    def __init__(self, view: RollBuilder):
-        super().__init__()
-        self.view = view
-        die = view.getCurrentDie()
-        if die is None:
-            raise Exception("Should never happen")
-        self.die = die
-
-    min = discord.ui.TextInput(
-        label="Minimum value",
-        required=False,
-        min_length=1,
-        max_length=3,
-        style=discord.TextStyle.short,
-    )
-    max = discord.ui.TextInput(
-        label="Maximum value",
-        required=False,
-        min_length=1,
-        max_length=3,
-        style=discord.TextStyle.short,
-    )
-
-    async def on_submit(self, interaction: discord.Interaction) -> None:
-        min = self.min.value
-        max = self.max.value
-
-        dieLabel = f"{self.die.amount}d{self.die.sides}"
-
-        if min:
-            min = int(min)
-            self.view.dice[dieLabel].min = min
-        if max:
-            max = int(max)
-            self.view.dice[dieLabel].max = max
-        await interaction.response.defer()
-
-    async def on_error(
-        self, interaction: discord.Interaction, error: Exception
-    ) -> None:
-        if isinstance(error, ValueError):
-            await interaction.response.send_message(
-                "Both values must be intergers", ephemeral=True
+        if parts["keep"] is not None:
+            die.keep = KeepType(
+                type=SELECTORS[parts["keepOn"]].value,
+                number=int(parts["keep"]),
+                dropOrKeep=(
+                    DropOrKeep.keep if parts["dropOrKeep"] == "k" else DropOrKeep.drop
+                ).value,
             )
-
-
-class TypeModal(ui.Modal, title="Set the damage type of the die"):
-    def __init__(self, view: RollBuilder):
-        super().__init__()
-        self.view = view
-        die = view.getCurrentDie()
-        if die is None:
-            raise Exception("Should never happen")
-        self.die = die
-
-    type = discord.ui.TextInput(
-        label="Type", required=True, style=discord.TextStyle.short
-    )
-
-    async def on_submit(self, interaction: discord.Interaction):
-        type = self.type.value
-
-        dieLabel = f"{self.die.amount}d{self.die.sides}"
-
-        self.view.dice[dieLabel].type = type.replace("]", "").replace("[", "")
-        await interaction.response.defer()
-
-
-class NegateModal(ui.Modal, title="Negate the result of the die?"):
-    def __init__(self, view: RollBuilder):
-        super().__init__()
-        self.view = view
-        die = view.getCurrentDie()
-        if die is None:
-            raise Exception("Should never happen")
-        self.die = die
-
-    negate = discord.ui.TextInput(
-        label="Yes or No", required=True, style=discord.TextStyle.short
-    )
-
-    async def on_submit(self, interaction: discord.Interaction) -> None:
-        negate = self.negate.value.lower()
-        if negate in ("yes", "y", "true", "t", "1", "enable", "on"):
-            negate = True
-        elif negate in ("no", "n", "false", "f", "0", "disable", "off"):
-            negate = False
-        else:
-            raise ValueError()
-
-        dieLabel = f"{self.die.amount}d{self.die.sides}"
-
-        self.view.dice[dieLabel].negate = negate
-        await interaction.response.defer()
-
-    async def on_error(
-        self, interaction: discord.Interaction, error: Exception
-    ) -> None:
-        if isinstance(error, ValueError):
-            await interaction.response.send_message(
-                "Your answer must be in the form of a yes/no or a true/false",
-                ephemeral=True,
+        if parts["modifier"] is not None:
+            die.modifier = int(parts["modifier"])
+        if parts["multiplyDivide"] is not None:
+            die.multiplyDivide = MultiplyDivide(
+                value=int(parts["multiplyDivide"]),
+                multiplyOrDivide=(
+                    MultiplyOrDivide.multiply
+                    if parts["multiplyOrDivide"] == "x"
+                    else MultiplyOrDivide.divide
+                ).value,
             )
+        die.negate = parts["negate"] is not None
+        return die
 
 
-class ModifierModal(ui.Modal, title="Set the modifier of the die"):
-    def __init__(self, view: RollBuilder):
-        super().__init__()
-        self.view = view
-        die = view.getCurrentDie()
-        if die is None:
-            raise Exception("Should never happen")
-        self.die = die
-
-    modifier = discord.ui.TextInput(
-        label="Modifer",
-        required=False,
-        min_length=1,
-        max_length=3,
-        style=discord.TextStyle.short,
-    )
-
-    async def on_submit(self, interaction: discord.Interaction) -> None:
-        modifier = int(self.modifier.value)
-
-        dieLabel = f"{self.die.amount}d{self.die.sides}"
-
-        self.view.dice[dieLabel].modifier = modifier
-        await interaction.response.defer()
+class Dice:
+    def __init__(self, dice: list[Die], DC: int | None = None):
+        self.dice = dice
+        self.DC = DC
 
-    async def on_error(
-        self, interaction: discord.Interaction, error: Exception
-    ) -> None:
-        if isinstance(error, ValueError):
-            await interaction.response.send_message(
-                "Value must be an interger", ephemeral=True
-            )
+    def expression(self) -> str:
+        return "(" + ", ".join(str(die) for die in self.dice) + ")"
 
+    def roll(self, seed: int | None = None) -> Rolled:
+        return roll_expression(self.expression(), seed)
 
-class KeepModal(ui.Modal, title="What dice to keep"):
-    def __init__(self, view: RollBuilder):
-        super().__init__()
-        self.view = view
-        die = view.getCurrentDie()
-        if die is None:
-            raise Exception("Should never happen")
-        self.die = die
-
-    selector = discord.ui.TextInput(
-        label="Selector",
-        required=False,
-        style=discord.TextStyle.short,
-        placeholder="lowest | highest | exact | greater | less",
-    )
 
-    number = discord.ui.TextInput(
-        label="Number",
-        required=True,
-        style=discord.TextStyle.short,
-        min_length=1,
-        max_length=3,
-        placeholder="Number for the selector (3 with highest for slector would keep highest 3)",
-    )
+class Parser(d20.Roller):
+    """
+    Parser
 
-    dropKeep = discord.ui.TextInput(
-        label="Drop Or Keep",
-        required=False,
-        style=discord.TextStyle.short,
-        placeholder="drop | keep",
-    )
+    d20's parser without its own cache, which is keyed on the expression with
+    every space taken out, annotations included. compile_expression keeps the
+    parsed trees instead.
+    """
 
-    async def on_submit(self, interaction: discord.Interaction) -> None:
-        try:
-            selector = Selectors(self.selector.value.lower())
-        except ValueError:
-            await interaction.response.send_message(
-                f"{self.selector.value} is not one of the options for `Selectors`",
-                ephemeral=True,
-            )
-            return
-        try:
-            dropKeep = DropOrKeep(self.dropKeep.value.lower())
-        except ValueError:
-            await interaction.response.send_message(
-                f"{self.dropKeep.value} is not one of the options for `Drop Or Keep`",
-                ephemeral=True,
-            )
-            return
-
-        number = int(self.number.value)
-
-        dieLabel = f"{self.die.amount}d{self.die.sides}"
-        keep = KeepType(
-            type=selector.value,
-            number=number,
-            dropOrKeep=dropKeep.value,
-        )
-
-        self.view.dice[dieLabel].keep = keep
-        await interaction.response.defer()
-
-    async def on_error(
-        self, interaction: discord.Interaction, error: Exception
-    ) -> None:
-        if isinstance(error, ValueError):
-            await interaction.response.send_message(
-                "Value must be an interger", ephemeral=True
-            )
+    def _parse_no_comment(self, expr: str) -> d20.ast.Expression:
+        return d20.ast.parser.parse(expr, start="expr")
 
 
-class RerollModal(ui.Modal, title="What to ReRoll on"):
-    def __init__(self, view: RollBuilder):
-        super().__init__()
-        self.view = view
-        die = view.getCurrentDie()
-        if die is None:
-            raise Exception("Should never happen")
-        self.die = die
-
-    selector = discord.ui.TextInput(
-        label="Selector",
-        required=False,
-        style=discord.TextStyle.short,
-        placeholder="lowest | highest | exact | greater | less",
-    )
+parser = Parser()
 
-    number = discord.ui.TextInput(
-        label="Number",
-        required=True,
-        style=discord.TextStyle.short,
-        min_length=1,
-        max_length=3,
-        placeholder="Number for the selector (3 with highest for slector would keep highest 3)",
-    )
 
-    rerollOn = discord.ui.TextInput(
-        label="What to reroll on",
-        required=True,
-        style=discord.TextStyle.short,
-        placeholder="rr (Reroll untill gone) | ro (reroll once) | ra (reroll and add original)",
+def expression_key(expression: str) -> str:
+    """An expression without the whitespace that doesn't change it, annotations are kept as written"""
+    parts = ANNOTATION.split(expression)
+    return "".join(
+        part if index % 2 else "".join(part.split()) for index, part in enumerate(parts)
     )
 
-    async def on_submit(self, interaction: discord.Interaction, /) -> None:
-        try:
-            selector = Selectors(self.selector.value.lower())
-        except ValueError:
-            await interaction.response.send_message(
-                f"{self.selector.value} is not one of the options for `Selectors`",
-                ephemeral=True,
-            )
-            return
-        try:
-            rerollOn = RerollOn(self.rerollOn.value.lower())
-        except ValueError:
-            await interaction.response.send_message(
-                f"{self.rerollOn.value} is not one of the options for `Drop Or Keep`",
-                ephemeral=True,
-            )
-            return
 
-        number = int(self.number.value)
-        dieLabel = f"{self.die.amount}d{self.die.sides}"
+def compile_expression(expression: str) -> d20.ast.Expression:
+    """
+    Compile Expression
 
-        reroll = Reroll(type=selector.value, when=rerollOn.value, number=number)
-        self.view.dice[dieLabel].reroll = reroll
-        await interaction.response.defer()
+    Parses a dice expression, reusing the tree from an earlier parse of the same
+    expression when there is one.
 
-    async def on_error(
-        self, interaction: discord.Interaction, error: Exception
-    ) -> None:
-        if isinstance(error, ValueError):
-            await interaction.response.send_message(
-                "Value must be an interger", ephemeral=True
-            )
 
+    Args:
+        expression (str): The dice expression
 
-class MultiplyDivideModal(ui.Modal, title="Multiply or Divide"):
-    def __init__(self, view: RollBuilder):
-        super().__init__()
-        self.view = view
-        die = view.getCurrentDie()
-        if die is None:
-            raise Exception("Should never happen")
-        self.die = die
-
-    number = discord.ui.TextInput(
-        label="Number",
-        required=True,
-        style=discord.TextStyle.short,
-        min_length=1,
-        max_length=3,
-    )
+    Returns:
+        d20.ast.Expression: The parsed expression, which d20 can roll directly
+    """
+    key = expression_key(expression)
+    found, tree = expressions.get(key)
+    if not found:
+        tree = parser.parse(expression)
+        expressions.put(key, tree)
+    return tree  # type: ignore
 
-    multiplyDivide = discord.ui.TextInput(
-        label="Multiply or Divide",
-        required=True,
-        style=discord.TextStyle.short,
-        placeholder="multiply | Divide",
-    )
 
-    async def on_submit(self, interaction: discord.Interaction, /) -> None:
-        number = int(self.number.value)
-        try:
-            multiplyDivide = MultiplyOrDivide(self.multiplyDivide.value.lower())
-        except ValueError:
-            await interaction.response.send_message(
-                f"{self.multiplyDivide.value} is not one of the options for `Multiply or Divide`",
-                ephemeral=True,
-            )
-            return
-        dieLabel = f"{self.die.amount}d{self.die.sides}"
-        multiplyOrDivide = MultiplyDivide(
-            value=number, multiplyOrDivide=multiplyDivide.value
-        )
-        self.view.dice[dieLabel].multiplyDivide = multiplyOrDivide
-        await interaction.response.defer()
+def roll_expression(expression: str, seed: int | None = None) -> Rolled:
+    return roll(compile_expression(expression), seed)
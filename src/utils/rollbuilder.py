@@ -0,0 +1,714 @@
+import asyncio
+import base64
+import hashlib
+from typing import Any, Callable, NamedTuple
+
+import d20
+import discord
+from discord import ui
+
+from utils.cost import check
+from utils.errors import BadRoll, OddsUnsupported, PoolSaturated
+from utils.history import history
+from utils.macros import MAX_NAME_LENGTH, USER, macros, validate
+from utils.odds import odds_embed
+from utils.pools import is_large, pool_embed, record_pool, roll_pool
+from utils.rng import seed_footer
+from utils.roll import (
+    Dice,
+    Die,
+    DropOrKeep,
+    KeepType,
+    MultiplyDivide,
+    MultiplyOrDivide,
+    Reroll,
+    RerollOn,
+    Selectors,
+    roll_expression,
+)
+from utils.simulate import work_out_odds
+
+# Discord allows 100 characters in a custom_id, "rb:" and the action take up to 8
+MAX_STATE_LENGTH = 92
+
+# The select shows at most 25 options and one of them is "New"
+MAX_DICE = 24
+
+BUTTONS = {
+    "min": "Set min/max",
+    "mod": "Set modifier",
+    "keep": "Set Keeps",
+    "rer": "Set Reroll",
+    "mul": "Multiply/Divide",
+    "roll": "Roll",
+    "odds": "Odds",
+    "save": "Save macro",
+}
+
+# Buttons that change the selected die
+EDITS = ("min", "mod", "keep", "rer", "mul")
+
+EXPIRED = "This roll builder has expired, start a new one with /complexroll."
+
+
+class BuilderState(NamedTuple):
+    dice: list[Die]
+    selected: int | None
+
+    @property
+    def die(self) -> Die | None:
+        return None if self.selected is None else self.dice[self.selected]
+
+    def labels(self) -> list[str]:
+        return [label(die) for die in self.dice]
+
+    def encode(self) -> str:
+        selected = "" if self.selected is None else str(self.selected)
+        return selected + "~" + ",".join(die.code() for die in self.dice)
+
+    @classmethod
+    def decode(cls, text: str) -> "BuilderState":
+        selected, _, codes = text.partition("~")
+        dice = [Die.from_code(code) for code in codes.split(",") if code]
+        index = int(selected) if selected else None
+        return cls(
+            dice, index if index is not None and 0 <= index < len(dice) else None
+        )
+
+
+def label(die: Die) -> str:
+    return f"{die.amount}d{die.sides}"
+
+
+async def save_state(state: BuilderState) -> str:
+    """
+    Save State
+
+    The state itself when it fits in a custom_id. Longer states are kept in
+    the macros file, so they survive restarts too, and their key goes in the
+    custom_id instead.
+
+
+    Args:
+        state (BuilderState): The dice and which one is being edited
+
+    Returns:
+        str: What to put in the custom_id
+    """
+    text = state.encode()
+    if len(text) <= MAX_STATE_LENGTH:
+        return text
+    digest = hashlib.blake2b(text.encode(), digest_size=12).digest()
+    key = "@" + base64.urlsafe_b64encode(digest).decode()
+    await macros.save_state(key, text)
+    return key
+
+
+async def load_state(reference: str) -> BuilderState | None:
+    """The state save_state gave *reference* for, None once it has expired"""
+    text: str | None = reference
+    if reference.startswith("@"):
+        text = await macros.load_state(reference)
+        if text is None:
+            return None
+    try:
+        return BuilderState.decode(text)  # type: ignore
+    except ValueError:
+        return None
+
+
+async def builder_view(state: BuilderState) -> ui.View:
+    """
+    Builder View
+
+    The select and buttons of a roll builder, every one of them carrying the
+    state in its custom_id. The view is stopped before it is sent so
+    discord.py never holds on to it, BuilderSelect and BuilderButton answer
+    its components instead.
+
+
+    Args:
+        state (BuilderState): The dice and which one is being edited
+
+    Returns:
+        ui.View: The components to send
+    """
+    reference = await save_state(state)
+    view = ui.View(timeout=None)
+    view.add_item(BuilderSelect(reference, state))
+    for action in BUTTONS:
+        view.add_item(
+            BuilderButton(
+                action, reference, disabled=action in EDITS and state.die is None
+            )
+        )
+    view.stop()
+    return view
+
+
+def builder_embed(
+    interaction: discord.Interaction, state: BuilderState
+) -> discord.Embed:
+    # Keeps the title and author /complexroll gave the message
+    message = interaction.message
+    embed = (
+        message.embeds[0] if message and message.embeds else discord.Embed(title="Dice")
+    )
+    embed.clear_fields().description = ", ".join(state.labels()) or None
+    if state.die is not None:
+        embed.add_field(name="Currently Editing", value=label(state.die))
+    return embed
+
+
+async def update(interaction: discord.Interaction, state: BuilderState) -> None:
+    await interaction.response.edit_message(
+        embed=builder_embed(interaction, state), view=await builder_view(state)
+    )
+
+
+class BuilderSelect(
+    ui.DynamicItem[ui.Select], template=r"rb:sel:(?P<state>.+)"  # type: ignore
+):
+    def __init__(self, reference: str, state: BuilderState | None = None) -> None:
+        options = [
+            discord.SelectOption(label="New", description="Add a new die", emoji="🆕")
+        ]
+        if state is not None:
+            for index, dieLabel in enumerate(state.labels()):
+                options.append(
+                    discord.SelectOption(
+                        label=dieLabel,
+                        value=str(index),
+                        emoji="🎲",
+                        default=index == state.selected,
+                    )
+                )
+        super().__init__(
+            ui.Select(
+                options=options,
+                min_values=1,
+                max_values=1,
+                placeholder="Pick a die to edit",
+                custom_id=f"rb:sel:{reference}",
+            ),
+            row=0,
+        )
+        self.reference = reference
+
+    @classmethod
+    async def from_custom_id(
+        cls, interaction: discord.Interaction, item: ui.Item[Any], match: Any
+    ) -> "BuilderSelect":
+        return cls(match["state"])
+
+    async def callback(self, interaction: discord.Interaction) -> None:
+        state = await load_state(self.reference)
+        if state is None:
+            return await interaction.response.send_message(EXPIRED, ephemeral=True)
+        value = self.item.values[0]
+        if value == "New":
+            return await interaction.response.send_modal(NewDieModal(state))
+        await update(interaction, state._replace(selected=int(value)))
+
+
+class BuilderButton(
+    ui.DynamicItem[ui.Button],  # type: ignore
+    template=r"rb:(?P<action>min|mod|keep|rer|mul|roll|odds|save):(?P<state>.+)",
+):
+    def __init__(self, action: str, reference: str, disabled: bool = False) -> None:
+        super().__init__(
+            ui.Button(
+                label=BUTTONS[action],
+                style=(
+                    discord.ButtonStyle.green
+                    if action == "roll"
+                    else discord.ButtonStyle.secondary
+                ),
+                custom_id=f"rb:{action}:{reference}",
+                disabled=disabled,
+            )
+        )
+        self.action = action
+        self.reference = reference
+
+    @classmethod
+    async def from_custom_id(
+        cls, interaction: discord.Interaction, item: ui.Item[Any], match: Any
+    ) -> "BuilderButton":
+        return cls(match["action"], match["state"])
+
+    async def callback(self, interaction: discord.Interaction) -> None:
+        state = await load_state(self.reference)
+        if state is None:
+            return await interaction.response.send_message(EXPIRED, ephemeral=True)
+        match self.action:
+            case "roll":
+                await self.roll(interaction, state)
+            case "odds":
+                await self.odds(interaction, state)
+            case "save" if state.dice:
+                await interaction.response.send_modal(SaveMacroModal(state))
+            case "save":
+                await interaction.response.send_message(
+                    content="No dice to save!", ephemeral=True
+                )
+            case action:
+                if state.die is None:
+                    return await interaction.response.send_message(
+                        content="Pick a die to edit first.", ephemeral=True
+                    )
+                await interaction.response.send_modal(MODALS[action](state))
+
+    async def roll(self, interaction: discord.Interaction, state: BuilderState) -> None:
+        if len(state.dice) <= 0:
+            return await interaction.response.send_message(
+                content="No dice to roll!", ephemeral=True
+            )
+        try:
+            expression = Dice(state.dice).expression()
+            cost = check(expression)
+            large = is_large(expression)
+            if cost.inline:
+                rolled = (roll_pool if large else roll_expression)(expression)
+            else:
+                # Big rolls take d20 a while, keep them off the event loop
+                rolled = await interaction.client.workers.submit(  # type: ignore
+                    roll_pool if large else roll_expression,
+                    expression,
+                    kind="process",
+                    timeout=2.0,
+                )
+        except d20.RollError as error:
+            return await interaction.response.send_message(
+                content=f"That roll can't be made: {error}", ephemeral=True
+            )
+        except BadRoll as error:
+            return await interaction.response.send_message(
+                content=error.message, ephemeral=True
+            )
+        except PoolSaturated:
+            return await interaction.response.send_message(
+                content="Too many rolls at once, try again in a moment.",
+                ephemeral=True,
+            )
+        except asyncio.TimeoutError:
+            return await interaction.response.send_message(
+                content="That roll is too big to finish in time.", ephemeral=True
+            )
+        if large:
+            record_pool(interaction.user.id, interaction.channel_id, expression, rolled)
+            embed = pool_embed("Roll", expression, rolled)
+        else:
+            history.record(
+                interaction.user.id, interaction.channel_id, expression, rolled.result
+            )
+            embed = discord.Embed(title="Roll", description=str(rolled.result))
+        embed.set_author(
+            name=interaction.user.__str__(),
+            icon_url=interaction.user.avatar.url if interaction.user.avatar else None,
+        )
+        if rolled.seed is not None:
+            embed.set_footer(text=seed_footer(expression, rolled.seed))
+        await interaction.response.send_message(embed=embed)
+
+    async def odds(self, interaction: discord.Interaction, state: BuilderState) -> None:
+        if len(state.dice) <= 0:
+            return await interaction.response.send_message(
+                content="No dice to work out the odds of!", ephemeral=True
+            )
+        try:
+            expression = Dice(state.dice).expression()
+            check(expression)
+            odds, samples = await work_out_odds(
+                expression, interaction.client.workers  # type: ignore
+            )
+        except BadRoll as error:
+            return await interaction.response.send_message(
+                content=error.message, ephemeral=True
+            )
+        except OddsUnsupported as error:
+            return await interaction.response.send_message(
+                content=f"Can't work out the odds: {error.reason}", ephemeral=True
+            )
+        await interaction.response.send_message(
+            embed=odds_embed(expression, odds, samples, None), ephemeral=True
+        )
+
+
+class NewDieModal(ui.Modal, title="New Die"):
+    def __init__(self, state: BuilderState):
+        super().__init__()
+        self.state = state
+
+    amount = discord.ui.TextInput(
+        label="# of dice",
+        default="1",
+        min_length=1,
+        max_length=4,
+        required=True,
+        style=discord.TextStyle.short,
+    )
+    sides = discord.ui.TextInput(
+        label="# of sides",
+        default="1",
+        required=True,
+        style=discord.TextStyle.short,
+        max_length=3,
+        min_length=1,
+    )
+
+    async def on_submit(self, interaction: discord.Interaction) -> None:
+        # Verify ints were submitted
+        sides = int(self.sides.value)
+        amount = int(self.amount.value)
+
+        dieLabel = f"{amount}d{sides}"
+        # Prevent conflicts
+        if dieLabel in self.state.labels():
+            return await interaction.response.send_message(f"{dieLabel} already exists")
+        if len(self.state.dice) >= MAX_DICE:
+            return await interaction.response.send_message(
+                f"A roll can have at most {MAX_DICE} dice", ephemeral=True
+            )
+
+        dice = [*self.state.dice, Die(amount, sides)]
+        await update(interaction, BuilderState(dice, len(dice) - 1))
+
+    async def on_error(
+        self, interaction: discord.Interaction, error: Exception
+    ) -> None:
+        if isinstance(error, ValueError):
+            await interaction.response.send_message(
+                "Both values must be intergers.", ephemeral=True
+            )
+
+
+class MinMaxModal(ui.Modal, title="Set the Min/Max"):
+    def __init__(self, state: BuilderState):
+        super().__init__()
+        self.state = state
+
+    min = discord.ui.TextInput(
+        label="Minimum value",
+        required=False,
+        min_length=1,
+        max_length=3,
+        style=discord.TextStyle.short,
+    )
+    max = discord.ui.TextInput(
+        label="Maximum value",
+        required=False,
+        min_length=1,
+        max_length=3,
+        style=discord.TextStyle.short,
+    )
+
+    async def on_submit(self, interaction: discord.Interaction) -> None:
+        min = self.min.value
+        max = self.max.value
+
+        die: Die = self.state.die  # type: ignore
+        if min:
+            die.min = int(min)
+        if max:
+            die.max = int(max)
+        await update(interaction, self.state)
+
+    async def on_error(
+        self, interaction: discord.Interaction, error: Exception
+    ) -> None:
+        if isinstance(error, ValueError):
+            await interaction.response.send_message(
+                "Both values must be intergers", ephemeral=True
+            )
+
+
+class TypeModal(ui.Modal, title="Set the damage type of the die"):
+    def __init__(self, state: BuilderState):
+        super().__init__()
+        self.state = state
+
+    type = discord.ui.TextInput(
+        label="Type", required=True, style=discord.TextStyle.short
+    )
+
+    async def on_submit(self, interaction: discord.Interaction):
+        type = self.type.value
+
+        self.state.die.type = type.replace("]", "").replace("[", "")  # type: ignore
+        await update(interaction, self.state)
+
+
+class NegateModal(ui.Modal, title="Negate the result of the die?"):
+    def __init__(self, state: BuilderState):
+        super().__init__()
+        self.state = state
+
+    negate = discord.ui.TextInput(
+        label="Yes or No", required=True, style=discord.TextStyle.short
+    )
+
+    async def on_submit(self, interaction: discord.Interaction) -> None:
+        negate = self.negate.value.lower()
+        if negate in ("yes", "y", "true", "t", "1", "enable", "on"):
+            negate = True
+        elif negate in ("no", "n", "false", "f", "0", "disable", "off"):
+            negate = False
+        else:
+            raise ValueError()
+
+        self.state.die.negate = negate  # type: ignore
+        await update(interaction, self.state)
+
+    async def on_error(
+        self, interaction: discord.Interaction, error: Exception
+    ) -> None:
+        if isinstance(error, ValueError):
+            await interaction.response.send_message(
+                "Your answer must be in the form of a yes/no or a true/false",
+                ephemeral=True,
+            )
+
+
+class ModifierModal(ui.Modal, title="Set the modifier of the die"):
+    def __init__(self, state: BuilderState):
+        super().__init__()
+        self.state = state
+
+    modifier = discord.ui.TextInput(
+        label="Modifer",
+        required=False,
+        min_length=1,
+        max_length=3,
+        style=discord.TextStyle.short,
+    )
+
+    async def on_submit(self, interaction: discord.Interaction) -> None:
+        modifier = int(self.modifier.value)
+
+        self.state.die.modifier = modifier  # type: ignore
+        await update(interaction, self.state)
+
+    async def on_error(
+        self, interaction: discord.Interaction, error: Exception
+    ) -> None:
+        if isinstance(error, ValueError):
+            await interaction.response.send_message(
+                "Value must be an interger", ephemeral=True
+            )
+
+
+class KeepModal(ui.Modal, title="What dice to keep"):
+    def __init__(self, state: BuilderState):
+        super().__init__()
+        self.state = state
+
+    selector = discord.ui.TextInput(
+        label="Selector",
+        required=False,
+        style=discord.TextStyle.short,
+        placeholder="lowest | highest | exact | greater | less",
+    )
+
+    number = discord.ui.TextInput(
+        label="Number",
+        required=True,
+        style=discord.TextStyle.short,
+        min_length=1,
+        max_length=3,
+        placeholder="Number for the selector (3 with highest for slector would keep highest 3)",
+    )
+
+    dropKeep = discord.ui.TextInput(
+        label="Drop Or Keep",
+        required=False,
+        style=discord.TextStyle.short,
+        placeholder="drop | keep",
+    )
+
+    async def on_submit(self, interaction: discord.Interaction) -> None:
+        try:
+            selector = Selectors(self.selector.value.lower())
+        except ValueError:
+            await interaction.response.send_message(
+                f"{self.selector.value} is not one of the options for `Selectors`",
+                ephemeral=True,
+            )
+            return
+        try:
+            dropKeep = DropOrKeep(self.dropKeep.value.lower())
+        except ValueError:
+            await interaction.response.send_message(
+                f"{self.dropKeep.value} is not one of the options for `Drop Or Keep`",
+                ephemeral=True,
+            )
+            return
+
+        number = int(self.number.value)
+
+        keep = KeepType(
+            type=selector.value,
+            number=number,
+            dropOrKeep=dropKeep.value,
+        )
+
+        self.state.die.keep = keep  # type: ignore
+        await update(interaction, self.state)
+
+    async def on_error(
+        self, interaction: discord.Interaction, error: Exception
+    ) -> None:
+        if isinstance(error, ValueError):
+            await interaction.response.send_message(
+                "Value must be an interger", ephemeral=True
+            )
+
+
+class RerollModal(ui.Modal, title="What to ReRoll on"):
+    def __init__(self, state: BuilderState):
+        super().__init__()
+        self.state = state
+
+    selector = discord.ui.TextInput(
+        label="Selector",
+        required=False,
+        style=discord.TextStyle.short,
+        placeholder="lowest | highest | exact | greater | less",
+    )
+
+    number = discord.ui.TextInput(
+        label="Number",
+        required=True,
+        style=discord.TextStyle.short,
+        min_length=1,
+        max_length=3,
+        placeholder="Number for the selector (3 with highest for slector would keep highest 3)",
+    )
+
+    rerollOn = discord.ui.TextInput(
+        label="What to reroll on",
+        required=True,
+        style=discord.TextStyle.short,
+        placeholder="rr (Reroll untill gone) | ro (reroll once) | ra (reroll and add original)",
+    )
+
+    async def on_submit(self, interaction: discord.Interaction, /) -> None:
+        try:
+            selector = Selectors(self.selector.value.lower())
+        except ValueError:
+            await interaction.response.send_message(
+                f"{self.selector.value} is not one of the options for `Selectors`",
+                ephemeral=True,
+            )
+            return
+        try:
+            rerollOn = RerollOn(self.rerollOn.value.lower())
+        except ValueError:
+            await interaction.response.send_message(
+                f"{self.rerollOn.value} is not one of the options for `Drop Or Keep`",
+                ephemeral=True,
+            )
+            return
+
+        number = int(self.number.value)
+
+        reroll = Reroll(type=selector.value, when=rerollOn.value, number=number)
+        self.state.die.reroll = reroll  # type: ignore
+        # Catch a reroll that never ends now rather than when the dice are rolled
+        try:
+            check(Dice(self.state.dice).expression())
+        except BadRoll as error:
+            return await interaction.response.send_message(
+                error.message, ephemeral=True
+            )
+        await update(interaction, self.state)
+
+    async def on_error(
+        self, interaction: discord.Interaction, error: Exception
+    ) -> None:
+        if isinstance(error, ValueError):
+            await interaction.response.send_message(
+                "Value must be an interger", ephemeral=True
+            )
+
+
+class MultiplyDivideModal(ui.Modal, title="Multiply or Divide"):
+    def __init__(self, state: BuilderState):
+        super().__init__()
+        self.state = state
+
+    number = discord.ui.TextInput(
+        label="Number",
+        required=True,
+        style=discord.TextStyle.short,
+        min_length=1,
+        max_length=3,
+    )
+
+    multiplyDivide = discord.ui.TextInput(
+        label="Multiply or Divide",
+        required=True,
+        style=discord.TextStyle.short,
+        placeholder="multiply | Divide",
+    )
+
+    async def on_submit(self, interaction: discord.Interaction, /) -> None:
+        number = int(self.number.value)
+        try:
+            multiplyDivide = MultiplyOrDivide(self.multiplyDivide.value.lower())
+        except ValueError:
+            await interaction.response.send_message(
+                f"{self.multiplyDivide.value} is not one of the options for `Multiply or Divide`",
+                ephemeral=True,
+            )
+            return
+        multiplyOrDivide = MultiplyDivide(
+            value=number, multiplyOrDivide=multiplyDivide.value
+        )
+        self.state.die.multiplyDivide = multiplyOrDivide  # type: ignore
+        await update(interaction, self.state)
+
+
+class SaveMacroModal(ui.Modal, title="Save as a macro"):
+    def __init__(self, state: BuilderState):
+        super().__init__()
+        self.state = state
+
+    name = discord.ui.TextInput(
+        label="Name",
+        required=True,
+        style=discord.TextStyle.short,
+        min_length=1,
+        max_length=MAX_NAME_LENGTH,
+        placeholder="Run it with /macro run",
+    )
+
+    async def on_submit(self, interaction: discord.Interaction) -> None:
+        try:
+            expression = await validate(
+                Dice(self.state.dice).expression(), interaction.client.workers  # type: ignore
+            )
+            await macros.save(
+                USER,
+                interaction.user.id,
+                self.name.value,
+                expression,
+                interaction.user.id,
+            )
+        except BadRoll as error:
+            return await interaction.response.send_message(
+                content=error.message, ephemeral=True
+            )
+        await interaction.response.send_message(
+            f"Saved `{expression}` as **{self.name.value}**, roll it with `/macro run`.",
+            ephemeral=True,
+        )
+
+
+MODALS: dict[str, Callable[[BuilderState], ui.Modal]] = {
+    "min": MinMaxModal,
+    "mod": ModifierModal,
+    "keep": KeepModal,
+    "rer": RerollModal,
+    "mul": MultiplyDivideModal,
+}
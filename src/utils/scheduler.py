@@ -0,0 +1,184 @@
+import asyncio
+import logging
+import random
+import time
+from typing import Any, Awaitable, Callable
+
+from utils.metrics import metrics
+
+log = logging.getLogger("scheduler")
+
+
+class Job:
+    """
+    Job
+
+    A named coroutine function run after *delay* seconds and then every
+    *interval* seconds, or just once when there is no interval. Each wait is
+    stretched by up to *jitter* seconds so jobs started together drift apart.
+    A run that would start while the previous one is still going is skipped.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        func: Callable[[], Awaitable[Any]],
+        interval: float | None,
+        delay: float,
+        jitter: float,
+        owner: str,
+    ) -> None:
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.delay = delay
+        self.jitter = jitter
+        self.owner = owner
+        self.runs = 0
+        self.failures = 0
+        self.skipped = 0
+        self.lastDuration: float | None = None
+        self.running: asyncio.Task | None = None
+        self.task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        self.task = asyncio.create_task(self.schedule(), name=f"scheduler-{self.name}")
+
+    def cancel(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+        if self.running is not None:
+            self.running.cancel()
+
+    def wait(self, seconds: float) -> Awaitable[None]:
+        return asyncio.sleep(seconds + random.uniform(0, self.jitter))
+
+    async def schedule(self) -> None:
+        await self.wait(self.delay)
+        while True:
+            if self.running is not None and not self.running.done():
+                self.skipped += 1
+                metrics.incr(f"scheduler.{self.name}.skipped")
+                log.warning("%s is still running, skipped a run", self.name)
+            else:
+                self.running = asyncio.create_task(self.run())
+            if self.interval is None:
+                await self.running
+                return
+            await self.wait(self.interval)
+
+    async def run(self) -> None:
+        started = time.perf_counter()
+        try:
+            await self.func()
+        except Exception:
+            self.failures += 1
+            metrics.incr(f"scheduler.{self.name}.failures")
+            log.exception("%s failed", self.name)
+        finally:
+            self.runs += 1
+            self.lastDuration = time.perf_counter() - started
+            metrics.observe(f"scheduler.{self.name}", self.lastDuration)
+
+
+class Scheduler:
+    """
+    Scheduler
+
+    Runs the bot's periodic and delayed jobs. Jobs belong to the module of the
+    function they run, which for a cog method is its extension, so the client
+    can cancel them when that extension is unloaded or reloaded.
+    """
+
+    def __init__(self) -> None:
+        self.jobs: dict[str, Job] = {}
+
+    def every(
+        self,
+        name: str,
+        interval: float,
+        func: Callable[[], Awaitable[Any]],
+        *,
+        delay: float | None = None,
+        jitter: float = 0.0,
+    ) -> Job:
+        """
+        Every
+
+        Runs *func* every *interval* seconds, first after *delay* seconds which
+        defaults to the interval. Replaces any job already called *name*.
+
+
+        Args:
+            name (str): Unique name of the job, used in logs and metrics
+            interval (float): Seconds between the starts of two runs
+            func (Callable): Coroutine function taking no arguments
+            delay (float): Seconds before the first run
+            jitter (float): Up to how many seconds to add to every wait
+
+        Returns:
+            Job: The scheduled job
+        """
+        return self.add(
+            Job(
+                name,
+                func,
+                interval,
+                interval if delay is None else delay,
+                jitter,
+                func.__module__,
+            )
+        )
+
+    def once(
+        self,
+        name: str,
+        delay: float,
+        func: Callable[[], Awaitable[Any]],
+        *,
+        jitter: float = 0.0,
+    ) -> Job:
+        """Runs *func* once after *delay* seconds, replacing any job called *name*"""
+        return self.add(Job(name, func, None, delay, jitter, func.__module__))
+
+    def add(self, job: Job) -> Job:
+        self.cancel(job.name)
+        self.jobs[job.name] = job
+        job.start()
+        if job.interval is None:
+            job.task.add_done_callback(lambda _: self.forget(job))  # type: ignore
+        return job
+
+    def forget(self, job: Job) -> None:
+        if self.jobs.get(job.name) is job:
+            del self.jobs[job.name]
+
+    def cancel(self, name: str) -> None:
+        job = self.jobs.pop(name, None)
+        if job is not None:
+            job.cancel()
+
+    def cancel_owner(self, owner: str) -> None:
+        """Cancels every job whose function lives in the module *owner* or below it"""
+        for job in list(self.jobs.values()):
+            if job.owner == owner or job.owner.startswith(f"{owner}."):
+                self.cancel(job.name)
+
+    def close(self) -> None:
+        for name in list(self.jobs):
+            self.cancel(name)
+
+    def stats(self) -> list[dict[str, Any]]:
+        return [
+            {
+                "name": job.name,
+                "interval": job.interval,
+                "runs": job.runs,
+                "failures": job.failures,
+                "skipped": job.skipped,
+                "last_ms": (
+                    None if job.lastDuration is None else job.lastDuration * 1000
+                ),
+            }
+            for job in self.jobs.values()
+        ]
@@ -1,13 +1,26 @@
+import asyncio
 import json
 
 from discord import Message
 
+from utils.singleflight import SingleFlight
 
-def get_prefix(_, message: Message) -> str:
+# Every message asks for its prefix, keep the parsed file for a while
+settingsFlight: SingleFlight[dict[str, str]] = SingleFlight("settings", ttl=30.0)
+
+
+def load_prefixes() -> dict[str, str]:
+    with open("settings.json", "r") as f:
+        return json.load(f)["prefixes"]
+
+
+async def get_prefix(_, message: Message) -> str:
     """
     Get Prefix
 
-    Obtains the prefix for the server of the message.
+    Obtains the prefix for the server of the message. settings.json is read
+    off the event loop at most once every 30 seconds, so edits to it take
+    effect within that time.
 
 
     Args:
@@ -16,8 +29,9 @@ def get_prefix(_, message: Message) -> str:
     Returns:
         str: The server's prefix.
     """
-    with open("settings.json", "r") as f:
-        prefixes = json.load(f)["prefixes"]
+    prefixes = await settingsFlight.do(
+        "prefixes", lambda: asyncio.to_thread(load_prefixes)
+    )
 
     if message.guild:
         try:
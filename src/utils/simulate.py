@@ -0,0 +1,367 @@
+import asyncio
+import math
+import time
+from typing import Any, NamedTuple
+
+import d20
+import numpy as np
+
+from utils.errors import OddsUnsupported, PoolSaturated
+from utils.odds import OPERATORS, Distribution, expression_odds
+from utils.rng import generator
+from utils.roll import compile_expression, expression_key
+from utils.singleflight import SingleFlight
+
+# Rolls simulated per pass, enough to amortise NumPy's overhead without much memory
+BATCH = 100_000
+
+# Fewest rolls to simulate before checking whether the estimate has settled
+MIN_SAMPLES = 20_000
+
+# d20 gives up on a roll that needs more dice than this, so does the simulation
+MAX_ROLLS = 1000
+
+# z score of a 95% confidence interval
+Z = 1.96
+
+
+class Estimate(NamedTuple):
+    distribution: Distribution
+    samples: int
+    converged: bool
+
+
+class Pool:
+    """
+    Pool
+
+    The same set of dice or values rolled in every simulated roll at once, a
+    row per roll and a column per die. Dice that were dropped, or were never
+    rolled in that row, are not *kept* and count as 0. Every face drawn is
+    added to *thrown* when it is given.
+    """
+
+    def __init__(
+        self,
+        values: np.ndarray,
+        size: int | str | None = None,
+        thrown: list[tuple[int | str, np.ndarray]] | None = None,
+    ) -> None:
+        self.values = values
+        self.kept = np.ones(values.shape, dtype=bool)
+        self.size = size
+        self.thrown = thrown
+        # Counted from the dice the pool starts with, so big pools can still explode
+        self.maxDice = values.shape[1] + MAX_ROLLS
+
+    def draw(self, rng: np.random.Generator, shape: tuple[int, ...]) -> np.ndarray:
+        # Drawing 32 bit faces is almost twice as fast as the default 64 bit ones
+        if self.size == "%":
+            faces = rng.integers(0, 10, shape, dtype=np.int32) * 10.0
+        else:
+            faces = rng.integers(1, int(self.size) + 1, shape, dtype=np.int32).astype(float)  # type: ignore
+        if self.thrown is not None:
+            self.thrown.append((self.size, faces))  # type: ignore
+        return faces
+
+    def select(self, selectors: list[Any]) -> np.ndarray:
+        selected = np.zeros(self.values.shape, dtype=bool)
+        for selector in selectors:
+            match selector.cat:
+                case None:
+                    selected |= self.values == selector.num
+                case "<":
+                    selected |= self.values < selector.num
+                case ">":
+                    selected |= self.values > selector.num
+                case "h" | "l":
+                    selected |= self.extreme(selector.cat == "h", selector.num)
+        return selected & self.kept
+
+    def extreme(self, highest: bool, count: int) -> np.ndarray:
+        """The *count* highest or lowest kept dice of every row"""
+        columns = self.values.shape[1]
+        if count >= columns:
+            return self.kept.copy()
+        selected = np.zeros(self.values.shape, dtype=bool)
+        if count <= 0:
+            return selected
+        # Dropped dice sort last, ties between equal faces don't change totals
+        keys = np.where(self.kept, self.values, -np.inf if highest else np.inf)
+        order = np.argpartition(-keys if highest else keys, count - 1, axis=1)
+        np.put_along_axis(selected, order[:, :count], True, axis=1)
+        return selected
+
+    def add(self, values: np.ndarray, kept: np.ndarray) -> None:
+        self.values = np.concatenate([self.values, values], axis=1)
+        self.kept = np.concatenate([self.kept, kept], axis=1)
+
+    def apply(self, operation: Any, rng: np.random.Generator) -> None:
+        op = operation.op
+        if self.size is None and op not in ("k", "p"):
+            raise OddsUnsupported(f"The {op} operator only works on dice")
+        match op:
+            case "k":
+                self.kept &= self.select(operation.sels)
+            case "p":
+                self.kept &= ~self.select(operation.sels)
+            case "mi" | "ma":
+                bound = operation.sels[-1].num
+                clamp = np.maximum if op == "mi" else np.minimum
+                self.values = np.where(
+                    self.kept, clamp(self.values, bound), self.values
+                )
+            case "ro":
+                selected = self.select(operation.sels)
+                self.values[selected] = self.draw(rng, (int(selected.sum()),))
+            case "rr":
+                selected = self.select(operation.sels)
+                for _ in range(MAX_ROLLS):
+                    if not selected.any():
+                        return
+                    self.values[selected] = self.draw(rng, (int(selected.sum()),))
+                    selected = self.select(operation.sels)
+                raise OddsUnsupported("Rerolling never ends")
+            case "ra":
+                # Only the first matching die gets another, so at most one per row
+                exploding = self.select(operation.sels).any(axis=1)
+                if not exploding.any():
+                    return
+                self.add(self.draw(rng, (len(exploding), 1)), exploding[:, None])
+            case "e":
+                exploded = np.zeros(self.values.shape, dtype=bool)
+                for _ in range(MAX_ROLLS):
+                    exploding = self.select(operation.sels) & ~exploded
+                    counts = exploding.sum(axis=1)
+                    if not counts.any():
+                        return
+                    columns = int(counts.max())
+                    kept = np.arange(columns)[None, :] < counts[:, None]
+                    exploded = np.concatenate(
+                        [exploded | exploding, np.zeros_like(kept)], axis=1
+                    )
+                    self.add(self.draw(rng, kept.shape), kept)
+                raise OddsUnsupported("Exploding never ends")
+            case _:
+                raise OddsUnsupported(f"The {op} operator isn't supported")
+        if self.values.shape[1] > self.maxDice:
+            raise OddsUnsupported(f"A roll needs more than {self.maxDice} dice")
+
+    def total(self) -> np.ndarray:
+        return np.where(self.kept, self.values, 0.0).sum(axis=1)
+
+
+def sample(
+    node: Any,
+    count: int,
+    rng: np.random.Generator,
+    thrown: list[tuple[int | str, np.ndarray]] | None = None,
+) -> np.ndarray:
+    """*count* simulated totals of a d20 syntax tree node, the faces drawn go in *thrown*"""
+    match node:
+        case d20.ast.Expression():
+            return sample(node.roll, count, rng, thrown)
+        case d20.ast.Parenthetical() | d20.ast.AnnotatedNumber():
+            return sample(node.value, count, rng, thrown)
+        case d20.ast.Literal():
+            return np.full(count, float(node.value))
+        case d20.ast.UnOp():
+            value = sample(node.value, count, rng, thrown)
+            return -value if node.op == "-" else value
+        case d20.ast.BinOp():
+            left = sample(node.left, count, rng, thrown)
+            right = sample(node.right, count, rng, thrown)
+            if node.op in ("/", "//", "%") and not right.all():
+                raise OddsUnsupported("The expression can divide by zero")
+            return OPERATORS[node.op](left, right).astype(float)
+        case (
+            d20.ast.OperatedSet()
+            | d20.ast.NumberSet()
+            | d20.ast.OperatedDice()
+            | d20.ast.Dice()
+        ):
+            return pool(node, count, rng, thrown).total()
+    raise OddsUnsupported(f"{type(node).__name__} expressions aren't supported")
+
+
+def pool(
+    node: Any,
+    count: int,
+    rng: np.random.Generator,
+    thrown: list[tuple[int | str, np.ndarray]] | None = None,
+) -> Pool:
+    match node:
+        case d20.ast.OperatedSet():
+            # OperatedDice is an OperatedSet over Dice
+            result = pool(node.value, count, rng, thrown)
+            for operation in node.operations:
+                result.apply(operation, rng)
+            return result
+        case d20.ast.NumberSet():
+            columns = [sample(value, count, rng, thrown) for value in node.values]
+            return Pool(np.stack(columns, axis=1) if columns else np.zeros((count, 0)))
+        case d20.ast.Dice():
+            if node.size != "%" and int(node.size) < 1:
+                raise OddsUnsupported("Cannot roll a 0-sided die")
+            result = Pool(np.zeros((count, node.num)), node.size, thrown)
+            result.values = result.draw(rng, (count, node.num))
+            return result
+    raise OddsUnsupported(f"{type(node).__name__} expressions aren't supported")
+
+
+def settled(
+    count: int, total: float, squares: float, hits: int | None, precision: float
+) -> bool:
+    """Whether the 95% intervals of the mean, relative to the spread, and the hit chance are within *precision*"""
+    mean = total / count
+    stdev = math.sqrt(max(0.0, squares / count - mean**2))
+    if Z * stdev / math.sqrt(count) > precision * stdev:
+        return False
+    if hits is None:
+        return True
+    chance = hits / count
+    return Z * math.sqrt(chance * (1 - chance) / count) <= precision
+
+
+def simulate(
+    expression: str,
+    goal: int | None = None,
+    samples: int = 1_000_000,
+    budget: float = 1.0,
+    precision: float = 0.005,
+) -> Estimate:
+    """
+    Simulate
+
+    Estimates the distribution of a dice expression by rolling it many times
+    over, a whole batch of rolls per NumPy operation. Works for everything
+    d20 can roll, including what the exact odds can't handle. Stops at
+    *samples* rolls, after *budget* seconds, or once the estimate of the mean
+    and of the chance to reach *goal* have settled to within *precision*.
+
+
+    Args:
+        expression (str): The dice expression
+        goal (int): Number to try to beat
+        samples (int): Most rolls to simulate
+        budget (float): Seconds to spend at most
+        precision (float): How settled the estimates must be to stop early, 0
+            to always simulate every roll
+
+    Returns:
+        Estimate: The estimated distribution and how many rolls it is from
+    """
+    deadline = time.monotonic() + budget
+    tree = compile_expression(expression)
+    generator = np.random.default_rng()
+    batches: list[np.ndarray] = []
+    count, total, squares = 0, 0.0, 0.0
+    hits: int | None = None if goal is None else 0
+    converged = False
+    while count < samples:
+        # d20 only truncates the final total
+        batch = np.trunc(sample(tree, min(BATCH, samples - count), generator))
+        batches.append(batch)
+        count += len(batch)
+        total += float(batch.sum())
+        squares += float(np.dot(batch, batch))
+        if hits is not None:
+            hits += int(np.count_nonzero(batch >= goal))
+        if (
+            count >= MIN_SAMPLES
+            and precision
+            and settled(count, total, squares, hits, precision)
+        ):
+            converged = True
+            break
+        if time.monotonic() > deadline:
+            break
+    totals = np.concatenate(batches)
+    values, counts = np.unique(totals, return_counts=True)
+    return Estimate(
+        Distribution(values, counts / count), count, converged or count >= samples
+    )
+
+
+def roll_batch(
+    expression: str, count: int, seed: int | None = None
+) -> tuple[np.ndarray, int | None]:
+    """
+    Roll Batch
+
+    Rolls an expression *count* times at once, every roll on its own, for
+    when a group of creatures all make the same roll.
+
+
+    Args:
+        expression (str): The dice expression
+        count (int): How many times to roll it
+        seed (int): Seed of an earlier batch of the same expression and count to replay
+
+    Returns:
+        tuple: The totals as d20 would report them in order, and the seed when
+            the batch can be replayed
+    """
+    rng, seed = generator(seed)
+    totals = sample(compile_expression(expression), count, rng)
+    return np.trunc(totals).astype(np.int64), seed
+
+
+# Estimates are random anyway, keeping them a while saves repeating the work
+simulations: SingleFlight[Estimate] = SingleFlight("odds.simulations", ttl=10 * 60)
+
+
+async def simulated_odds(
+    expression: str, workers: Any, goal: int | None = None
+) -> Estimate:
+    """
+    Simulated Odds
+
+    Estimates the odds of an expression in the process pool, sharing the
+    estimate with everyone asking for the same expression and goal.
+
+
+    Args:
+        expression (str): The dice expression
+        workers (WorkerPool): The client's worker pools
+        goal (int): Number to try to beat
+
+    Returns:
+        Estimate: The estimated distribution and how many rolls it is from
+    """
+    key = (expression_key(expression), goal)
+    try:
+        return await simulations.do(
+            key,
+            lambda: workers.submit(
+                simulate, expression, goal, kind="process", timeout=2.0
+            ),
+        )
+    except (PoolSaturated, asyncio.TimeoutError):
+        raise OddsUnsupported("The odds took too long to work out")
+
+
+async def work_out_odds(
+    expression: str, workers: Any, goal: int | None = None
+) -> tuple[Distribution, int | None]:
+    """
+    Work Out Odds
+
+    The exact odds of an expression, or an estimate from simulated rolls when
+    they can't be worked out exactly.
+
+
+    Args:
+        expression (str): The dice expression
+        workers (WorkerPool): The client's worker pools
+        goal (int): Number to try to beat, the estimate is made precise for it
+
+    Returns:
+        tuple: The distribution, and how many rolls it was estimated from or
+            None when it is exact
+    """
+    try:
+        return await expression_odds(expression, workers), None
+    except OddsUnsupported:
+        estimate = await simulated_odds(expression, workers, goal)
+        return estimate.distribution, estimate.samples
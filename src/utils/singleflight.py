@@ -0,0 +1,111 @@
+import asyncio
+import inspect
+from typing import Any, Awaitable, Callable, Generic, Hashable, TypeVar
+
+from utils.caches import TTLCache
+from utils.metrics import metrics
+
+T = TypeVar("T")
+
+
+class SingleFlight(Generic[T]):
+    """
+    Single Flight
+
+    Makes concurrent callers asking for the same key share one call and its
+    result instead of each repeating the work. With a *ttl* the results are
+    also kept for that many seconds, least recently used first out once there
+    are more than *maxEntries*. Failures are shared but never kept, and neither
+    are results *keep* says no to.
+
+
+    Args:
+        name (str): Name used for the metrics
+        ttl (float): Seconds to keep results for, None to only coalesce
+        maxEntries (int): How many results to keep at most
+        keep (Callable): Whether a result is worth keeping, all are by default
+    """
+
+    def __init__(
+        self,
+        name: str,
+        ttl: float | None = None,
+        maxEntries: int = 1024,
+        keep: Callable[[T], bool] | None = None,
+    ) -> None:
+        self.name = name
+        self.keep = keep
+        self.cache: TTLCache[T] | None = (
+            None if ttl is None else TTLCache(name, maxEntries, ttl)
+        )
+        self.inflight: dict[Hashable, asyncio.Future[T]] = {}
+        self.hits = 0
+        self.coalesced = 0
+        self.misses = 0
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[T] | T]) -> T:
+        """
+        Do
+
+        Returns the result of func() for *key*, reusing a kept result or joining
+        a call for the same key that is already running.
+
+
+        Args:
+            key (Hashable): What identifies the result
+            func (Callable): Produces the result, may return an awaitable
+
+        Returns:
+            Any: The shared result
+        """
+        found, result = self.cache.get(key) if self.cache is not None else (False, None)
+        if found:
+            self.hits += 1
+            metrics.incr(f"singleflight.{self.name}.hits")
+            return result  # type: ignore
+
+        future = self.inflight.get(key)
+        if future is not None:
+            self.coalesced += 1
+            metrics.incr(f"singleflight.{self.name}.coalesced")
+        else:
+            self.misses += 1
+            metrics.incr(f"singleflight.{self.name}.misses")
+            future = asyncio.ensure_future(self.call(func))
+            self.inflight[key] = future
+            future.add_done_callback(lambda done: self.finish(key, done))
+        # A caller giving up must not cancel the call for everyone else
+        return await asyncio.shield(future)
+
+    async def call(self, func: Callable[[], Awaitable[T] | T]) -> T:
+        result = func()
+        if inspect.isawaitable(result):
+            return await result
+        return result
+
+    def finish(self, key: Hashable, future: asyncio.Future[T]) -> None:
+        if self.inflight.get(key) is future:
+            del self.inflight[key]
+        if self.cache is None or future.cancelled() or future.exception() is not None:
+            return
+        result = future.result()
+        if self.keep is None or self.keep(result):
+            self.cache.put(key, result)
+
+    def invalidate(self, key: Hashable | None = None) -> None:
+        """Forgets the result kept for *key*, or every result without a key"""
+        if self.cache is None:
+            return
+        if key is None:
+            self.cache.clear()
+        else:
+            self.cache.pop(key)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "entries": len(self.cache) if self.cache is not None else 0,
+            "inflight": len(self.inflight),
+            "hits": self.hits,
+            "coalesced": self.coalesced,
+            "misses": self.misses,
+        }
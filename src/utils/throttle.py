@@ -0,0 +1,161 @@
+import functools
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable, NamedTuple, TypeVar
+
+import discord
+from discord import app_commands
+
+T = TypeVar("T")
+
+
+class Limit(NamedTuple):
+    rate: int
+    per: float
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, capacity: float, now: float) -> None:
+        self.tokens = capacity
+        self.updated = now
+
+
+class Buckets:
+    """
+    Buckets
+
+    Token buckets for one Limit, one per key. A bucket that has been idle long
+    enough to refill completely is no different from a new one so it is dropped,
+    and the least recently used buckets are dropped past *maxBuckets*.
+    """
+
+    def __init__(self, limit: Limit, maxBuckets: int = 10_000) -> None:
+        self.limit = limit
+        self.refill = limit.rate / limit.per
+        self.maxBuckets = maxBuckets
+        self.buckets: OrderedDict[Hashable, TokenBucket] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.buckets)
+
+    def expire(self, now: float) -> None:
+        while self.buckets:
+            key, bucket = next(iter(self.buckets.items()))
+            if (
+                now - bucket.updated < self.limit.per
+                and len(self.buckets) < self.maxBuckets
+            ):
+                break
+            del self.buckets[key]
+
+    def wait(self, key: Hashable, now: float | None = None) -> float:
+        """
+        Wait
+
+        Refills *key*'s bucket without taking from it.
+
+
+        Returns:
+            float: 0 if a token is available, otherwise the seconds until one is
+        """
+        now = time.monotonic() if now is None else now
+        self.expire(now)
+
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(self.limit.rate, now)
+        else:
+            self.buckets.move_to_end(key)
+            bucket.tokens = min(
+                self.limit.rate, bucket.tokens + (now - bucket.updated) * self.refill
+            )
+            bucket.updated = now
+
+        if bucket.tokens >= 1:
+            return 0.0
+        return (1 - bucket.tokens) / self.refill
+
+    def take(self, key: Hashable, now: float | None = None) -> float:
+        """
+        Take
+
+        Takes a token from *key*'s bucket.
+
+
+        Returns:
+            float: 0 if a token was taken, otherwise the seconds until one is available
+        """
+        retryAfter = self.wait(key, now)
+        if not retryAfter:
+            self.buckets[key].tokens -= 1
+        return retryAfter
+
+
+class Throttle:
+    """
+    Throttle
+
+    Rate limits one command per user and per guild. Use `check` on commands,
+    which then fail with CommandOnCooldown, and `autocomplete` on autocomplete
+    callbacks, which then get the user's last result instead of running.
+    """
+
+    def __init__(self, user: Limit | None = None, guild: Limit | None = None) -> None:
+        self.user = Buckets(user) if user else None
+        self.guild = Buckets(guild) if guild else None
+        self.lastResults: OrderedDict[int, Any] = OrderedDict()
+        self.maxResults = 1_000
+        self.throttled = 0
+
+    def hit(self, interaction: discord.Interaction) -> tuple[float, Limit | None]:
+        """Returns how long the interaction has to wait and the limit it hit"""
+        now = time.monotonic()
+        buckets = []
+        if self.user is not None:
+            buckets.append((self.user, interaction.user.id))
+        if self.guild is not None and interaction.guild_id is not None:
+            buckets.append((self.guild, interaction.guild_id))
+        # Both buckets need a token before either gives one up, a call turned
+        # away by the guild limit mustn't cost the user anything
+        for limited, key in buckets:
+            retryAfter = limited.wait(key, now)
+            if retryAfter:
+                self.throttled += 1
+                return retryAfter, limited.limit
+        for limited, key in buckets:
+            limited.take(key, now)
+        return 0.0, None
+
+    def check(self) -> Callable[[T], T]:
+        def predicate(interaction: discord.Interaction) -> bool:
+            retryAfter, limit = self.hit(interaction)
+            if limit is not None:
+                raise app_commands.CommandOnCooldown(
+                    app_commands.Cooldown(limit.rate, limit.per), retryAfter
+                )
+            return True
+
+        return app_commands.check(predicate)
+
+    def autocomplete(
+        self, func: Callable[..., Awaitable[list[app_commands.Choice[Any]]]]
+    ) -> Callable[..., Awaitable[list[app_commands.Choice[Any]]]]:
+        @functools.wraps(func)
+        async def wrapper(
+            cog: Any, interaction: discord.Interaction, current: str
+        ) -> list[app_commands.Choice[Any]]:
+            userId = interaction.user.id
+            _, limit = self.hit(interaction)
+            if limit is not None:
+                return self.lastResults.get(userId, [])
+
+            results = await func(cog, interaction, current)
+            self.lastResults[userId] = results
+            self.lastResults.move_to_end(userId)
+            if len(self.lastResults) > self.maxResults:
+                self.lastResults.popitem(last=False)
+            return results
+
+        return wrapper
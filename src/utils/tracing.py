@@ -0,0 +1,138 @@
+import json
+import logging
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from queue import SimpleQueue
+from typing import Any, Iterator
+
+from discord.webhook.async_ import AsyncWebhookAdapter, async_context
+
+# Kept off the root logger so traces never mix with the regular logs
+traceLog = logging.getLogger("traces")
+traceLog.propagate = False
+
+
+class Span:
+    __slots__ = ("name", "parent", "trace", "start", "end", "attrs")
+
+    def __init__(self, name: str, parent: "Span | None", attrs: dict[str, Any]):
+        self.name = name
+        self.parent = parent
+        self.trace: list[Span] = parent.trace if parent else []
+        self.trace.append(self)
+        self.start = time.perf_counter()
+        self.end: float | None = None
+        self.attrs = attrs
+
+    def finish(self) -> None:
+        self.end = time.perf_counter()
+
+    def to_dict(self, root: "Span") -> dict[str, Any]:
+        end = self.end if self.end is not None else time.perf_counter()
+        return {
+            "name": self.name,
+            "parent": self.parent.name if self.parent else None,
+            "offset_ms": round((self.start - root.start) * 1000, 3),
+            "duration_ms": round((end - self.start) * 1000, 3),
+            **self.attrs,
+        }
+
+
+currentSpan: ContextVar[Span | None] = ContextVar("currentSpan", default=None)
+
+
+class Tracer:
+    def __init__(self) -> None:
+        self.sampleRate = 0.0
+
+    def start_trace(self, name: str, **attrs: Any) -> Span | None:
+        """Opens the root span for the current task, or returns None when not sampled"""
+        if self.sampleRate <= 0 or random.random() >= self.sampleRate:
+            return None
+        root = Span(name, None, attrs)
+        currentSpan.set(root)
+        return root
+
+    def finish_trace(self, root: Span) -> None:
+        root.finish()
+        traceLog.info(
+            json.dumps(
+                {
+                    "trace": root.name,
+                    "time": time.time(),
+                    "duration_ms": round((root.end - root.start) * 1000, 3),  # type: ignore
+                    **root.attrs,
+                    "spans": [span.to_dict(root) for span in root.trace[1:]],
+                },
+                default=str,
+            )
+        )
+
+
+tracer = Tracer()
+
+
+@contextmanager
+def span(name: str, **attrs: Any) -> Iterator[Span | None]:
+    """
+    Span
+
+    Times the block as a child of the current span, does nothing when the
+    current task isn't being traced.
+    """
+    parent = currentSpan.get()
+    if parent is None:
+        yield None
+        return
+
+    child = Span(name, parent, attrs)
+    token = currentSpan.set(child)
+    try:
+        yield child
+    except BaseException as err:
+        child.attrs["error"] = type(err).__name__
+        raise
+    finally:
+        child.finish()
+        currentSpan.reset(token)
+
+
+class TracingWebhookAdapter(AsyncWebhookAdapter):
+    """Puts a span around every interaction response, followup and edit"""
+
+    async def request(self, route, *args, **kwargs) -> Any:
+        with span(f"discord {route.method} {route.path}"):
+            return await super().request(route, *args, **kwargs)
+
+
+def setup_tracing(
+    path: str, sampleRate: float, maxBytes: int = 10_000_000, backupCount: int = 5
+) -> QueueListener:
+    """
+    Setup Tracing
+
+    Samples *sampleRate* of the interactions and writes their traces to *path*
+    as JSON lines from a background thread, rotating the file at *maxBytes*.
+
+
+    Returns:
+        QueueListener: The running writer, stop it to flush the queue on exit
+    """
+    tracer.sampleRate = sampleRate
+    # Tasks created after this, which is all of client.run, inherit the adapter
+    async_context.set(TracingWebhookAdapter())
+
+    queue: SimpleQueue[logging.LogRecord] = SimpleQueue()
+    fileHandler = RotatingFileHandler(
+        path, maxBytes=maxBytes, backupCount=backupCount, encoding="utf-8"
+    )
+    traceLog.handlers.clear()
+    traceLog.addHandler(QueueHandler(queue))
+    traceLog.setLevel(logging.INFO)
+
+    listener = QueueListener(queue, fileHandler)
+    listener.start()
+    return listener
@@ -0,0 +1,116 @@
+import asyncio
+import logging
+
+import discord
+from discord import app_commands
+from discord.state import ConnectionState
+
+from utils.log import bind_interaction
+from utils.tracing import tracer
+
+log = logging.getLogger("interactions")
+# Every keystroke is an autocomplete, keep it on its own logger so it can be sampled
+autocompleteLog = logging.getLogger("interactions.autocomplete")
+
+# Tasks discord.py runs interaction handlers in
+HANDLER_TASKS = (
+    "CommandTree-invoker",
+    "discord-ui-view-dispatch",
+    "discord-ui-modal-dispatch",
+    "discord-ui-dynamic-item",
+)
+
+# Interaction types the command tree never sees, views and modals handle them
+COMPONENT = 3
+MODAL_SUBMIT = 5
+
+
+class SpellbotTree(app_commands.CommandTree):
+    def __init__(self, client: discord.Client, **kwargs) -> None:
+        super().__init__(client, **kwargs)
+        self.accepting = True
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        bind_interaction(interaction)
+        name = interaction.command.qualified_name if interaction.command else "unknown"
+        if interaction.type is discord.InteractionType.autocomplete:
+            name += ":autocomplete"
+            autocompleteLog.debug("Autocomplete received")
+        else:
+            log.info("Command received")
+
+        root = tracer.start_trace(
+            name, guild=interaction.guild_id, interaction=interaction.id
+        )
+        task = asyncio.current_task()
+        if root is not None and task is not None:
+            # The handler runs in this task, the trace ends when it does
+            task.add_done_callback(lambda _: tracer.finish_trace(root))
+
+        if self.accepting:
+            return True
+        await self.refuse(interaction)
+        return False
+
+    async def refuse(self, interaction: discord.Interaction) -> None:
+        """Turns an interaction away while the bot shuts down"""
+        if interaction.type is discord.InteractionType.autocomplete:
+            await interaction.response.autocomplete([])
+        else:
+            await interaction.response.send_message(
+                "Spellbot is restarting, try again in a moment.", ephemeral=True
+            )
+
+    async def on_error(
+        self, interaction: discord.Interaction, error: app_commands.AppCommandError
+    ) -> None:
+        if isinstance(error, app_commands.CommandOnCooldown):
+            await interaction.response.send_message(
+                f"Slow down! Try again in {error.retry_after:.1f}s.", ephemeral=True
+            )
+            return
+        await super().on_error(interaction, error)
+
+    async def drain(self, timeout: float) -> int:
+        """
+        Drain
+
+        Waits up to *timeout* seconds for the interaction handlers that are
+        currently running to finish.
+
+
+        Returns:
+            int: The number of handlers still running when the timeout ran out
+        """
+        current = asyncio.current_task()
+        handlers = [
+            task
+            for task in asyncio.all_tasks()
+            if task is not current and task.get_name().startswith(HANDLER_TASKS)
+        ]
+        if not handlers:
+            return 0
+        _, pending = await asyncio.wait(handlers, timeout=timeout)
+        return len(pending)
+
+
+class SpellbotState(ConnectionState):
+    """
+    Spellbot State
+
+    Button clicks, select choices and modal submissions go straight to views
+    and dynamic items without passing the command tree, so they are turned
+    away here while the tree isn't accepting interactions.
+    """
+
+    def parse_interaction_create(self, data) -> None:
+        tree = self._command_tree
+        if (
+            data["type"] in (COMPONENT, MODAL_SUBMIT)
+            and isinstance(tree, SpellbotTree)
+            and not tree.accepting
+        ):
+            interaction = discord.Interaction(data=data, state=self)
+            asyncio.create_task(tree.refuse(interaction), name="spellbot-refuse")
+            return
+        super().parse_interaction_create(data)
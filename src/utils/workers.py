@@ -0,0 +1,162 @@
+import asyncio
+import concurrent.futures
+import functools
+import multiprocessing
+import os
+from typing import Any, Callable, TypeVar
+
+from utils.errors import PoolSaturated
+from utils.metrics import metrics
+
+T = TypeVar("T")
+
+KINDS = ("thread", "process")
+
+
+def available_cores() -> int:
+    """The cores this process may run on, which can be fewer than the machine has"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+class WorkerPool:
+    """
+    Worker Pool
+
+    Runs CPU bound work off the event loop so it doesn't hold up gateway
+    handling. Threads suit work that releases the GIL or is short, processes
+    suit long pure Python work whose arguments and result pickle cheaply.
+    Each pool admits its workers plus *queued* calls waiting for one, callers
+    past that wait for a slot until their deadline and then get PoolSaturated.
+
+
+    Args:
+        threads (int): Thread pool size, defaults to the available cores + 4 up to 32
+        processes (int): Process pool size, defaults to the available cores - 1
+        queued (int): Calls per worker allowed to wait for a free worker
+    """
+
+    def __init__(
+        self, threads: int | None = None, processes: int | None = None, queued: int = 4
+    ) -> None:
+        cores = available_cores()
+        self.sizes = {
+            "thread": threads or min(32, cores + 4),
+            "process": processes or max(1, cores - 1),
+        }
+        self.slots = {
+            kind: asyncio.Semaphore(size * (1 + queued))
+            for kind, size in self.sizes.items()
+        }
+        self.pending = {kind: 0 for kind in KINDS}
+        self.executors: dict[str, concurrent.futures.Executor] = {}
+
+    def executor(self, kind: str) -> concurrent.futures.Executor:
+        executor = self.executors.get(kind)
+        if executor is None:
+            if kind == "thread":
+                executor = concurrent.futures.ThreadPoolExecutor(
+                    self.sizes[kind], thread_name_prefix="spellbot-worker"
+                )
+            else:
+                # Forking a process that runs an event loop and threads isn't safe
+                executor = concurrent.futures.ProcessPoolExecutor(
+                    self.sizes[kind], mp_context=multiprocessing.get_context("spawn")
+                )
+            self.executors[kind] = executor
+        return executor
+
+    def warm(self) -> None:
+        """Starts the worker processes now so the first call doesn't pay for spawning them"""
+        self.executor("process").submit(int)
+
+    async def submit(
+        self,
+        func: Callable[..., T],
+        *args: Any,
+        kind: str = "thread",
+        timeout: float | None = None,
+        **kwargs: Any,
+    ) -> T:
+        """
+        Submit
+
+        Runs func(*args, **kwargs) in the pool and waits for its result.
+        Calls still waiting for a worker are dropped when the deadline passes or
+        the caller is cancelled, calls already running finish in the background.
+
+
+        Args:
+            func (Callable): A picklable callable when *kind* is "process"
+            kind (str): Either "thread" or "process"
+            timeout (float): Seconds to wait for a slot and the result together
+
+        Returns:
+            Any: What func returned
+
+        Raises:
+            PoolSaturated: No slot freed up before the deadline
+            asyncio.TimeoutError: The call didn't finish before the deadline
+        """
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        slots = self.slots[kind]
+
+        try:
+            await asyncio.wait_for(slots.acquire(), timeout)
+        except asyncio.TimeoutError:
+            metrics.incr(f"workers.{kind}.rejected")
+            raise PoolSaturated(kind) from None
+
+        self.pending[kind] += 1
+
+        def release() -> None:
+            self.pending[kind] -= 1
+            slots.release()
+
+        def released(_: concurrent.futures.Future) -> None:
+            # Calls left running on shutdown can finish after the loop closed
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(release)
+
+        try:
+            future = self.executor(kind).submit(
+                functools.partial(func, *args, **kwargs)
+            )
+        except BaseException:
+            release()
+            raise
+        # The slot stays taken until the worker is actually free again
+        future.add_done_callback(released)
+
+        started = loop.time()
+        remaining = None if deadline is None else max(0.0, deadline - started)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), remaining)
+        except asyncio.TimeoutError:
+            metrics.incr(f"workers.{kind}.timeouts")
+            raise
+        except concurrent.futures.BrokenExecutor:
+            # A worker process died, start a fresh pool for the next call
+            self.executors.pop(kind, None)
+            raise
+        finally:
+            metrics.observe(f"workers.{kind}", loop.time() - started)
+
+    def stats(self) -> dict[str, dict[str, int]]:
+        """Pool sizes, calls in flight and how many of those wait for a worker"""
+        return {
+            kind: {
+                "size": self.sizes[kind],
+                "pending": self.pending[kind],
+                "queued": max(0, self.pending[kind] - self.sizes[kind]),
+            }
+            for kind in KINDS
+        }
+
+    def close(self) -> None:
+        for executor in self.executors.values():
+            executor.shutdown(wait=False, cancel_futures=True)
+        self.executors.clear()